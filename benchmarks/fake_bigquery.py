@@ -0,0 +1,33 @@
+"""
+Recording stand-in for the google.cloud.bigquery client used by bigquery_utils
+"""
+import json
+import threading
+import time
+import types
+from collections import defaultdict
+
+
+class RecordingClient:
+    def __init__(self, latency=0.):
+        self.latency = latency
+        self.rows = defaultdict(list)
+        self.calls = 0
+        self.bytes_pushed = 0
+        self._lock = threading.Lock()
+
+    def get_table(self, table_id):
+        project, dataset_id, table = str(table_id).split('.')
+        return types.SimpleNamespace(project=project, dataset_id=dataset_id, table_id=table)
+
+    def create_table(self, table):
+        return self.get_table(table.table_id)
+
+    def insert_rows_json(self, table_id, json_rows):
+        time.sleep(self.latency)
+        size = len(json.dumps(json_rows))
+        with self._lock:
+            self.calls += 1
+            self.bytes_pushed += size
+            self.rows[table_id].extend(json_rows)
+        return []
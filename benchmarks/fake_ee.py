@@ -0,0 +1,249 @@
+"""
+Local stand-in for the subset of the earth-engine API used by cities_watch.
+
+Graph-building calls (ImageCollection.filterDate, Image.select, reduceToVectors ...) return lazy objects that only
+keep track of the geometry and the 'year' properties they relate to, and count the calls. getInfo() and export tasks
+are the only remote calls, they can be given a latency. Export tasks take a fixed latency (queueing, start-up) plus a
+latency per mapped year, and write synthetic GeoJSON city shapes (or a placeholder GeoTIFF for images) to a FakeS3
+bucket.
+"""
+import json
+import threading
+import time
+import types
+import zlib
+from collections import Counter
+
+from shapely.geometry import mapping, shape
+
+from benchmarks import synthetic
+
+
+class EEObject:
+    def __init__(self, fake, kind, geometry=None, years=()):
+        self._fake = fake
+        self._kind = kind
+        self._geometry = geometry
+        self._years = set(years)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+
+        def method(*args, **kwargs):
+            self._fake.count(f'{self._kind}.{name}')
+            years = set(self._years)
+            for arg in list(args) + list(kwargs.values()):
+                if isinstance(arg, EEObject):
+                    years |= arg._years
+                elif callable(arg):
+                    # mapped functions (e.g. mask2clouds) are traced once, as earth-engine does
+                    traced = arg(EEObject(self._fake, self._kind))
+                    if isinstance(traced, EEObject):
+                        years |= traced._years
+            if name == 'set':
+                props = args[0] if isinstance(args[0], dict) else {args[0]: args[1]}
+                if 'year' in props:
+                    years.add(props['year'])
+            return EEObject(self._fake, self._kind, _find_geometry(args, kwargs) or self._geometry, years)
+
+        return method
+
+    def getInfo(self):
+        self._fake.count('getInfo')
+        time.sleep(self._fake.getinfo_latency)
+        if self._geometry is None:
+            return None
+        return mapping(self._geometry)
+
+
+def _find_geometry(args, kwargs):
+    for arg in list(args) + list(kwargs.values()):
+        if isinstance(arg, EEObject) and arg._geometry is not None:
+            return arg._geometry
+        if isinstance(arg, dict) and arg.get('type') in ('Polygon', 'MultiPolygon'):
+            return shape(arg)
+    return None
+
+
+class _Namespace:
+    # Constructors such as ee.Image(...) that also expose static methods such as ee.Image.cat(...)
+    def __init__(self, fake, kind):
+        self._fake = fake
+        self._kind = kind
+
+    def __call__(self, *args, **kwargs):
+        self._fake.count(self._kind)
+        return EEObject(self._fake, self._kind, _find_geometry(args, kwargs))
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+
+        def method(*args, **kwargs):
+            self._fake.count(f'{self._kind}.{name}')
+            return EEObject(self._fake, self._kind, _find_geometry(args, kwargs))
+
+        return method
+
+
+class _Filter(_Namespace):
+    def eq(self, name, value):
+        self._fake.count('Filter.eq')
+        geometry = self._fake.country_geometry(value) if name == 'country_na' else None
+        return EEObject(self._fake, 'Filter', geometry)
+
+
+class FakeTask:
+    def __init__(self, fake, collection, description, bucket, fileNamePrefix, fileFormat='GeoJSON', **kwargs):
+        self._fake = fake
+        kind = 'image' if fileFormat == 'GeoTIFF' else 'table'
+        fake.count(f'Export.{kind}.toCloudStorage')
+        self.id = f'FAKE{fake.count("tasks"):08d}'
+        self.collection = collection
+        self.description = description
+        self.bucket = bucket
+        self.file_format = fileFormat
+        self.file_name = f"{fileNamePrefix}.{'tif' if fileFormat == 'GeoTIFF' else fileFormat.lower()}"
+        self.state = 'UNSUBMITTED'
+        self.creation_ts = int(time.time() * 1e3)
+        self.start_ts = None
+        self.update_ts = self.creation_ts
+
+    def start(self):
+        self.state = 'READY'
+        self._fake.submit(self)
+
+    def run(self):
+        with self._fake.task_slots:
+            self.state = 'RUNNING'
+            self.start_ts = int(time.time() * 1e3)
+            self._fake.task_started()
+            try:
+                time.sleep(self._fake.task_latency + self._fake.year_latency * max(1, len(self.collection._years)))
+                if self.file_format == 'GeoTIFF':
+                    content = b'II*\x00'
+                else:
+                    content = self._fake.export_content(self.collection, self.description)
+                self._fake.s3.Bucket(self.bucket).put_object(Key=self.file_name, Body=content)
+                self.state = 'COMPLETED'
+            except Exception as e:
+                print(f'Fake export {self.description} failed: {e}')
+                self.state = 'FAILED'
+            finally:
+                self.update_ts = int(time.time() * 1e3)
+                self._fake.task_finished(self)
+
+    def active(self):
+        return self.state in ('READY', 'RUNNING')
+
+    def status(self):
+        return {'state': self.state,
+                'description': self.description,
+                'creation_timestamp_ms': self.creation_ts,
+                'update_timestamp_ms': self.update_ts,
+                'start_timestamp_ms': self.start_ts,
+                'task_type': 'EXPORT_FEATURES',
+                'id': self.id,
+                'name': f'projects/earthengine-legacy/operations/{self.id}'}
+
+
+class FakeEarthEngine:
+    def __init__(self, s3, getinfo_latency=0.5, task_latency=5., max_concurrent_tasks=10,
+                 country_radius=6., shapes_per_degree2=20, seed=0, year_latency=0.):
+        self.s3 = s3
+        self.getinfo_latency = getinfo_latency
+        self.task_latency = task_latency
+        self.year_latency = year_latency
+        self.country_radius = country_radius
+        self.shapes_per_degree2 = shapes_per_degree2
+        self.seed = seed
+        self.task_slots = threading.Semaphore(max_concurrent_tasks)
+        self.calls = Counter()
+        self.tasks = []
+        self.task_durations = []
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def count(self, name):
+        with self._lock:
+            self.calls[name] += 1
+            return self.calls[name]
+
+    def country_geometry(self, country):
+        # Seeded by name so that the same country always gets the same shape
+        seed = zlib.crc32(f'{self.seed}_{country}'.encode())
+        center = (-120 + seed % 240, -40 + (seed // 240) % 90)
+        return synthetic.make_country_polygon(seed=seed % 2 ** 31, radius=self.country_radius, center=center,
+                                              n_islands=2).buffer(0)
+
+    def export_content(self, collection, description):
+        geom = collection._geometry
+        n_shapes = max(1, int(geom.area * self.shapes_per_degree2))
+        features = []
+        # Multi-year collections get one set of shapes per year, with a year property
+        for year in sorted(collection._years) or [None]:
+            seed = zlib.crc32(f'{self.seed}_{description}_{year}'.encode()) % 2 ** 31
+            shapes = [t.intersection(geom) for t in synthetic.make_city_shapes(n_shapes, bounds=geom.bounds,
+                                                                                seed=seed)
+                      if t.intersects(geom)]
+            for t in shapes:
+                if t.is_empty:
+                    continue
+                props = {'city': 1, 'mean': 0.95, 'id': str(len(features))}
+                if year is not None:
+                    props['year'] = year
+                features.append({'type': 'Feature', 'id': props['id'], 'geometry': mapping(t), 'properties': props})
+        return json.dumps({'type': 'FeatureCollection', 'features': features}).encode('utf-8')
+
+    def submit(self, task):
+        with self._lock:
+            self.tasks.append(task)
+        thread = threading.Thread(target=task.run, daemon=True)
+        self._threads.append(thread)
+        thread.start()
+
+    def task_started(self):
+        with self._lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+
+    def task_finished(self, task):
+        with self._lock:
+            self.running -= 1
+            self.task_durations.append((task.update_ts - task.start_ts) / 1e3)
+
+    def wait_all(self):
+        for thread in list(self._threads):
+            thread.join()
+
+    def module(self):
+        """
+        Build a module exposing the ee API, to be installed as sys.modules['ee'] before importing cities_watch
+        """
+        fake = self
+        ee = types.ModuleType('ee')
+        ee.ServiceAccountCredentials = lambda *args, **kwargs: None
+        ee.Initialize = lambda *args, **kwargs: None
+        for kind in ['Image', 'ImageCollection', 'Feature', 'FeatureCollection', 'Geometry', 'Number', 'Reducer',
+                     'Model', 'Projection', 'PixelType']:
+            setattr(ee, kind, _Namespace(fake, kind))
+        ee.Filter = _Filter(fake, 'Filter')
+
+        def to_cloud_storage(collection, description, bucket, fileNamePrefix, fileFormat='GeoJSON', **kwargs):
+            return FakeTask(fake, collection, description, bucket, fileNamePrefix, fileFormat)
+
+        def image_to_cloud_storage(image, description, bucket, fileNamePrefix, fileFormat='GeoTIFF', **kwargs):
+            return FakeTask(fake, image, description, bucket, fileNamePrefix, fileFormat)
+
+        def get_task_status(task_ids):
+            task_ids = [task_ids] if isinstance(task_ids, str) else list(task_ids)
+            return [t.status() for t in list(fake.tasks) if t.id in task_ids]
+
+        ee.data = types.SimpleNamespace(getTaskStatus=get_task_status)
+        ee.batch = types.SimpleNamespace(
+            Export=types.SimpleNamespace(table=types.SimpleNamespace(toCloudStorage=to_cloud_storage),
+                                         image=types.SimpleNamespace(toCloudStorage=image_to_cloud_storage)))
+        return ee
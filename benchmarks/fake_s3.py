@@ -0,0 +1,73 @@
+"""
+In-memory stand-in for the boto3 S3 resource, as used by gcloud_utils.list_objects_from_bucket
+"""
+import io
+import threading
+import time
+from collections import Counter, defaultdict
+
+
+class FakeObjectSummary:
+    def __init__(self, s3, bucket_name, key):
+        self._s3 = s3
+        self.bucket_name = bucket_name
+        self.key = key
+        self.size = len(s3.buckets[bucket_name][key])
+
+    def get(self):
+        data = self._s3.read(self.bucket_name, self.key)
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data)}
+
+
+class FakeObjects:
+    def __init__(self, s3, bucket_name):
+        self._s3 = s3
+        self._bucket_name = bucket_name
+
+    def filter(self, Prefix=''):
+        self._s3.count('list')
+        time.sleep(self._s3.latency)
+        with self._s3.lock:
+            keys = sorted(t for t in self._s3.buckets[self._bucket_name] if t.startswith(Prefix))
+        return [FakeObjectSummary(self._s3, self._bucket_name, t) for t in keys]
+
+    def all(self):
+        return self.filter(Prefix='')
+
+
+class FakeBucket:
+    def __init__(self, s3, name):
+        self._s3 = s3
+        self.name = name
+        self.objects = FakeObjects(s3, name)
+
+    def put_object(self, Key, Body):
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        self._s3.count('put')
+        self._s3.count('bytes_written', len(Body))
+        with self._s3.lock:
+            self._s3.buckets[self.name][Key] = bytes(Body)
+
+
+class FakeS3:
+    def __init__(self, latency=0.):
+        self.latency = latency
+        self.buckets = defaultdict(dict)
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.calls[name] += value
+
+    def read(self, bucket_name, key):
+        time.sleep(self.latency)
+        with self.lock:
+            data = self.buckets[bucket_name][key]
+        self.count('get')
+        self.count('bytes_read', len(data))
+        return data
+
+    def Bucket(self, name):
+        return FakeBucket(self, name)
@@ -0,0 +1,121 @@
+"""
+Canned HTTP server answering the Overpass and Wikimedia pageviews queries made by osm_utils and wiki_utils.
+
+Point the code at it with the OVERPASS_URL and REF_WIKI_URL environment variables (see FakeServices.environ)
+before importing cities_watch.
+"""
+import json
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+BBOX_PATTERN = re.compile(r'node\(\s*([-\d.e]+),\s*([-\d.e]+),\s*([-\d.e]+),\s*([-\d.e]+)\s*\)')
+
+
+def overpass_elements(south, west, north, east, nodes_per_degree2=5, max_nodes=20000):
+    seed = zlib.crc32(f'{south}_{west}_{north}_{east}'.encode()) % 2 ** 31
+    rng = np.random.RandomState(seed)
+    n = int(min(max_nodes, max(1, (north - south) * (east - west) * nodes_per_degree2)))
+    lats = rng.uniform(south, north, n)
+    lons = rng.uniform(west, east, n)
+    elements = []
+    for i, (lat, lon) in enumerate(zip(lats, lons)):
+        name = f'place_{seed}_{i}'
+        elements.append({'type': 'node', 'id': int(seed % 1e6 * 1e5 + i), 'lat': float(lat), 'lon': float(lon),
+                         'tags': {'name': name,
+                                  'name:en': name,
+                                  'alt_name': f'alt_{name}',
+                                  'place': 'city' if rng.rand() < 0.2 else 'town',
+                                  'wikipedia': f'en:{name}'}})
+    return elements
+
+
+def pageviews_items(path, found_ratio=0.8):
+    seed = zlib.crc32(path.encode())
+    if seed % 100 >= found_ratio * 100:
+        return None
+    rng = np.random.RandomState(seed % 2 ** 31)
+    return [{'views': int(t)} for t in rng.pareto(1., 12) * 1e3]
+
+
+class FakeServices:
+    def __init__(self, latency=0., nodes_per_degree2=5, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.nodes_per_degree2 = nodes_per_degree2
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def environ(self):
+        return {'OVERPASS_URL': f'{self.url}/api/interpreter',
+                'REF_WIKI_URL': f'{self.url}/metrics/pageviews/per-article/{{language}}.wikipedia.org/all-access/'
+                                f'all-agents/{{name}}/{{granularity}}/{{start}}/{{end}}'}
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.calls[name] += value
+
+    def _handler(self):
+        services = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, status, payload):
+                body = json.dumps(payload).encode('utf-8')
+                services.count('bytes_sent', len(body))
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _route(self, query=''):
+                time.sleep(services.latency)
+                if self.path.startswith('/api/interpreter'):
+                    services.count('overpass')
+                    match = BBOX_PATTERN.search(query)
+                    if not match:
+                        return self._reply(400, {'remark': 'no bbox in query'})
+                    south, west, north, east = map(float, match.groups())
+                    elements = overpass_elements(south, west, north, east,
+                                                 nodes_per_degree2=services.nodes_per_degree2)
+                    return self._reply(200, {'version': 0.6, 'generator': 'fake', 'elements': elements})
+                if self.path.startswith('/metrics/pageviews'):
+                    services.count('wikimedia')
+                    items = pageviews_items(self.path)
+                    if items is None:
+                        return self._reply(404, {'type': 'not_found', 'title': 'Not found.'})
+                    return self._reply(200, {'items': items})
+                return self._reply(404, {})
+
+            def do_GET(self):
+                self._route()
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                self._route(self.rfile.read(length).decode('utf-8'))
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
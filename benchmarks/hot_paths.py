@@ -0,0 +1,136 @@
+"""
+Micro-benchmarks of the geometry and tagging hot paths on seeded synthetic data.
+
+Usage (from the repository root):
+    python -m benchmarks.hot_paths                   # run and compare against the stored baseline
+    python -m benchmarks.hot_paths --save-baseline   # run and store the results as the new baseline
+    python -m benchmarks.hot_paths --sweep full      # bigger sizes, closer to country-scale runs
+"""
+import argparse
+import os
+
+# Benchmarks never need earth-engine
+os.environ.setdefault('CITIES_WATCH_OFFLINE', '1')
+
+import geopandas as gpd
+import pandas as pd
+
+from benchmarks import synthetic
+from benchmarks.measure import measure, load_baseline, save_baseline, compare_to_baseline
+from cities_watch import config
+from cities_watch.geom_utils import area_split, get_clusters_from_geom, merge_split_shapes
+from cities_watch.reverse_geo_utils import add_city_ranking, ckdnearest, compute_area, tag_nodes_to_shapes
+
+BENCHMARK_NAME = 'hot_paths'
+SEED = 42
+BOUNDS = (5., 40., 15., 50.)
+METADATA = {'country_code_gaul': 0, 'iso3c': 'XXX', 'year': 2019}
+
+SWEEPS = {
+    'quick': {'area_split': [2, 5, 10],  # radius of the country shape in degrees
+              'get_clusters_from_geom': [10, 100, 500],  # number of islands
+              'merge_split_shapes': [500, 2000, 5000],  # number of city shapes
+              'tag_nodes_to_shapes': [(500, 500), (2000, 1000), (5000, 2000)],  # (shapes, nodes)
+              'ckdnearest': [(1000, 1000), (10000, 5000), (50000, 20000)],  # (points, nodes)
+              'compute_area': [100, 500, 2000],  # number of city shapes
+              'add_city_ranking': [1000, 10000, 100000]},  # number of records
+    'full': {'area_split': [5, 10, 20],
+             'get_clusters_from_geom': [100, 1000, 5000],
+             'merge_split_shapes': [5000, 20000, 50000],
+             'tag_nodes_to_shapes': [(5000, 2000), (20000, 10000), (50000, 20000)],
+             'ckdnearest': [(50000, 20000), (200000, 50000), (1000000, 100000)],
+             'compute_area': [2000, 10000, 20000],
+             'add_city_ranking': [100000, 500000, 1000000]},
+}
+
+
+def _setup_area_split(radius):
+    country = synthetic.make_country_polygon(seed=SEED, radius=radius)
+    return (list(country)[0],), {'max_area': config.MAX_AREA}
+
+
+def _setup_get_clusters_from_geom(n_islands):
+    return (synthetic.make_country_polygon(seed=SEED, n_islands=n_islands),), {}
+
+
+def _setup_merge_split_shapes(n_shapes):
+    shapes = synthetic.make_city_shapes(n_shapes, bounds=BOUNDS, seed=SEED)
+    return (synthetic.make_split_features(shapes, seed=SEED),), {}
+
+
+def _setup_tag_nodes_to_shapes(sizes):
+    n_shapes, n_nodes = sizes
+    shapes = synthetic.make_city_shapes(n_shapes, bounds=BOUNDS, seed=SEED)
+    df_nodes = synthetic.make_osm_nodes(n_nodes, bounds=BOUNDS, seed=SEED)
+    return (df_nodes, shapes), {'metadata': METADATA, 'add_ranks': True}
+
+
+def _setup_ckdnearest(sizes):
+    n_points, n_nodes = sizes
+    df_nodes = synthetic.make_osm_nodes(n_points + n_nodes, bounds=BOUNDS, seed=SEED)
+    gd1 = gpd.GeoDataFrame(df_nodes.iloc[:n_points][['node_id', 'geometry']])
+    gd2 = gpd.GeoDataFrame(df_nodes.iloc[n_points:].reset_index(drop=True))
+    return (gd1, gd2), {}
+
+
+def _compute_areas(geoms):
+    return [compute_area(g) for g in geoms]
+
+
+def _setup_compute_area(n_shapes):
+    return (synthetic.make_city_shapes(n_shapes, bounds=BOUNDS, seed=SEED),), {}
+
+
+def _setup_add_city_ranking(n_records):
+    return (synthetic.make_city_records(n_records, seed=SEED),), {}
+
+
+CASES = {
+    'area_split': (area_split, _setup_area_split),
+    'get_clusters_from_geom': (get_clusters_from_geom, _setup_get_clusters_from_geom),
+    'merge_split_shapes': (merge_split_shapes, _setup_merge_split_shapes),
+    'tag_nodes_to_shapes': (tag_nodes_to_shapes, _setup_tag_nodes_to_shapes),
+    'ckdnearest': (ckdnearest, _setup_ckdnearest),
+    'compute_area': (_compute_areas, _setup_compute_area),
+    'add_city_ranking': (add_city_ranking, _setup_add_city_ranking),
+}
+
+
+def run(sweep='quick', cases=None, repeat=3):
+    results = {}
+    for name, sizes in SWEEPS[sweep].items():
+        if cases and name not in cases:
+            continue
+        func, setup = CASES[name]
+        for size in sizes:
+            args, kwargs = setup(size)
+            case = f"{name}[{'x'.join(map(str, size)) if isinstance(size, tuple) else size}]"
+            results[case] = measure(func, *args, repeat=repeat, **kwargs)
+            print(f"{case}: {results[case]['time_min']:.4f}s, {results[case]['peak_mem_mb']:.1f}MB")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sweep', choices=list(SWEEPS), default='quick')
+    parser.add_argument('--cases', nargs='*', choices=list(CASES), default=None)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=config.BENCHMARK_TOLERANCE)
+    args = parser.parse_args()
+
+    baseline_name = f'{BENCHMARK_NAME}_{args.sweep}'
+    bench_results = run(sweep=args.sweep, cases=args.cases, repeat=args.repeat)
+
+    if args.save_baseline:
+        print(f'Baseline written at {save_baseline(baseline_name, bench_results)}')
+    else:
+        ref = load_baseline(baseline_name)
+        if ref is None:
+            print(f'No baseline found for {baseline_name}, run with --save-baseline to create one.')
+        else:
+            df_compare = compare_to_baseline(bench_results, ref, tolerance=args.tolerance)
+            with pd.option_context('display.width', 200, 'display.max_rows', None):
+                print(df_compare)
+            if df_compare.get('regression', pd.Series(dtype=bool)).fillna(False).any():
+                raise SystemExit('Performance regression(s) detected v.s baseline')
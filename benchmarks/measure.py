@@ -0,0 +1,72 @@
+import gc
+import json
+import os
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from cities_watch import config
+
+
+def measure(func, *args, repeat=3, warmup=1, **kwargs):
+    """
+    Time a function call (best and mean of repeat runs) and its peak memory.
+    Peak memory is measured by tracemalloc on a separate run, so that tracing does not bias timings.
+    It covers Python and numpy allocations of the current process only (not GEOS internals or joblib workers).
+    """
+    for _ in range(warmup):
+        func(*args, **kwargs)
+
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        timings.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {'time_min': min(timings),
+            'time_mean': float(np.mean(timings)),
+            'peak_mem_mb': peak / 2 ** 20}
+
+
+def load_baseline(name):
+    file_path = os.path.join(config.BENCHMARKS_FOLDER, f'{name}_baseline.json')
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path, 'r') as f:
+        return json.load(f)
+
+
+def save_baseline(name, results):
+    file_path = os.path.join(config.BENCHMARKS_FOLDER, f'{name}_baseline.json')
+    with open(file_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    return file_path
+
+
+def compare_to_baseline(results, baseline, tolerance=config.BENCHMARK_TOLERANCE):
+    """
+    Compare results {case: {'time_min':..., 'peak_mem_mb':...}} to a baseline with the same structure.
+    A case is flagged as a regression when time or peak memory grew by more than tolerance
+    """
+    rows = []
+    for case, res in results.items():
+        ref = baseline.get(case)
+        row = {'case': case, 'time_min': res['time_min'], 'peak_mem_mb': res['peak_mem_mb']}
+        if ref:
+            row['time_ratio'] = res['time_min'] / ref['time_min'] if ref['time_min'] else np.nan
+            row['mem_ratio'] = res['peak_mem_mb'] / ref['peak_mem_mb'] if ref['peak_mem_mb'] else np.nan
+            row['regression'] = bool((row['time_ratio'] > 1 + tolerance) | (row['mem_ratio'] > 1 + tolerance))
+        rows.append(row)
+
+    return pd.DataFrame(rows)
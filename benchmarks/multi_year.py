@@ -0,0 +1,70 @@
+"""
+Compare the number of earth-engine tasks, graph calls and wall-clock time of urban_mapper.main with one export per
+(split, year) v.s a single multi-year export per split, against the fake earth-engine.
+
+Usage (from the repository root):
+    python -m benchmarks.multi_year --countries 2 --years 2015 2016 2017 2018 2019 --task-latency 5 --year-latency 2
+
+Each export task takes --task-latency (queueing, start-up) plus --year-latency per year it maps. Few synthetic shapes
+are exported by default so that generating them locally does not weigh on the wall-clock time.
+"""
+import argparse
+import json
+import time
+
+from benchmarks.pipeline import install_stand_ins, make_metas
+
+
+def run_mode(urban_mapper, model, fake, s3, metas, list_years, multi_year):
+    fake.calls.clear()
+    fake.max_running = 0
+    s3.buckets.clear()
+    start = time.perf_counter()
+    summaries = urban_mapper.main(metas, list(list_years), model=model, s3=s3, multi_year=multi_year)
+    submitted = time.perf_counter()
+    fake.wait_all()
+    end = time.perf_counter()
+    return {'multi_year': multi_year,
+            'tasks': len(summaries),
+            'graph_calls': sum(fake.calls.values()) - fake.calls['getInfo'],
+            'getinfo_calls': fake.calls['getInfo'],
+            'max_running_tasks': fake.max_running,
+            'submit_s': submitted - start,
+            'wall_clock_s': end - start}
+
+
+def compare(n_countries=2, list_years=(2015, 2016, 2017, 2018, 2019), task_latency=5., year_latency=2.,
+            max_concurrent_tasks=10, getinfo_latency=0.5, shapes_per_degree2=2):
+    stand_ins = install_stand_ins(getinfo_latency=getinfo_latency, task_latency=task_latency,
+                                  year_latency=year_latency, max_concurrent_tasks=max_concurrent_tasks,
+                                  shapes_per_degree2=shapes_per_degree2)
+    fake, s3 = stand_ins['ee'], stand_ins['s3']
+    stand_ins['services'].stop()
+
+    from cities_watch import models, urban_mapper
+
+    metas = make_metas(n_countries)
+    model = models.load_model()
+    per_year = run_mode(urban_mapper, model, fake, s3, metas, list_years, multi_year=False)
+    multi_year = run_mode(urban_mapper, model, fake, s3, metas, list_years, multi_year=True)
+
+    return {'per_year': per_year,
+            'multi_year': multi_year,
+            'task_reduction': 1 - multi_year['tasks'] / per_year['tasks'],
+            'graph_calls_reduction': 1 - multi_year['graph_calls'] / per_year['graph_calls'],
+            'wall_clock_reduction': 1 - multi_year['wall_clock_s'] / per_year['wall_clock_s']}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--countries', type=int, default=2)
+    parser.add_argument('--years', type=int, nargs='+', default=[2015, 2016, 2017, 2018, 2019])
+    parser.add_argument('--task-latency', type=float, default=5.)
+    parser.add_argument('--year-latency', type=float, default=2.)
+    parser.add_argument('--max-concurrent-tasks', type=int, default=10)
+    parser.add_argument('--getinfo-latency', type=float, default=0.5)
+    args = parser.parse_args()
+
+    print(json.dumps(compare(n_countries=args.countries, list_years=args.years, task_latency=args.task_latency,
+                             year_latency=args.year_latency, max_concurrent_tasks=args.max_concurrent_tasks,
+                             getinfo_latency=args.getinfo_latency), indent=2))
@@ -0,0 +1,224 @@
+"""
+End-to-end offline run of urban_mapper and urban_tagger against local stand-ins (earth-engine, bucket,
+Overpass/Wikimedia, BigQuery), reporting stage timings, concurrency and bottlenecks.
+
+Usage (from the repository root):
+    python -m benchmarks.pipeline --countries 4 --years 2018 2019 --concurrency 2 --task-latency 5
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+import pandas as pd
+
+from benchmarks.fake_bigquery import RecordingClient
+from benchmarks.fake_ee import FakeEarthEngine
+from benchmarks.fake_s3 import FakeS3
+from benchmarks.fake_services import FakeServices
+
+MAPPER_STAGES = {'split_feature': 'split', 'map_urban_areas': 'graph', 'list_exported_objects': 'bucket_list',
+                 'export_shapes_to_bucket': 'submit'}
+TAGGER_STAGES = {'load_country_shape': 'country_shape', 'load_country_nodes': 'osm_nodes',
+                 'load_cities_shapes': 'fetch_merge', 'download_cities_shapes': 'fetch',
+                 'merge_split_shapes': 'merge', 'tag_nodes_to_shapes': 'tag', 'tag_nodes_to_tables': 'tag',
+                 'push_records_to_bq': 'bq_push'}
+
+
+class StageRecorder:
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, stage, start, end):
+        with self._lock:
+            self.spans.append({'stage': stage, 'start': start, 'end': end, 'thread': threading.get_ident()})
+
+    def wrap(self, module, attr, stage):
+        func = getattr(module, attr)
+
+        @wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, start, time.perf_counter())
+
+        setattr(module, attr, timed)
+
+
+def _max_overlap(intervals):
+    events = sorted([(s, 1) for s, _ in intervals] + [(e, -1) for _, e in intervals])
+    current = best = 0
+    for _, step in events:
+        current += step
+        best = max(best, current)
+    return best
+
+
+def _busy_time(intervals):
+    # length of the union of the intervals: time during which at least one call of the stage was running
+    total, last_end = 0., None
+    for s, e in sorted(intervals):
+        if last_end is None or s > last_end:
+            total += e - s
+            last_end = e
+        elif e > last_end:
+            total += e - last_end
+            last_end = e
+    return total
+
+
+def summarize_stages(spans, wall_time):
+    df = pd.DataFrame(spans)
+    rows = []
+    for stage, df_s in df.groupby('stage'):
+        intervals = list(zip(df_s['start'], df_s['end']))
+        durations = df_s['end'] - df_s['start']
+        busy = _busy_time(intervals)
+        rows.append({'stage': stage, 'calls': len(df_s), 'total_s': durations.sum(), 'mean_s': durations.mean(),
+                     'max_s': durations.max(), 'busy_s': busy, 'busy_share': busy / wall_time,
+                     'max_concurrency': _max_overlap(intervals)})
+    return pd.DataFrame(rows).sort_values('busy_s', ascending=False).reset_index(drop=True)
+
+
+def make_metas(n_countries):
+    return [{'country_name': f'Country {i}', 'country_na_LSIB': f'Country {i}', 'country_code_gaul': 90000 + i,
+             'iso3c': f'Z{i:02d}'} for i in range(n_countries)]
+
+
+def install_stand_ins(getinfo_latency=0.5, task_latency=5., max_concurrent_tasks=10, s3_latency=0.05,
+                      http_latency=0.01, bq_latency=0.1, country_radius=6., shapes_per_degree2=20,
+                      nodes_per_degree2=5, year_latency=0.):
+    """
+    Start the stand-ins and point cities_watch at them, must be called before importing any cities_watch module.
+    Outputs written to the data folders are redirected to a temporary folder.
+    """
+    s3 = FakeS3(latency=s3_latency)
+    fake = FakeEarthEngine(s3, getinfo_latency=getinfo_latency, task_latency=task_latency,
+                           max_concurrent_tasks=max_concurrent_tasks, country_radius=country_radius,
+                           shapes_per_degree2=shapes_per_degree2, year_latency=year_latency)
+    services = FakeServices(latency=http_latency, nodes_per_degree2=nodes_per_degree2).start()
+    client = RecordingClient(latency=bq_latency)
+
+    # The stand-ins must be in place before cities_watch reads its configuration and imports ee
+    if any(t.startswith('cities_watch') for t in sys.modules):
+        raise RuntimeError('cities_watch must not be imported before setting up the stand-ins')
+    os.environ['CITIES_WATCH_OFFLINE'] = '1'
+    os.environ.update(services.environ)
+    sys.modules['ee'] = fake.module()
+
+    from cities_watch import config
+
+    # Keep outputs away from the real data folders
+    tmp_dir = tempfile.mkdtemp(prefix='cities_watch_pipeline_')
+    for folder in ['RESUlTS_FOLDER', 'FAILS_FOLDER', 'OSM_NODES_FOLDER', 'SUMMARY_FOLDER', 'NORMALIZED_FOLDER',
+                   'COUNTRIES_FOLDER']:
+        setattr(config, folder, os.path.join(tmp_dir, folder.lower()))
+        os.makedirs(getattr(config, folder), exist_ok=True)
+
+    return {'ee': fake, 's3': s3, 'services': services, 'bq': client, 'output_folder': tmp_dir}
+
+
+def run_load(n_countries=2, list_years=(2018, 2019), concurrency=2, getinfo_latency=0.5, task_latency=5.,
+             max_concurrent_tasks=10, s3_latency=0.05, http_latency=0.01, bq_latency=0.1, country_radius=6.,
+             shapes_per_degree2=20, nodes_per_degree2=5, multi_year=False, pipelined=False):
+    stand_ins = install_stand_ins(getinfo_latency=getinfo_latency, task_latency=task_latency,
+                                  max_concurrent_tasks=max_concurrent_tasks, s3_latency=s3_latency,
+                                  http_latency=http_latency, bq_latency=bq_latency, country_radius=country_radius,
+                                  shapes_per_degree2=shapes_per_degree2, nodes_per_degree2=nodes_per_degree2)
+    fake, s3, services, client = stand_ins['ee'], stand_ins['s3'], stand_ins['services'], stand_ins['bq']
+    tmp_dir = stand_ins['output_folder']
+
+    from cities_watch import models, urban_mapper, urban_tagger
+
+    recorder = StageRecorder()
+    for attr, stage in MAPPER_STAGES.items():
+        recorder.wrap(urban_mapper, attr, stage)
+    for attr, stage in TAGGER_STAGES.items():
+        recorder.wrap(urban_tagger, attr, stage)
+
+    metas = make_metas(n_countries)
+    model = models.load_model()
+    start = time.perf_counter()
+
+    # Mapping: one worker per country, export tasks run concurrently on the fake earth-engine
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        summaries = list(pool.map(lambda meta: urban_mapper.main([meta], list(list_years), model=model, s3=s3,
+                                                                 multi_year=multi_year),
+                                  metas))
+    mapped_at = time.perf_counter()
+    fake.wait_all()
+    exported_at = time.perf_counter()
+    recorder.add('ee_export_wait', mapped_at, exported_at)
+
+    # Tagging: one worker per country, or all country-years through the staged pipeline (merge and tag then run in
+    # worker processes, which are not recorded as stages)
+    if pipelined:
+        urban_tagger.run_pipeline(metas, list(list_years), s3=s3, client=client, fetch_workers=concurrency)
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(lambda meta: urban_tagger.main([meta], list(list_years), s3=s3, client=client), metas))
+    end = time.perf_counter()
+    services.stop()
+
+    wall_time = end - start
+    df_stages = summarize_stages(recorder.spans, wall_time)
+    n_tasks = sum(len(t) for t in summaries)
+    report = {'countries': n_countries,
+              'years': list(list_years),
+              'wall_time_s': wall_time,
+              'mapping_s': mapped_at - start,
+              'export_wait_s': exported_at - mapped_at,
+              'tagging_s': end - exported_at,
+              'ee_tasks': n_tasks,
+              'ee_max_running_tasks': fake.max_running,
+              'ee_getinfo_calls': fake.calls['getInfo'],
+              'ee_graph_calls': sum(fake.calls.values()) - fake.calls['getInfo'],
+              'bucket_calls': dict(s3.calls),
+              'http_calls': dict(services.calls),
+              'bq_calls': client.calls,
+              'bq_rows': sum(len(t) for t in client.rows.values()),
+              'bq_bytes': client.bytes_pushed,
+              'tasks_per_hour': n_tasks / wall_time * 3600,
+              'bottleneck': df_stages.iloc[0]['stage'] if len(df_stages) else None,
+              'stages': df_stages.to_dict(orient='records'),
+              'output_folder': tmp_dir}
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--countries', type=int, default=2)
+    parser.add_argument('--years', type=int, nargs='+', default=[2018, 2019])
+    parser.add_argument('--concurrency', type=int, default=2)
+    parser.add_argument('--getinfo-latency', type=float, default=0.5)
+    parser.add_argument('--task-latency', type=float, default=5.)
+    parser.add_argument('--max-concurrent-tasks', type=int, default=10)
+    parser.add_argument('--s3-latency', type=float, default=0.05)
+    parser.add_argument('--http-latency', type=float, default=0.01)
+    parser.add_argument('--bq-latency', type=float, default=0.1)
+    parser.add_argument('--multi-year', action='store_true', help='Export all years of a split in a single task')
+    parser.add_argument('--pipelined', action='store_true', help='Tag through the staged pipeline of urban_tagger')
+    parser.add_argument('--out', default=None, help='Optional path to write the JSON report')
+    args = parser.parse_args()
+
+    load_report = run_load(n_countries=args.countries, list_years=args.years, concurrency=args.concurrency,
+                           getinfo_latency=args.getinfo_latency, task_latency=args.task_latency,
+                           max_concurrent_tasks=args.max_concurrent_tasks, s3_latency=args.s3_latency,
+                           http_latency=args.http_latency, bq_latency=args.bq_latency, multi_year=args.multi_year,
+                           pipelined=args.pipelined)
+
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(pd.DataFrame(load_report['stages']))
+    print(json.dumps({k: v for k, v in load_report.items() if k != 'stages'}, indent=2, default=str))
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(load_report, f, indent=2, default=str)
@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+from shapely.geometry import MultiPolygon, Point, Polygon, box, mapping
+
+
+def _blob(center, radius, rng, n_vertices=12, roughness=0.4):
+    # Star-shaped polygon around a center, valid by construction (sorted angles)
+    angles = np.sort(rng.uniform(0, 2 * np.pi, n_vertices))
+    radii = radius * (1 + roughness * (rng.rand(n_vertices) - .5))
+    # Shrink longitudes so that shapes are roughly isotropic on the ground
+    lon_factor = 1 / max(np.cos(np.radians(center[1])), 0.1)
+    xs = center[0] + radii * np.cos(angles) * lon_factor
+    ys = center[1] + radii * np.sin(angles)
+    return Polygon(zip(xs, ys)).buffer(0)
+
+
+def make_country_polygon(seed=0, radius=5., center=(10., 45.), n_vertices=256, n_islands=0):
+    """
+    Country-like shape: a rough main land of the specified radius (in degrees) with optional islands around it.
+    Always returned as a MultiPolygon, as loaded from "USDOS/LSIB_SIMPLE/2017"
+    """
+    rng = np.random.RandomState(seed)
+    parts = [_blob(center, radius, rng, n_vertices=n_vertices, roughness=0.3)]
+
+    for _ in range(n_islands):
+        angle = rng.uniform(0, 2 * np.pi)
+        distance = radius * rng.uniform(1.3, 3)
+        island_center = (center[0] + distance * np.cos(angle), center[1] + distance * np.sin(angle))
+        parts.append(_blob(island_center, radius * rng.uniform(0.01, 0.1), rng, n_vertices=32))
+
+    polygons = []
+    for p in parts:
+        polygons.extend(p if isinstance(p, MultiPolygon) else [p])
+    return MultiPolygon(polygons)
+
+
+def make_city_shapes(n, bounds=(5., 40., 15., 50.), seed=0, min_radius=2 * 1e-3, zipf_exponent=1.):
+    """
+    Field of n city shapes inside bounds, with radius following a Pareto distribution (cities size distribution)
+    """
+    rng = np.random.RandomState(seed)
+    west, south, east, north = bounds
+    centers = np.column_stack([rng.uniform(west, east, n), rng.uniform(south, north, n)])
+    # Areas follow a power law with exponent zipf_exponent --> radius ~ sqrt(area)
+    radii = min_radius * np.sqrt(rng.pareto(zipf_exponent, n) + 1)
+    radii = np.minimum(radii, min(east - west, north - south) / 20)
+
+    return [_blob(tuple(c), r, rng) for c, r in zip(centers, radii)]
+
+
+def make_split_features(city_shapes, n_splits=4, seed=0):
+    """
+    Emulate the GeoJSON features exported by urban_mapper: the field is cut into vertical stripes (the aois splits)
+    and every shape crossing a seam is exported as several features
+    """
+    rng = np.random.RandomState(seed)
+    west = min(t.bounds[0] for t in city_shapes)
+    south = min(t.bounds[1] for t in city_shapes)
+    east = max(t.bounds[2] for t in city_shapes)
+    north = max(t.bounds[3] for t in city_shapes)
+    edges = np.linspace(west, east, n_splits + 1)
+    stripes = [box(x0, south, x1, north) for x0, x1 in zip(edges[:-1], edges[1:])]
+
+    features = []
+    for split_id, stripe in enumerate(stripes):
+        for geom in city_shapes:
+            if not geom.intersects(stripe):
+                continue
+            part = geom.intersection(stripe)
+            if part.is_empty or part.area == 0:
+                continue
+            features.append({'type': 'Feature',
+                             'geometry': mapping(part),
+                             'properties': {'city': 1,
+                                            'mean': float(rng.uniform(0.9, 1)),
+                                            'id': f'{split_id}_{len(features)}'}})
+    return features
+
+
+def make_osm_nodes(m, bounds=(5., 40., 15., 50.), seed=0):
+    """
+    Set of m OSM place nodes with the same columns as the output of osm_utils.get_tagged_nodes
+    """
+    rng = np.random.RandomState(seed)
+    west, south, east, north = bounds
+    xs = rng.uniform(west, east, m)
+    ys = rng.uniform(south, north, m)
+    names = [f'city_{i}' for i in range(m)]
+    has_wiki = rng.rand(m) < 0.3
+
+    return pd.DataFrame({'node_id': np.arange(m) + 1,
+                         'name': names,
+                         'name_en': [n if rng.rand() < 0.5 else None for n in names],
+                         'alt_name': None,
+                         'place': np.where(rng.rand(m) < 0.8, 'town', 'city'),
+                         'geometry': [Point(x, y) for x, y in zip(xs, ys)],
+                         'wikipedia': [f'en:{n}' if w else None for n, w in zip(names, has_wiki)],
+                         'pageviews': np.where(has_wiki, rng.pareto(1., m) * 1e3, 0).astype(int)})
+
+
+def make_city_records(n, seed=0):
+    """
+    Minimal records (as produced by reverse_geo_utils.form_new_city_record) to rank
+    """
+    rng = np.random.RandomState(seed)
+    areas = np.round(rng.pareto(1., n) + 1, 3)
+    return [{'id': f'0_XXX_2019_{i}', 'name': f'city_{i}', 'area': a} for i, a in enumerate(areas)]
@@ -1,17 +1,32 @@
 import os
+import threading
 from pathlib import Path
 
-import ee
 from dotenv import load_dotenv
 
 # Load dotenv
 env_path = Path('..') / '.env'
 load_dotenv(dotenv_path=env_path, override=True)
 
-# Init. earth-engine
-credentials = ee.ServiceAccountCredentials(os.getenv("SERVICE_ACCOUNT"),
-                                           os.getenv("PATH_TO_CREDS"))
-ee.Initialize(credentials)
+_EE_LOCK = threading.Lock()
+_EE_INITIALIZED = False
+
+
+def init_ee():
+    """
+    Init. earth-engine on first use (importing cities_watch never touches it), unless running offline (e.g. benchmarks
+    with local stand-ins)
+    """
+    global _EE_INITIALIZED
+    with _EE_LOCK:
+        if _EE_INITIALIZED or os.getenv("CITIES_WATCH_OFFLINE"):
+            return
+        import ee
+
+        credentials = ee.ServiceAccountCredentials(os.getenv("SERVICE_ACCOUNT"),
+                                                   os.getenv("PATH_TO_CREDS"))
+        ee.Initialize(credentials)
+        _EE_INITIALIZED = True
 
 
 if __name__ == '__main__':
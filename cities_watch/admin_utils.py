@@ -0,0 +1,119 @@
+import json
+import multiprocessing
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from shapely.geometry import shape
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+from tqdm import tqdm
+
+from cities_watch import config
+from cities_watch.zipf_utils import load_results
+
+_ADMIN_INDEXES = {}
+
+
+def load_admin_regions(file_path, id_col, name_col=None, layer=None):
+    """
+    Admin polygons from a local file readable by fiona (GeoJSON, shapefile, GeoPackage ...), e.g. GADM level 1,
+    with columns region_id, region_name and geometry (EPSG:4326)
+    """
+    gdf = gpd.read_file(file_path, layer=layer) if layer else gpd.read_file(file_path)
+    if gdf.crs is not None and gdf.crs.to_epsg() != 4326:
+        gdf = gdf.to_crs(epsg=4326)
+    gdf = gdf[gdf['geometry'].notnull()]
+    return gpd.GeoDataFrame({'region_id': gdf[id_col].astype(str).values,
+                             'region_name': gdf[name_col].values if name_col else gdf[id_col].astype(str).values,
+                             'geometry': gdf['geometry'].buffer(0).values})
+
+
+def build_admin_index(gdf_regions):
+    """
+    STRtree over the admin polygons with their prepared geometries, to be reused for all the city shapes
+    """
+    geoms = list(gdf_regions['geometry'])
+    return {'tree': STRtree(geoms),
+            'prepared': [prep(g) for g in geoms],
+            'index_by_id': {id(g): i for i, g in enumerate(geoms)},
+            'region_id': list(gdf_regions['region_id']),
+            'region_name': list(gdf_regions['region_name'])}
+
+
+def get_admin_index(file_path, id_col, name_col=None, layer=None):
+    # Admin files are indexed once per process
+    key = (file_path, id_col, name_col, layer)
+    if key not in _ADMIN_INDEXES:
+        _ADMIN_INDEXES[key] = build_admin_index(load_admin_regions(file_path, id_col, name_col=name_col, layer=layer))
+    return _ADMIN_INDEXES[key]
+
+
+def assign_regions(geometries, admin_index, min_fraction=1e-3):
+    """
+    Fraction of each geometry in each admin region it intersects. Shapes contained in a region (most of them)
+    are resolved with the prepared geometry only, the intersection is computed for shapes crossing borders.
+
+    :return: list of (index of the geometry, index of the region, fraction of the geometry area)
+    """
+    out = []
+    for i, geom in enumerate(geometries):
+        if geom.is_empty or geom.area == 0:
+            continue
+        for region in admin_index['tree'].query(geom):
+            r = admin_index['index_by_id'][id(region)]
+            prepared = admin_index['prepared'][r]
+            if prepared.contains(geom):
+                out.append((i, r, 1.))
+            elif prepared.intersects(geom):
+                fraction = region.intersection(geom).area / geom.area
+                if fraction >= min_fraction:
+                    out.append((i, r, fraction))
+    return out
+
+
+def _assign_batch(df_batch, admin_file, id_col, name_col, layer, min_fraction):
+    admin_index = get_admin_index(admin_file, id_col, name_col=name_col, layer=layer)
+    geometries = [shape(json.loads(t)) for t in df_batch['geometry']]
+    links = assign_regions(geometries, admin_index, min_fraction=min_fraction)
+    if len(links) == 0:
+        return pd.DataFrame()
+
+    idx, regions, fractions = (np.array(t) for t in zip(*links))
+    df = df_batch.drop(columns=['geometry']).iloc[idx].reset_index(drop=True)
+    df['region_id'] = [admin_index['region_id'][r] for r in regions]
+    df['region_name'] = [admin_index['region_name'][r] for r in regions]
+    df['fraction'] = fractions.round(4)
+    df['area'] = (df['area'] * fractions).round(3)
+    return df
+
+
+def region_rank_tables(df_regions, group_cols=('region_id', 'year')):
+    """
+    Rank of the (apportioned) city areas within each region and year
+    """
+    df_regions = df_regions.sort_values(list(group_cols) + ['area'], ascending=[True] * len(group_cols) + [False])
+    df_regions['rank'] = df_regions.groupby(list(group_cols)).cumcount() + 1
+    return df_regions.reset_index(drop=True)
+
+
+def aggregate_by_region(admin_file, id_col, name_col=None, layer=None, folder=config.RESUlTS_FOLDER,
+                        min_fraction=1e-3, batch_size=5000, n_jobs=None):
+    """
+    Assign the city shapes of all countries and years in the results folder to admin regions, splitting the area
+    of the shapes crossing borders, and rank the cities of each region and year.
+    Shapes are processed in batches in a process pool, each worker indexes the admin file once.
+
+    :return: one row per (city, region) with the apportioned area, the fraction of the city in the region and
+    the rank in the region
+    """
+    df = load_results(folder, columns=('id', 'name', 'area', 'geometry'), n_jobs=n_jobs)
+    batches = [df.iloc[i:i + batch_size] for i in range(0, len(df), batch_size)]
+    n_jobs = n_jobs or multiprocessing.cpu_count()
+    dfs = Parallel(n_jobs=n_jobs)(delayed(_assign_batch)(t, admin_file, id_col, name_col, layer, min_fraction)
+                                  for t in tqdm(batches))
+    dfs = [t for t in dfs if len(t) > 0]
+    if len(dfs) == 0:
+        return pd.DataFrame()
+    return region_rank_tables(pd.concat(dfs, ignore_index=True))
@@ -7,11 +7,19 @@ from google.oauth2 import service_account
 from tqdm import tqdm
 
 from cities_watch import config
+from cities_watch.trace_utils import is_tracing, trace_count, trace_span
 
-# Load service account credentials for BigQuery
+# Service account credentials for BigQuery, loaded on first use
 scopes = ["https://www.googleapis.com/auth/cloud-platform"]
-credentials = service_account.Credentials.from_service_account_file(filename=os.getenv("PATH_TO_CREDS"),
-                                                                    scopes=scopes)
+credentials = None
+
+
+def get_client():
+    global credentials
+    if credentials is None:
+        credentials = service_account.Credentials.from_service_account_file(filename=os.getenv("PATH_TO_CREDS"),
+                                                                            scopes=scopes)
+    return bigquery.Client(credentials=credentials, project=credentials.project_id)
 
 
 def get_table_schema(schema=None, path_to_schema=None):
@@ -32,7 +40,7 @@ def get_table_schema(schema=None, path_to_schema=None):
 
 def load_table(table_id, client=None, path_to_schema=None, buffer_creation=10):
     if not client:
-        client = bigquery.Client(credentials=credentials, project=credentials.project_id)
+        client = get_client()
 
     try:
         table = client.get_table(table_id)
@@ -57,7 +65,7 @@ def load_table(table_id, client=None, path_to_schema=None, buffer_creation=10):
 def push_records_to_bq(bq_records, table_id, batch_size=1000, client=None, verbose=config.VERBOSE, path_to_schema=None):
     if not client:
         # Construct a BigQuery client object.
-        client = bigquery.Client(credentials=credentials, project=credentials.project_id)
+        client = get_client()
 
     # Check table exists or create one
     _ = load_table(table_id=table_id, client=client, path_to_schema=path_to_schema)
@@ -65,15 +73,25 @@ def push_records_to_bq(bq_records, table_id, batch_size=1000, client=None, verbo
     # Insert rows in table
     failed_to_push = []
     if len(bq_records) < batch_size:
-        errors = client.insert_rows_json(table_id, bq_records)
+        errors = _insert_rows(client, table_id, bq_records)
         if len(errors) != 0:
             print("Encountered errors while inserting rows: {}".format(errors))
             failed_to_push += bq_records
     else:
         for i in tqdm(range(0, len(bq_records), batch_size)):
             to_push = bq_records[i:i + batch_size]
-            errors = client.insert_rows_json(table_id, to_push)
+            errors = _insert_rows(client, table_id, to_push)
             if len(errors) != 0:
                 print("Encountered errors while inserting rows: {}".format(errors))
                 failed_to_push += to_push
     return failed_to_push
+
+
+def _insert_rows(client, table_id, rows):
+    trace_count('bq.insert_calls')
+    trace_count('bq.rows', len(rows))
+    if is_tracing():
+        # Only serialize twice when tracing
+        trace_count('bq.bytes_pushed', len(json.dumps(rows)))
+    with trace_span('bq.insert'):
+        return client.insert_rows_json(table_id, rows)
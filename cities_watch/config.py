@@ -11,6 +11,18 @@ FAILS_FOLDER = os.path.join(ROOT_DIR, 'data', 'fails')
 os.makedirs(FAILS_FOLDER, exist_ok=True)
 OSM_NODES_FOLDER = os.path.join(ROOT_DIR, 'data', 'osm_nodes')
 os.makedirs(OSM_NODES_FOLDER, exist_ok=True)
+BENCHMARKS_FOLDER = os.path.join(ROOT_DIR, 'data', 'benchmarks')
+os.makedirs(BENCHMARKS_FOLDER, exist_ok=True)
+CACHE_FOLDER = os.path.join(ROOT_DIR, 'data', 'cache')
+os.makedirs(CACHE_FOLDER, exist_ok=True)
+TILES_FOLDER = os.path.join(ROOT_DIR, 'data', 'tiles')
+os.makedirs(TILES_FOLDER, exist_ok=True)
+MIRROR_FOLDER = os.path.join(ROOT_DIR, 'data', 'bucket_mirror')
+os.makedirs(MIRROR_FOLDER, exist_ok=True)
+NORMALIZED_FOLDER = os.path.join(ROOT_DIR, 'data', 'normalized')
+os.makedirs(NORMALIZED_FOLDER, exist_ok=True)
+COUNTRIES_FOLDER = os.path.join(ROOT_DIR, 'data', 'countries')
+os.makedirs(COUNTRIES_FOLDER, exist_ok=True)
 """
 Path to root repository
 """
@@ -25,6 +37,12 @@ UPDATE = False
 Boolean to choose whether or not to update existing files on bucket
 """
 
+MULTI_YEAR = False
+"""
+Boolean to export the shapes of all the requested years of a split in a single task (with a year property),
+instead of one task per split and year
+"""
+
 BUFFER_COEFF = 0.1
 SIMPLIFY_COEFF = 0.1
 MAX_AREA = 50
@@ -111,6 +129,21 @@ FILENAME = 'predicted_shapes'
 Bucket where city vectors are stored (GeoJSON)
 """
 
+SHAPES_SOURCE = 'bucket'
+"""
+Where urban_tagger reads the city vectors: 'bucket' downloads the GeoJSON exports, 'fgb' reads the FlatGeobuf files
+ingested in MIRROR_FOLDER (see fgb_utils.ingest), optionally within a bbox only
+"""
+
+CACHE_STACKS = False
+STACKS_FOLDER = 'feature_stacks'
+STACK_BANDS = ['radiance', 'R', 'G', 'B', 'NDVI']
+"""
+Boolean to export the feature stack of each split and year once (cloud-optimized GeoTIFF in STACKS_FOLDER of the
+bucket) and read it in later runs instead of recompositing the raw collections, e.g. when iterating on the model
+STACK_BANDS is the band order of the stack fed to the model
+"""
+
 POP_THRESHOLD = 50
 """
 Threshold of max population count by grid to convert population density image to binary image of human-settlements 
@@ -119,11 +152,17 @@ https://developers.google.com/earth-engine/datasets/catalog/JRC_GHSL_P2016_POP_G
 """
 
 GRID_SIZE = 5 * 1e3
+TAG_METHOD = 'contain'
 """
 Split a city shape into a grid of elements with the specified size. Used for reverse-geocode all grid centroids.
+TAG_METHOD='grid' tags shapes with the OSM nodes nearest to their grid cells, weighted by the area they cover,
+'contain' with the nodes they contain (or the node nearest to their centroid).
+With 'grid', the major city of a shape is the node covering most of its area, and each city of a record gets a
+coverage field: add {"name": "coverage", "type": "FLOAT", "mode": "NULLABLE"} to the fields of the cities RECORD of
+the BigQuery table schema (SCHEMA_FOLDER/TABLE_NAME.json) before pushing grid records
 """
 
-REF_WIKI_URL = 'https://wikimedia.org/api/rest_v1/metrics/pageviews/per-article/{language}.wikipedia.org/all-access/all-agents/{name}/{granularity}/{start}/{end}'
+REF_WIKI_URL = os.getenv('REF_WIKI_URL', 'https://wikimedia.org/api/rest_v1/metrics/pageviews/per-article/{language}.wikipedia.org/all-access/all-agents/{name}/{granularity}/{start}/{end}')
 """
 Base url to query wikipedia pageviews
 """
@@ -131,8 +170,9 @@ Base url to query wikipedia pageviews
 OSM_TAGS = ['town', 'city']
 OSM_ADMIN_LEVELS = [6, 7, 8]
 OSM_TIMEOUT = 900
+OVERPASS_URL = os.getenv('OVERPASS_URL')
 """
-Parameters for the query of OpenStreetMap data
+Parameters for the query of OpenStreetMap data, OVERPASS_URL=None uses the default overpy endpoint
 """
 
 DATASET_NAME = os.getenv('DATASET_NAME')
@@ -140,3 +180,60 @@ TABLE_NAME = os.getenv('TABLE_NAME')
 """
 BigQuery data-set and table to store processed shapes
 """
+
+OUTPUT_MODE = 'records'
+"""
+How urban_tagger writes the tagged shapes: 'records' one record per shape with all its cities (RESUlTS_FOLDER and
+TABLE_NAME), 'normalized' a shapes table, a (shape_id, node_id, tag_method, distance) links table and the nodes of
+each country written once (NORMALIZED_FOLDER and TABLE_NAME_shapes/_links/_nodes), see normalize_utils
+"""
+
+BENCHMARK_TOLERANCE = 0.2
+"""
+Relative slow-down (time or peak memory) tolerated v.s the stored benchmark baseline before flagging a regression
+"""
+
+TRACE = os.getenv('CITIES_WATCH_TRACE', '0') == '1'
+"""
+Boolean to record timings, remote calls counters and peak memory of a run (written next to the run summaries)
+"""
+
+BLOCK_SIZE = 1024
+"""
+Size in pixels of the square blocks read at once by the local raster engines, bounding their memory use
+"""
+
+LOCAL_BATCH_SIZE = 64
+"""
+Number of INPUT_TILE_SIZE tiles per prediction batch when running the model locally
+"""
+
+TILE_MIN_ZOOM = 0
+TILE_MAX_ZOOM = 12
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+"""
+Zoom levels of the vector tiles of the city shapes, extent and buffer of the tiles in tile units
+"""
+
+PLAN_SECONDS_PER_MPIXEL = 300.
+PLAN_SUBMIT_SECONDS = 2.
+PLAN_BYTES_PER_MPIXEL = 5e5
+PLAN_CONCURRENT_TASKS = 4
+"""
+Defaults of the mapping planner (see plan_utils) when past runs cannot calibrate them: run time of an export task
+and size of the exported shapes per million pixels (at SCALE) and year, time to build and submit a task, and
+earth-engine tasks running at once
+"""
+
+TAGGER_FETCH_WORKERS = 4
+TAGGER_TAG_WORKERS = None
+TAGGER_SINK_WORKERS = 2
+TAGGER_QUEUE_SIZE = 4
+TAGGER_MEMORY_MB = 2048
+"""
+Pipelined tagging: threads downloading the shapes, processes merging and tagging them (None for one per core), threads
+writing and pushing the records, with queues of TAGGER_QUEUE_SIZE country-years between the stages.
+TAGGER_MEMORY_MB caps the shapes (listed file sizes) and the nodes (local copy size, once per tag worker) held in the
+pipeline, parsed features take a few times their size
+"""
@@ -0,0 +1,164 @@
+import glob
+import multiprocessing
+import os
+from collections import namedtuple
+
+import fiona
+from joblib import Parallel, delayed
+from shapely.geometry import box, mapping, shape
+from tqdm import tqdm
+
+from cities_watch import config
+from cities_watch.gcloud_utils import list_objects_from_bucket
+from cities_watch.trace_utils import trace_count, trace_span
+
+FGB_DRIVER = 'FlatGeobuf'
+
+MirroredFile = namedtuple('MirroredFile', ['key', 'path'])
+"""
+File of the local mirror, with the key of the bucket object it was converted from
+"""
+
+
+def check_driver():
+    # FlatGeobuf requires GDAL >= 3.1 in the fiona build
+    if FGB_DRIVER not in fiona.supported_drivers:
+        raise RuntimeError(f'{FGB_DRIVER} is not supported by fiona {fiona.__version__} '
+                           f'(GDAL {fiona.__gdal_version__}), GDAL >= 3.1 is required')
+
+
+def get_fgb_path(geojson_path):
+    return os.path.splitext(geojson_path)[0] + '.fgb'
+
+
+def mirror_objects(prefix=config.FOLDER, mirror_folder=config.MIRROR_FOLDER, s3=None):
+    """
+    Download the GeoJSON exports under prefix to mirror_folder (same keys), objects already mirrored with the same
+    size are skipped.
+
+    :return: local paths of the mirrored files
+    """
+    paths = []
+    for obj in list_objects_from_bucket(prefix=prefix, s3=s3):
+        if config.FILENAME not in obj.key or not obj.key.endswith('.geojson'):
+            continue
+        path = os.path.join(mirror_folder, obj.key)
+        paths.append(path)
+        if os.path.exists(path) and os.path.getsize(path) == obj.size:
+            continue
+        with trace_span('bucket.download'):
+            content = obj.get()['Body'].read()
+        trace_count('bucket.get_calls')
+        trace_count('bucket.bytes_downloaded', len(content))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(content)
+        os.replace(path + '.tmp', path)
+        if getattr(obj, 'last_modified', None) is not None:
+            # Keep the export date, used to pick the most recent export of a year (urban_tagger.select_year_files)
+            os.utime(path, (obj.last_modified.timestamp(), obj.last_modified.timestamp()))
+    return paths
+
+
+def geojson_to_fgb(geojson_path, fgb_path=None, force=False):
+    """
+    Convert an earth-engine GeoJSON export to a FlatGeobuf with a packed R-tree (written once, skipped when newer
+    than the GeoJSON). Polygons are stored as MultiPolygons so that the file has a single geometry type.
+    """
+    fgb_path = fgb_path or get_fgb_path(geojson_path)
+    if not force and os.path.exists(fgb_path) and os.path.getmtime(fgb_path) >= os.path.getmtime(geojson_path):
+        return fgb_path
+
+    with fiona.open(geojson_path) as src:
+        schema = {'geometry': 'MultiPolygon', 'properties': dict(src.schema['properties'])}
+        # Hidden while written (GDAL needs the .fgb extension to write a single file)
+        tmp_path = os.path.join(os.path.dirname(fgb_path), '.' + os.path.basename(fgb_path))
+        with fiona.open(tmp_path, 'w', driver=FGB_DRIVER, schema=schema, crs=src.crs, SPATIAL_INDEX='YES') as dst:
+            for feature in src:
+                geom = shape(feature['geometry'])
+                if geom.geom_type == 'Polygon':
+                    coordinates = [mapping(geom)['coordinates']]
+                elif geom.geom_type == 'MultiPolygon':
+                    coordinates = mapping(geom)['coordinates']
+                else:
+                    continue
+                dst.write({'geometry': {'type': 'MultiPolygon', 'coordinates': coordinates},
+                           'properties': dict(feature['properties'])})
+    os.replace(tmp_path, fgb_path)
+    # Same date as the export it was converted from
+    os.utime(fgb_path, (os.path.getmtime(geojson_path), os.path.getmtime(geojson_path)))
+    return fgb_path
+
+
+def ingest(prefix=config.FOLDER, mirror_folder=config.MIRROR_FOLDER, s3=None, download=True, force=False,
+           n_jobs=None, verbose=config.VERBOSE):
+    """
+    Convert the GeoJSON exports under prefix to indexed FlatGeobuf files next to them in mirror_folder, after
+    mirroring them from the bucket unless download=False (GeoJSON files already in mirror_folder).
+    Files are converted in parallel, and only once.
+
+    :return: paths of the FlatGeobuf files
+    """
+    check_driver()
+    if download:
+        paths = mirror_objects(prefix=prefix, mirror_folder=mirror_folder, s3=s3)
+    else:
+        paths = glob.glob(os.path.join(mirror_folder, prefix, '**', f'{config.FILENAME}*.geojson'), recursive=True)
+    n_jobs = n_jobs or multiprocessing.cpu_count()
+    return Parallel(n_jobs=n_jobs)(delayed(geojson_to_fgb)(t, force=force)
+                                   for t in tqdm(sorted(paths), disable=not verbose))
+
+
+def list_mirrored_files(prefix, mirror_folder=config.MIRROR_FOLDER):
+    # Ingested files under a bucket prefix, with the key of their GeoJSON export
+    paths = glob.glob(os.path.join(mirror_folder, prefix, '**', f'{config.FILENAME}*.fgb'), recursive=True)
+    return [MirroredFile(key=os.path.relpath(t, mirror_folder).replace(os.sep, '/')[:-len('.fgb')] + '.geojson',
+                         path=t) for t in sorted(paths)]
+
+
+def read_features(fgb_path, bbox=None):
+    """
+    GeoJSON-like features of a FlatGeobuf file, only those intersecting bbox (west, south, east, north) when set:
+    the packed R-tree is searched and only the matching features are read
+    """
+    with fiona.open(fgb_path) as src:
+        features = src.filter(bbox=tuple(bbox)) if bbox is not None else iter(src)
+        for feature in features:
+            yield {'type': 'Feature', 'id': feature['id'], 'properties': dict(feature['properties']),
+                   'geometry': mapping(shape(feature['geometry']))}
+
+
+def split_seams(fgb_paths, buffer=5 * 1e-3):
+    """
+    Seams between the splits of a country: intersections of the extents (header bounds, buffered) of every pair of
+    split files. Shapes cut by a split boundary can only be found there.
+
+    :return: dict of the seams (list of bboxes) of each file
+    """
+    extents = {}
+    for t in fgb_paths:
+        with fiona.open(t) as src:
+            if len(src) > 0:
+                extents[t] = box(*src.bounds).buffer(buffer, join_style=2)
+    seams = {t: [] for t in fgb_paths}
+    paths = list(extents)
+    for i, a in enumerate(paths):
+        for b in paths[i + 1:]:
+            overlap = extents[a].intersection(extents[b])
+            if not overlap.is_empty:
+                seams[a].append(overlap.bounds)
+                seams[b].append(overlap.bounds)
+    return seams
+
+
+def read_seam_features(fgb_paths, buffer=5 * 1e-3):
+    """
+    Features of the split files lying in a seam between splits (see split_seams), each read once
+    """
+    for t, bboxes in split_seams(fgb_paths, buffer=buffer).items():
+        seen = set()
+        for bbox in bboxes:
+            for feature in read_features(t, bbox=bbox):
+                if feature['id'] not in seen:
+                    seen.add(feature['id'])
+                    yield feature
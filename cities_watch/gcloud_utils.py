@@ -1,9 +1,11 @@
+import re
 import time
 
 import ee
 from boto3.session import Session
 
-from cities_watch import config
+from cities_watch import config, init_ee
+from cities_watch.trace_utils import trace_count, trace_span
 
 
 def list_objects_from_bucket(prefix=None, bucket_name=config.BUCKET_NAME, s3=None):
@@ -17,14 +19,27 @@ def list_objects_from_bucket(prefix=None, bucket_name=config.BUCKET_NAME, s3=Non
 
     bucket = s3.Bucket(bucket_name)
 
-    if prefix:
-        return list(bucket.objects.filter(Prefix=prefix))
-    else:
-        return list(bucket.objects.all())
+    trace_count('bucket.list_calls')
+    with trace_span('bucket.list'):
+        if prefix:
+            return list(bucket.objects.filter(Prefix=prefix))
+        else:
+            return list(bucket.objects.all())
+
+
+def list_exported_objects(file_name, extension, s3=None, tiled=False):
+    """
+    Objects exported with fileNamePrefix=file_name: exact key, the prefix alone also matches the exports of other
+    splits (e.g. predicted_shapes_1 and predicted_shapes_10).
+    With tiled, images exported as several files (<file_name>-<row offset>-<col offset>.tif) are matched too.
+    """
+    pattern = re.escape(file_name) + (r'(-\d{10}-\d{10})?' if tiled else '') + re.escape(f'.{extension}')
+    return [t for t in list_objects_from_bucket(file_name, s3=s3) if re.fullmatch(pattern, t.key)]
 
 
 def export_shapes_to_bucket(city_vectors, description, file_name, wait_finish=True, refresh=10):
     # Export shapes to bucket
+    init_ee()
     task = ee.batch.Export.table.toCloudStorage(
         collection=city_vectors,
         description=description,
@@ -32,17 +47,52 @@ def export_shapes_to_bucket(city_vectors, description, file_name, wait_finish=Tr
         fileNamePrefix=file_name,
         fileFormat='GeoJSON'
     )
-    task.start()
+    with trace_span('ee.export_submit'):
+        task.start()
+    trace_count('ee.export_tasks')
     print(f'Exporting shapes {description} to bucket={config.BUCKET_NAME} - task_id={task.id}')
 
     if wait_finish:
-        while task.active():
-            time.sleep(refresh)
+        wait_task(task, refresh=refresh)
 
-        # Error condition
-        if task.status()['state'] != 'COMPLETED':
-            print('Error with image export.')
-        else:
-            print('Collection export completed.')
+    return task
+
+
+def export_image_to_bucket(image, description, file_name, region, scale=config.SCALE, wait_finish=True, refresh=10):
+    # Export image to bucket as cloud-optimized GeoTIFF (readable with ee.Image.loadGeoTIFF). Splits smaller than
+    # MAX_AREA fit in a single file of fileDimensions at SCALE, bigger images are written as tiles (see
+    # list_exported_objects)
+    init_ee()
+    task = ee.batch.Export.image.toCloudStorage(
+        image=image,
+        description=description,
+        bucket=config.BUCKET_NAME,
+        fileNamePrefix=file_name,
+        region=region,
+        scale=scale,
+        crs='EPSG:4326',
+        maxPixels=1e13,
+        fileDimensions=32768,
+        fileFormat='GeoTIFF',
+        formatOptions={'cloudOptimized': True}
+    )
+    with trace_span('ee.export_submit'):
+        task.start()
+    trace_count('ee.export_tasks')
+    print(f'Exporting image {description} to bucket={config.BUCKET_NAME} - task_id={task.id}')
+
+    if wait_finish:
+        wait_task(task, refresh=refresh)
 
     return task
+
+
+def wait_task(task, refresh=10):
+    while task.active():
+        time.sleep(refresh)
+
+    # Error condition
+    if task.status()['state'] != 'COMPLETED':
+        print('Error with image export.')
+    else:
+        print('Collection export completed.')
@@ -1,11 +1,15 @@
+import json
 import math
+import os
 
 import numpy as np
 import pandas as pd
 from shapely.geometry import box, Polygon, MultiPolygon, GeometryCollection, mapping, shape
+from shapely.ops import unary_union
 from sklearn.cluster import DBSCAN
 
 from cities_watch import config
+from cities_watch.trace_utils import trace_count, trace_span
 
 
 def get_clusters_from_geom(f_geom, min_sample_poly=config.MIN_SAMPLE_POLYGONS,
@@ -69,13 +73,32 @@ def area_split(geom, max_area, max_count=250, count=0, return_singles=False):
         return result
 
 
-def split_feature(feature, extra_props=None, max_area=config.MAX_AREA,
-                  return_singles=config.RETURN_SINGLES):
-    f_shape = feature.geometry().getInfo()
+def get_country_geometry_path(country, folder=config.COUNTRIES_FOLDER):
+    return os.path.join(folder, country.replace('/', '_').replace(' ', '_') + '.geojson')
+
+
+def read_country_geometry(country, folder=config.COUNTRIES_FOLDER):
+    # Geometry of the country from the local cache, None when not cached
+    path = get_country_geometry_path(country, folder=folder)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return shape(json.load(f))
+
+
+def write_country_geometry(country, geom, folder=config.COUNTRIES_FOLDER):
+    path = get_country_geometry_path(country, folder=folder)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(mapping(geom), f)
+    os.replace(path + '.tmp', path)
 
-    # Fix potential bad shapes with buffer 0
-    f_geom = shape(f_shape).buffer(0)
 
+def split_geometry(f_geom, extra_props=None, max_area=config.MAX_AREA, return_singles=config.RETURN_SINGLES):
+    """
+    Split a country geometry into clusters of polygons, themselves split to be smaller than max_area (degrees2)
+
+    :return: list of GeoJSON-like geometries with a split_id (and extra_props) in their properties
+    """
     # Form clusters
     list_geoms = get_clusters_from_geom(f_geom)
 
@@ -93,3 +116,29 @@ def split_feature(feature, extra_props=None, max_area=config.MAX_AREA,
         out_list.append(geo_s)
 
     return out_list
+
+
+def split_feature(feature, extra_props=None, max_area=config.MAX_AREA,
+                  return_singles=config.RETURN_SINGLES, cache_as=None):
+    """
+    split_geometry of an earth-engine feature. With cache_as (country name), the geometry is read from the local
+    cache of country geometries when available, and cached otherwise.
+    """
+    f_geom = read_country_geometry(cache_as, folder=config.COUNTRIES_FOLDER) if cache_as else None
+    if f_geom is None:
+        trace_count('ee.getInfo_calls')
+        with trace_span('ee.getInfo'):
+            f_shape = feature.geometry().getInfo()
+
+        # Fix potential bad shapes with buffer 0
+        f_geom = shape(f_shape).buffer(0)
+        if cache_as:
+            write_country_geometry(cache_as, f_geom, folder=config.COUNTRIES_FOLDER)
+
+    return split_geometry(f_geom, extra_props=extra_props, max_area=max_area, return_singles=return_singles)
+
+
+def merge_split_shapes(all_shapes, buffer_coeff=5 * 1e-3):
+    # process shapes to correct split features and holes
+    all_geoms = [shape(t['geometry']).buffer(buffer_coeff).buffer(-buffer_coeff) for t in all_shapes]
+    return unary_union(all_geoms)
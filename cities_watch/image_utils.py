@@ -4,6 +4,7 @@ import ee
 import numpy as np
 
 from cities_watch import config
+from cities_watch.raster_utils import stack_key
 
 
 def mask2clouds(img):
@@ -90,7 +91,7 @@ def get_scaling_image_ols_dnb(common_range=config.COMMON_RANGE_NTL,
     return scaling_image
 
 
-def load_dmsp_ols_collection(start_date, end_date, geometry=None, apply_scaling=True, use_image=True):
+def load_dmsp_ols_collection(start_date, end_date, geometry=None, apply_scaling=True, use_image=True, scaling_img=None):
 
     # Load DMSP-OLS imagery
     dmsp_ols_collection = ee.ImageCollection('NOAA/DMSP-OLS/NIGHTTIME_LIGHTS') \
@@ -102,7 +103,8 @@ def load_dmsp_ols_collection(start_date, end_date, geometry=None, apply_scaling=
 
     if apply_scaling:
         # apply scaling to each image
-        scaling_img = get_scaling_image_ols_dnb(use_image=use_image)
+        if scaling_img is None:
+            scaling_img = get_scaling_image_ols_dnb(use_image=use_image)
         dmsp_ols_collection = dmsp_ols_collection.map(lambda x: x.multiply(scaling_img))
 
     return dmsp_ols_collection
@@ -120,13 +122,14 @@ def load_bnd_viirs_collection(start_date, end_date, geometry=None):
     return viirs_dnb_collection
 
 
-def load_nl_image(start_date, end_date, geometry=None, apply_scaling=True, use_image=True):
+def load_nl_image(start_date, end_date, geometry=None, apply_scaling=True, use_image=True, scaling_img=None):
 
     # Load DMSP-OLS imagery
     dmsp_ols_collection = load_dmsp_ols_collection(start_date, end_date,
                                                    geometry=geometry,
                                                    apply_scaling=apply_scaling,
-                                                   use_image=use_image)
+                                                   use_image=use_image,
+                                                   scaling_img=scaling_img)
 
     viirs_dnb_collection = load_bnd_viirs_collection(start_date, end_date,
                                                      geometry=geometry)
@@ -160,7 +163,7 @@ def check_aoi_coverage(geometry, ref_collection, start_date=None, end_date=None,
     return corrected_geometry
 
 
-def load_feature_stack(start_date, end_date, geometry=None, check_geometry=False):
+def load_feature_stack(start_date, end_date, geometry=None, check_geometry=False, scaling_img=None):
 
     if geometry and check_geometry:
         # Make sure the geometry is contained inside the images footprint
@@ -169,7 +172,7 @@ def load_feature_stack(start_date, end_date, geometry=None, check_geometry=False
 
     optical_image = load_ms_image(start_date, end_date, geometry=geometry)
 
-    radiance_image = load_nl_image(start_date, end_date, geometry=geometry)
+    radiance_image = load_nl_image(start_date, end_date, geometry=geometry, scaling_img=scaling_img)
 
     # form feature stack for inference
     feature_stack = ee.Image.cat([
@@ -183,6 +186,28 @@ def load_feature_stack(start_date, end_date, geometry=None, check_geometry=False
     return feature_stack
 
 
+def get_stack_file_name(aoi_props, ref_year, key=None):
+    """
+
+    :param aoi_props:
+    :param ref_year:
+    :param key: hash of the compositing parameters, defaults to raster_utils.stack_key()
+    :return: File name (e.g: STACKS_FOLDER/<key>/85_FRA/2015/feature_stack_1)
+    """
+    key = key or stack_key()
+    ff_prefix = f"{aoi_props['country_code_gaul']}_{aoi_props['iso3c']}"
+    return f"{config.STACKS_FOLDER}/{key}/{ff_prefix}/{ref_year}/feature_stack_{aoi_props['split_id']}"
+
+
+def load_cached_feature_stack(file_names, bucket_name=config.BUCKET_NAME):
+    # Cloud-optimized GeoTIFF written by gcloud_utils.export_image_to_bucket, or its tiles (list of file names)
+    if isinstance(file_names, str):
+        file_names = [file_names]
+    images = [ee.Image.loadGeoTIFF(f"gs://{bucket_name}/{t}.tif") for t in file_names]
+    image = images[0] if len(images) == 1 else ee.ImageCollection(images).mosaic()
+    return image.rename(config.STACK_BANDS).float()
+
+
 def load_population_count(start_date, end_date, ref_collection='JRC/GHSL/P2016/POP_GPW_GLOBE_V1',
                           threshold=config.POP_THRESHOLD, geometry=None):
     def _get_closest_year(ref_date):
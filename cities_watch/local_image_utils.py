@@ -0,0 +1,335 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from tqdm import tqdm
+
+from cities_watch import config
+from cities_watch.raster_utils import (band_index, bounds_to_window, create_raster, iter_windows, raster_profile,
+                                       read_window, stack_key)
+
+
+def load_scene_index(file_path):
+    """
+    Index of the scenes available on disk, as a csv with columns:
+    - path: raster of the scene, with the original band names (e.g. B1, ..., pixel_qa), see raster_utils
+    - collection: key of config.MS_BANDS_CORRESPONDENCE (e.g. LANDSAT/LC08/C01)
+    - date: acquisition date (YYYY-MM-DD)
+    - CLOUD_COVER: cloud cover of the scene, from its metadata
+    All scenes must be on the same grid (same shape and transform).
+    """
+    return pd.read_csv(file_path).to_dict('records')
+
+
+def filter_scenes(scenes, start_date, end_date, max_cloud_cover=config.MAX_CLOUD_COVER):
+    # Same filters as image_utils.load_ms_image: filterDate (end date excluded) and CLOUD_COVER
+    return [s for s in scenes
+            if (s['collection'] in config.MS_BANDS_CORRESPONDENCE)
+            and (start_date <= str(s['date'])[:10] < end_date)
+            and (s['CLOUD_COVER'] < max_cloud_cover)]
+
+
+def check_same_grid(profiles):
+    ref = profiles[0]
+    for p in profiles[1:]:
+        if (p['height'], p['width']) != (ref['height'], ref['width']) or \
+                not np.allclose(p['transform'], ref['transform']):
+            raise ValueError('All rasters must be on the same grid (same shape and transform)')
+    return ref
+
+
+def cloud_mask(qa):
+    """
+    Local version of image_utils.mask2clouds, from the pixel_qa band: True for cloudy pixels
+    """
+    qa = qa.astype(np.int64)
+    return (((qa & (1 << 5)) != 0) & ((qa & (1 << 7)) != 0)) | ((qa & (1 << 3)) != 0)
+
+
+def nan_median(stack):
+    with warnings.catch_warnings():
+        # All-nan pixels (no clear observation) are expected and stay nan
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        return np.nanmedian(stack, axis=0)
+
+
+def _scene_valid_mask(scene, profile, window):
+    raw_bands = list(config.MS_BANDS_CORRESPONDENCE[scene['collection']].keys())
+    data = read_window(scene['path'], window, bands=[band_index(profile, b) for b in raw_bands + ['pixel_qa']])
+    # Masked (nodata) pixels in any band are masked in all bands, as img.mask().reduce(ee.Reducer.min())
+    valid = np.isfinite(data).all(axis=0)
+    valid[valid] = ~cloud_mask(data[-1][valid])
+    return valid
+
+
+def _composite_block(scenes, profiles, window, out_path, out_bands):
+    row_off, col_off, height, width = window
+    valid = [_scene_valid_mask(s, p, window) for s, p in zip(scenes, profiles)]
+
+    medians = {}
+    for band in out_bands + [t for t in config.NDVI_bands if t not in out_bands]:
+        stack = np.full((len(scenes), height, width), np.nan, dtype=np.float32)
+        for k, (scene, profile) in enumerate(zip(scenes, profiles)):
+            raw_band = {v: u for u, v in config.MS_BANDS_CORRESPONDENCE[scene['collection']].items()}[band]
+            data = read_window(scene['path'], window, bands=band_index(profile, raw_band))[0]
+            stack[k][valid[k]] = data[valid[k]]
+        # Median composite, then scaling of the surface reflectance values
+        medians[band] = nan_median(stack) * 0.0001
+
+    nir, red = (medians[t] for t in config.NDVI_bands)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ndvi = (nir - red) / (nir + red)
+
+    out = np.load(out_path, mmap_mode='r+')
+    out[:, row_off:row_off + height, col_off:col_off + width] = np.stack([medians[t] for t in out_bands] + [ndvi])
+    out.flush()
+    return window
+
+
+def composite_ms_image(scenes, start_date, end_date, out_path, selected_bands=True,
+                       max_cloud_cover=config.MAX_CLOUD_COVER, block_size=config.BLOCK_SIZE, n_jobs=None,
+                       verbose=config.VERBOSE):
+    """
+    Local version of image_utils.load_ms_image over Landsat scenes on disk (see load_scene_index):
+    same band renaming, CLOUD_COVER filter, pixel_qa cloud mask, median composite, scaling and NDVI band.
+    The median is computed block by block over memory-mapped scenes in a process pool, the memory used by a worker
+    is about n_scenes x block_size^2 x 5 bytes.
+
+    :return: path of the .npy composite, with bands R, G, B, NDVI (or all bands + NDVI if not selected_bands)
+    """
+    scenes = filter_scenes(scenes, start_date, end_date, max_cloud_cover=max_cloud_cover)
+    if len(scenes) == 0:
+        raise ValueError(f'No scene available between {start_date} and {end_date}')
+
+    profiles = [raster_profile(s['path']) for s in scenes]
+    ref = check_same_grid(profiles)
+
+    if selected_bands:
+        out_bands = list(config.RGB_bands)
+        band_names = ['R', 'G', 'B', 'NDVI']
+    else:
+        out_bands = list(next(iter(config.MS_BANDS_CORRESPONDENCE.values())).values())
+        band_names = out_bands + ['NDVI']
+
+    create_raster(out_path, len(band_names), ref['height'], ref['width'], ref['transform'], bands=band_names,
+                  crs=ref.get('crs', 'EPSG:4326'))
+
+    windows = list(iter_windows(ref['height'], ref['width'], block_size=block_size))
+    if verbose:
+        print(f'Compositing {len(scenes)} scene(s) in {len(windows)} block(s) ...')
+
+    n_jobs = n_jobs or multiprocessing.cpu_count()
+    Parallel(n_jobs=n_jobs)(delayed(_composite_block)(scenes, profiles, w, out_path, out_bands)
+                            for w in tqdm(windows))
+
+    return out_path
+
+
+NL_BANDS_CORRESPONDENCE = {'NOAA/DMSP-OLS/NIGHTTIME_LIGHTS': 'stable_lights',
+                           'NOAA/VIIRS/DNB/MONTHLY_V1/VCMCFG': 'avg_rad'}
+DMSP_OLS, VIIRS_DNB = NL_BANDS_CORRESPONDENCE.keys()
+# Part of the key of the cached scaling images, bumped when their computation changes
+SCALING_VERSION = 2
+
+
+def filter_nl_images(images, start_date, end_date, collection=None):
+    """
+    Night lights images on disk are described as dicts with path, collection (key of NL_BANDS_CORRESPONDENCE) and
+    date (YYYY-MM-DD), e.g. loaded with load_scene_index. Same date filter as ee filterDate (end date excluded).
+    """
+    return [t for t in images
+            if (t['collection'] == collection if collection else t['collection'] in NL_BANDS_CORRESPONDENCE)
+            and (start_date <= str(t['date'])[:10] < end_date)]
+
+
+def _read_radiance(image, profile, window):
+    band = band_index(profile, NL_BANDS_CORRESPONDENCE[image['collection']])
+    return read_window(image['path'], window, bands=band)[0]
+
+
+def _scaling_block(dmsp_images, viirs_images, profiles, window, out_path):
+    row_off, col_off, height, width = window
+    dmsp_ols = nan_median(np.stack([_read_radiance(t, profiles[t['path']], window) for t in dmsp_images]))
+    bnd_viirs = nan_median(np.stack([_read_radiance(t, profiles[t['path']], window) for t in viirs_images]))
+
+    # ee divide returns 0 where the divisor is 0: pixels without DMSP-OLS lights are scaled to 0, only nodata is nan
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scaling = np.where((dmsp_ols == 0) & np.isfinite(bnd_viirs), 0., bnd_viirs / dmsp_ols)
+
+    out = np.load(out_path, mmap_mode='r+')
+    out[0, row_off:row_off + height, col_off:col_off + width] = scaling
+    out.flush()
+    return window
+
+
+def get_scaling_image(images, common_range=config.COMMON_RANGE_NTL, cache_folder=config.CACHE_FOLDER,
+                      block_size=config.BLOCK_SIZE, n_jobs=None, verbose=config.VERBOSE):
+    """
+    Local version of image_utils.get_scaling_image_ols_dnb: per pixel ratio of the VIIRS and DMSP-OLS medians over
+    the range of dates in common. Computed once and cached as a memory-mapped .npy raster, keyed by the range
+    and the images used.
+
+    :return: path of the cached scaling raster
+    """
+    start, end = common_range
+    dmsp_images = filter_nl_images(images, start, end, collection=DMSP_OLS)
+    viirs_images = filter_nl_images(images, start, end, collection=VIIRS_DNB)
+    if len(dmsp_images) == 0 or len(viirs_images) == 0:
+        raise ValueError(f'Both DMSP-OLS and VIIRS images are required between {start} and {end}')
+
+    profiles = {t['path']: raster_profile(t['path']) for t in dmsp_images + viirs_images}
+    ref = check_same_grid(list(profiles.values()))
+
+    key = hashlib.md5(json.dumps([common_range, ref['transform'], ref['height'], ref['width'],
+                                  sorted(profiles), SCALING_VERSION]).encode()).hexdigest()[:12]
+    out_path = os.path.join(cache_folder, f'nl_scaling_{start}_{end}_{key}.npy')
+    if os.path.exists(out_path):
+        return out_path
+
+    windows = list(iter_windows(ref['height'], ref['width'], block_size=block_size))
+    if verbose:
+        print(f'Computing NL scaling image over {len(windows)} block(s) ...')
+
+    # Written under a temporary name, so that an interrupted run is not reused
+    tmp_path = out_path.replace('.npy', '.tmp.npy')
+    create_raster(tmp_path, 1, ref['height'], ref['width'], ref['transform'], bands=['radiance'],
+                  crs=ref.get('crs', 'EPSG:4326'))
+    n_jobs = n_jobs or multiprocessing.cpu_count()
+    Parallel(n_jobs=n_jobs)(delayed(_scaling_block)(dmsp_images, viirs_images, profiles, w, tmp_path)
+                            for w in tqdm(windows))
+    os.replace(tmp_path.replace('.npy', '.json'), out_path.replace('.npy', '.json'))
+    os.replace(tmp_path, out_path)
+
+    return out_path
+
+
+def get_scaling_factor(scaling_path, images, control_shape=config.CONTROL_SHAPE, common_range=config.COMMON_RANGE_NTL):
+    """
+    Local version of get_scaling_image_ols_dnb(use_image=False): single factor, ratio of the mean VIIRS and DMSP-OLS
+    medians over the control shape
+    """
+    profile = raster_profile(scaling_path)
+    coords = np.array(control_shape['coordinates'][0])
+    bounds = (coords[:, 0].min(), coords[:, 1].min(), coords[:, 0].max(), coords[:, 1].max())
+    window = bounds_to_window(profile['transform'], bounds, profile['height'], profile['width'])
+    if window[2] == 0 or window[3] == 0:
+        raise ValueError('The control shape is outside of the night lights images')
+
+    start, end = common_range
+    medians = []
+    for collection in (VIIRS_DNB, DMSP_OLS):
+        selected = filter_nl_images(images, start, end, collection=collection)
+        medians.append(nan_median(np.stack([_read_radiance(t, raster_profile(t['path']), window)
+                                            for t in selected])))
+    return float(np.nanmean(medians[0]) / np.nanmean(medians[1]))
+
+
+def _nl_block(dmsp_images, viirs_images, profiles, window, scaling, out_path):
+    row_off, col_off, height, width = window
+    layers = [_read_radiance(t, profiles[t['path']], window) for t in viirs_images]
+    if dmsp_images:
+        if isinstance(scaling, str):
+            scaling = read_window(scaling, window)[0]
+        layers += [_read_radiance(t, profiles[t['path']], window) * scaling for t in dmsp_images]
+
+    out = np.load(out_path, mmap_mode='r+')
+    out[0, row_off:row_off + height, col_off:col_off + width] = nan_median(np.stack(layers))
+    out.flush()
+    return window
+
+
+def composite_nl_image(images, start_date, end_date, out_path, apply_scaling=True, use_image=True,
+                       common_range=config.COMMON_RANGE_NTL, cache_folder=config.CACHE_FOLDER,
+                       block_size=config.BLOCK_SIZE, n_jobs=None, verbose=config.VERBOSE):
+    """
+    Local version of image_utils.load_nl_image over monthly night lights images on disk: DMSP-OLS images are scaled
+    with the (cached) scaling image, merged with the VIIRS images, and the median radiance is computed in a single
+    streaming pass over blocks.
+
+    :return: path of the .npy composite, with a single radiance band
+    """
+    dmsp_images = filter_nl_images(images, start_date, end_date, collection=DMSP_OLS)
+    viirs_images = filter_nl_images(images, start_date, end_date, collection=VIIRS_DNB)
+    if len(dmsp_images) + len(viirs_images) == 0:
+        raise ValueError(f'No night lights image available between {start_date} and {end_date}')
+
+    profiles = {t['path']: raster_profile(t['path']) for t in dmsp_images + viirs_images}
+    ref = check_same_grid(list(profiles.values()))
+
+    scaling = 1.
+    if apply_scaling and dmsp_images:
+        scaling = get_scaling_image(images, common_range=common_range, cache_folder=cache_folder,
+                                    block_size=block_size, n_jobs=n_jobs, verbose=verbose)
+        check_same_grid([ref, raster_profile(scaling)])
+        if not use_image:
+            scaling = get_scaling_factor(scaling, images, common_range=common_range)
+
+    create_raster(out_path, 1, ref['height'], ref['width'], ref['transform'], bands=['radiance'],
+                  crs=ref.get('crs', 'EPSG:4326'))
+    windows = list(iter_windows(ref['height'], ref['width'], block_size=block_size))
+    if verbose:
+        print(f'Compositing {len(dmsp_images)} DMSP-OLS and {len(viirs_images)} VIIRS image(s) '
+              f'in {len(windows)} block(s) ...')
+
+    n_jobs = n_jobs or multiprocessing.cpu_count()
+    Parallel(n_jobs=n_jobs)(delayed(_nl_block)(dmsp_images, viirs_images, profiles, w, scaling, out_path)
+                            for w in tqdm(windows))
+
+    return out_path
+
+
+def build_feature_stack(nl_path, ms_path, out_path, block_size=config.BLOCK_SIZE):
+    """
+    Local version of image_utils.load_feature_stack: radiance, R, G, B, NDVI bands on a single raster,
+    as expected by local_models.predict_raster
+    """
+    nl_profile, ms_profile = raster_profile(nl_path), raster_profile(ms_path)
+    ref = check_same_grid([nl_profile, ms_profile])
+    ms_bands = [band_index(ms_profile, t) for t in ['R', 'G', 'B', 'NDVI']]
+
+    out = create_raster(out_path, len(config.STACK_BANDS), ref['height'], ref['width'], ref['transform'],
+                        bands=config.STACK_BANDS, crs=ref.get('crs', 'EPSG:4326'))
+    for window in iter_windows(ref['height'], ref['width'], block_size=block_size):
+        row_off, col_off, height, width = window
+        out[:, row_off:row_off + height, col_off:col_off + width] = np.concatenate([
+            read_window(nl_path, window, bands=band_index(nl_profile, 'radiance')),
+            read_window(ms_path, window, bands=ms_bands)])
+    out.flush()
+
+    return out_path
+
+
+def get_feature_stack(scenes, images, start_date, end_date, cache_folder=config.CACHE_FOLDER,
+                      block_size=config.BLOCK_SIZE, n_jobs=None, verbose=config.VERBOSE):
+    """
+    Feature stack of the period, composited once from the Landsat scenes and night lights images and cached in
+    cache_folder. The cache is keyed by the compositing parameters (raster_utils.stack_key), the dates and the inputs,
+    so that later inference runs (e.g. of another model) read it instead of recompositing.
+
+    :return: path of the cached .npy feature stack
+    """
+    key = stack_key([start_date, end_date, sorted(t['path'] for t in scenes), sorted(t['path'] for t in images)])
+    out_path = os.path.join(cache_folder, f'feature_stack_{start_date}_{end_date}_{key}.npy')
+    if os.path.exists(out_path):
+        if verbose:
+            print(f'Using cached feature stack {out_path}')
+        return out_path
+
+    # Intermediate composites and stack written under temporary names, so that an interrupted run is not reused
+    ms_path, nl_path, tmp_path = [out_path.replace('.npy', f'.{t}.tmp.npy') for t in ['ms', 'nl', 'stack']]
+    composite_ms_image(scenes, start_date, end_date, ms_path, block_size=block_size, n_jobs=n_jobs, verbose=verbose)
+    composite_nl_image(images, start_date, end_date, nl_path, cache_folder=cache_folder, block_size=block_size,
+                       n_jobs=n_jobs, verbose=verbose)
+    build_feature_stack(nl_path, ms_path, tmp_path, block_size=block_size)
+    for path in [ms_path, nl_path]:
+        os.remove(path)
+        os.remove(path.replace('.npy', '.json'))
+    os.replace(tmp_path.replace('.npy', '.json'), out_path.replace('.npy', '.json'))
+    os.replace(tmp_path, out_path)
+
+    return out_path
@@ -0,0 +1,148 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+from functools import partial
+
+import numpy as np
+from joblib import Parallel, delayed
+from tqdm import tqdm
+
+from cities_watch import config
+from cities_watch.raster_utils import create_raster, iter_windows, raster_profile, read_window
+
+_LOADED_MODELS = {}
+
+
+def _predict_saved_model(model_path, batch):
+    # Models are loaded once per process
+    if model_path not in _LOADED_MODELS:
+        import tensorflow as tf
+
+        _LOADED_MODELS[model_path] = tf.keras.models.load_model(model_path, compile=False)
+    return _LOADED_MODELS[model_path].predict(batch, batch_size=len(batch))
+
+
+def load_local_model(model_path):
+    """
+    Predictor running a saved TensorFlow/Keras model (as deployed on AI Platform) locally.
+
+    A predictor is any picklable callable mapping a (n_tiles, rows, cols, bands) float32 array of feature stack tiles
+    to (n_tiles, rows, cols) or (n_tiles, rows, cols, 1) predictions. Plain numpy functions can be used for tests.
+    TensorFlow already uses all cores, so saved models are best run with n_jobs=1 in predict_raster.
+    """
+    return partial(_predict_saved_model, model_path)
+
+
+def blending_weights(tile_size=config.INPUT_TILE_SIZE, overlap=config.INPUT_OVERLAP_SIZE):
+    """
+    Weights of the tile pixels when blending overlapping predictions: 1 in the core of the tile,
+    linearly decreasing over the overlap margins
+    """
+    weights = []
+    for size, margin in zip(tile_size, overlap):
+        w = np.ones(size, dtype=np.float32)
+        if margin > 0:
+            ramp = np.arange(1, margin + 1, dtype=np.float32) / (margin + 1)
+            w[:margin] = ramp
+            w[-margin:] = ramp[::-1]
+        weights.append(w)
+    return np.outer(*weights)
+
+
+def tile_origins(height, width, tile_size=config.INPUT_TILE_SIZE, overlap=config.INPUT_OVERLAP_SIZE):
+    """
+    Upper left corners of the tiles, as earth-engine tiles model inputs: tiles of tile_size pixels whose cores
+    (tile_size - 2 * overlap pixels) cover the raster and whose overlap margins are shared with the neighbour tiles
+    """
+    core = [s - 2 * o for s, o in zip(tile_size, overlap)]
+    if min(core) <= 0:
+        raise ValueError(f'Overlap {overlap} too large for tiles of {tile_size} pixels')
+    rows = np.arange(0, height, core[0]) - overlap[0]
+    cols = np.arange(0, width, core[1]) - overlap[1]
+    return [(r, c) for r in rows for c in cols]
+
+
+def read_tile(source, row_off, col_off, tile_size, height, width):
+    """
+    Read a (bands, rows, cols) tile that may extend past the raster edges, padded by reflection
+    """
+    r0, c0 = max(row_off, 0), max(col_off, 0)
+    r1, c1 = min(row_off + tile_size[0], height), min(col_off + tile_size[1], width)
+    data = read_window(source, (r0, c0, r1 - r0, c1 - c0))
+    pad = ((0, 0), (r0 - row_off, row_off + tile_size[0] - r1), (c0 - col_off, col_off + tile_size[1] - c1))
+    if any(p for t in pad for p in t):
+        mode = 'reflect' if min(data.shape[1:]) > 1 else 'edge'
+        data = np.pad(data, pad, mode=mode)
+    return data
+
+
+def _predict_tiles(source, origins, tile_size, height, width, predictor):
+    tiles = np.stack([read_tile(source, r, c, tile_size, height, width) for r, c in origins])
+    # channels last, as the model inputs; masked pixels are zeroed
+    batch = np.nan_to_num(np.moveaxis(tiles, 1, -1))
+    predictions = np.asarray(predictor(batch), dtype=np.float32)
+    if predictions.ndim == 4:
+        predictions = predictions[..., 0]
+    return predictions
+
+
+def predict_raster(source, out_path, predictor, profile=None, tile_size=config.INPUT_TILE_SIZE,
+                   overlap=config.INPUT_OVERLAP_SIZE, batch_size=config.LOCAL_BATCH_SIZE, n_jobs=None,
+                   block_size=config.BLOCK_SIZE, verbose=config.VERBOSE):
+    """
+    Local alternative to model.predictImage: cut a feature stack raster into overlapping tiles, predict them by
+    batches across cores and blend the overlaps into a full-size classes raster.
+    Inputs are read tile by tile and blending accumulators are memory-mapped, so rasters bigger than RAM are supported.
+
+    :param source: feature stack (radiance, R, G, B, NDVI), see raster_utils.raster_profile for supported sources
+    :param out_path: path of the output .npy raster (with a single config.RESPONSE band)
+    :param predictor: callable, see load_local_model
+    """
+    profile = raster_profile(source, profile)
+    height, width = profile['height'], profile['width']
+    origins = tile_origins(height, width, tile_size=tile_size, overlap=overlap)
+    batches = [origins[i:i + batch_size] for i in range(0, len(origins), batch_size)]
+    n_jobs = n_jobs or multiprocessing.cpu_count()
+    weights = blending_weights(tile_size=tile_size, overlap=overlap)
+
+    if verbose:
+        print(f'Predicting {height}x{width} pixels: {len(origins)} tile(s) in {len(batches)} batch(es) ...')
+
+    tmp_dir = tempfile.mkdtemp(prefix='cities_watch_predict_')
+    try:
+        weighted_sum = np.lib.format.open_memmap(os.path.join(tmp_dir, 'sum.npy'), mode='w+', dtype=np.float32,
+                                                 shape=(height, width))
+        weights_sum = np.lib.format.open_memmap(os.path.join(tmp_dir, 'weights.npy'), mode='w+', dtype=np.float32,
+                                                shape=(height, width))
+
+        # Dispatch a few batches per worker at a time, to keep the predictions held in memory bounded
+        step = 2 * n_jobs
+        with Parallel(n_jobs=n_jobs) as parallel:
+            for i in tqdm(range(0, len(batches), step)):
+                group = batches[i:i + step]
+                results = parallel(delayed(_predict_tiles)(source, b, tile_size, height, width, predictor)
+                                   for b in group)
+                for batch_origins, predictions in zip(group, results):
+                    for (r, c), pred in zip(batch_origins, predictions):
+                        r0, c0 = max(r, 0), max(c, 0)
+                        r1, c1 = min(r + tile_size[0], height), min(c + tile_size[1], width)
+                        w = weights[r0 - r:r1 - r, c0 - c:c1 - c]
+                        weighted_sum[r0:r1, c0:c1] += w * pred[r0 - r:r1 - r, c0 - c:c1 - c]
+                        weights_sum[r0:r1, c0:c1] += w
+
+        out = create_raster(out_path, 1, height, width, profile['transform'], bands=[config.RESPONSE],
+                            crs=profile.get('crs', 'EPSG:4326'))
+        for row_off, col_off, h, w in iter_windows(height, width, block_size=block_size):
+            rows, cols = slice(row_off, row_off + h), slice(col_off, col_off + w)
+            classes = weighted_sum[rows, cols] / weights_sum[rows, cols]
+            # Mask pixels without valid input, as earth-engine does
+            valid = np.isfinite(read_window(source, (row_off, col_off, h, w))).all(axis=0)
+            classes[~valid] = np.nan
+            out[0, rows, cols] = classes
+        out.flush()
+        del weighted_sum, weights_sum
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return out_path
@@ -0,0 +1,313 @@
+import json
+import multiprocessing
+from collections import defaultdict
+
+import numpy as np
+import pyproj
+from joblib import Parallel, delayed
+from scipy import ndimage
+from shapely.geometry import box, mapping
+from shapely.ops import unary_union
+from tqdm import tqdm
+
+from cities_watch import config
+from cities_watch.raster_utils import band_index, iter_windows, pixel_to_coords, raster_profile, read_window
+from cities_watch.reverse_geo_utils import add_city_ranking
+
+EIGHT_CONNECTED = np.ones((3, 3), dtype=int)
+
+
+def label_mask(mask):
+    # Label 8-connected components, as reduceToVectors(eightConnected=True)
+    return ndimage.label(mask, structure=EIGHT_CONNECTED)
+
+
+def block_edges(labels):
+    return {'top': labels[0].copy(), 'bottom': labels[-1].copy(),
+            'left': labels[:, 0].copy(), 'right': labels[:, -1].copy()}
+
+
+def _seam_pairs(a, b):
+    # Labels of the 8-connected pixel pairs facing each other along a seam (a and b are the two facing pixel lines)
+    pairs = []
+    for aa, bb in ((a, b), (a[1:], b[:-1]), (a[:-1], b[1:])):
+        is_pair = (aa > 0) & (bb > 0)
+        pairs.append(np.column_stack([aa[is_pair], bb[is_pair]]))
+    pairs = np.concatenate(pairs)
+    if len(pairs) == 0:
+        return pairs
+    return np.unique(pairs, axis=0)
+
+
+def merge_block_labels(edges):
+    """
+    Merge labels of components crossing block boundaries, with a union-find over the block seams.
+
+    :param edges: {(block_row, block_col): block_edges(labels)} for a regular grid of blocks
+    :return: {(block_row, block_col, label): root} for every label touching a seam connected to another block
+    """
+    parent = {}
+
+    def find(x):
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    def union(a, b):
+        parent.setdefault(a, a)
+        parent.setdefault(b, b)
+        ra, rb = find(a), find(b)
+        if ra != rb:
+            parent[max(ra, rb)] = min(ra, rb)
+
+    for (i, j), e in edges.items():
+        right = edges.get((i, j + 1))
+        if right is not None:
+            for la, lb in _seam_pairs(e['right'], right['left']):
+                union((i, j, int(la)), (i, j + 1, int(lb)))
+
+        below = edges.get((i + 1, j))
+        if below is not None:
+            for la, lb in _seam_pairs(e['bottom'], below['top']):
+                union((i, j, int(la)), (i + 1, j, int(lb)))
+
+        # Components only connected through a corner of the blocks
+        diagonal = edges.get((i + 1, j + 1))
+        if diagonal is not None and e['bottom'][-1] > 0 and diagonal['top'][0] > 0:
+            union((i, j, int(e['bottom'][-1])), (i + 1, j + 1, int(diagonal['top'][0])))
+        anti_diagonal = edges.get((i + 1, j - 1))
+        if anti_diagonal is not None and e['bottom'][0] > 0 and anti_diagonal['top'][-1] > 0:
+            union((i, j, int(e['bottom'][0])), (i + 1, j - 1, int(anti_diagonal['top'][-1])))
+
+    return {k: find(k) for k in parent}
+
+
+def labels_to_polygons(labels, n_labels, window, transform):
+    """
+    Polygons of each label (index label - 1), as the union of the boxes of the runs of pixels along each row
+    """
+    row_off, col_off = window[:2]
+    height, width = labels.shape
+    padded = np.zeros((height, width + 2), dtype=labels.dtype)
+    padded[:, 1:-1] = labels
+
+    # Column where the label changes along each row, consecutive changes in a row delimit a run
+    rows, cols = np.nonzero(padded[:, 1:] != padded[:, :-1])
+    same_row = rows[:-1] == rows[1:]
+    run_rows, run_starts, run_ends = rows[:-1][same_row], cols[:-1][same_row], cols[1:][same_row]
+    run_labels = labels[run_rows, run_starts]
+    is_city = run_labels > 0
+    run_rows, run_starts, run_ends, run_labels = (run_rows[is_city], run_starts[is_city], run_ends[is_city],
+                                                  run_labels[is_city])
+
+    x0, y0 = pixel_to_coords(transform, row_off + run_rows, col_off + run_starts)
+    x1, y1 = pixel_to_coords(transform, row_off + run_rows + 1, col_off + run_ends)
+
+    order = np.argsort(run_labels, kind='stable')
+    splits = np.searchsorted(run_labels[order], np.arange(1, n_labels + 1), side='right')[:-1]
+    polygons = []
+    for idx in np.split(order, splits):
+        boxes = [box(min(a, c), min(b, d), max(a, c), max(b, d)) for a, b, c, d in zip(x0[idx], y0[idx],
+                                                                                         x1[idx], y1[idx])]
+        polygons.append(unary_union(boxes))
+    return polygons
+
+
+def _vectorize_block(source, window, band, threshold, transform):
+    classes = read_window(source, window, bands=band)[0]
+    with np.errstate(invalid='ignore'):
+        mask = classes >= threshold
+    labels, n_labels = label_mask(mask)
+    if n_labels == 0:
+        return {'polygons': [], 'counts': [], 'sums': [], 'edges': block_edges(labels)}
+
+    index = np.arange(1, n_labels + 1)
+    return {'polygons': labels_to_polygons(labels, n_labels, window, transform),
+            'counts': ndimage.sum(mask, labels, index),
+            'sums': ndimage.sum(np.nan_to_num(classes), labels, index),
+            'edges': block_edges(labels)}
+
+
+def vectorize_raster(source, profile=None, band=config.RESPONSE, threshold=config.CITY_THRESHOLD,
+                     block_size=config.BLOCK_SIZE, n_jobs=None, verbose=config.VERBOSE):
+    """
+    Local alternative to vector_utils.vectorize_image: threshold a prediction raster and extract 8-connected
+    polygons at the native resolution, block by block in a process pool, stitching polygons across block edges.
+
+    :param source: path to a GeoTIFF or .npy raster, or a numpy array (with profile), see raster_utils.raster_profile
+    :return: GeoJSON FeatureCollection with the same schema as the shapes exported by urban_mapper
+    """
+    profile = raster_profile(source, profile)
+    b_index = band_index(profile, band)
+    windows = list(iter_windows(profile['height'], profile['width'], block_size=block_size))
+    if verbose:
+        print(f"Vectorizing {profile['height']}x{profile['width']} pixels in {len(windows)} block(s) ...")
+
+    n_jobs = n_jobs or multiprocessing.cpu_count()
+    blocks = Parallel(n_jobs=n_jobs)(delayed(_vectorize_block)(source, w, b_index, threshold, profile['transform'])
+                                     for w in tqdm(windows))
+
+    # Stitch components crossing block edges
+    keys = [(w[0] // block_size, w[1] // block_size) for w in windows]
+    roots = merge_block_labels({k: blk['edges'] for k, blk in zip(keys, blocks)})
+
+    components = []
+    groups = defaultdict(list)
+    for (i, j), blk in zip(keys, blocks):
+        for label, part in enumerate(zip(blk['polygons'], blk['counts'], blk['sums']), start=1):
+            root = roots.get((i, j, label))
+            if root is None:
+                components.append(part)
+            else:
+                groups[root].append(part)
+    for parts in groups.values():
+        polygons, counts, sums = zip(*parts)
+        components.append((unary_union(polygons), sum(counts), sum(sums)))
+
+    features = []
+    for idx, (geom, count, total) in enumerate(components):
+        # same properties as reduceToVectors(labelProperty='city', reducer=ee.Reducer.mean()) + re-assigned id
+        features.append({'type': 'Feature',
+                         'id': str(idx),
+                         'geometry': mapping(geom),
+                         'properties': {'city': 1, 'mean': float(total / count), 'id': str(idx)}})
+
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def write_feature_collection(collection, file_path):
+    with open(file_path, 'w') as f:
+        json.dump(collection, f)
+    return file_path
+
+
+def disk(radius):
+    y, x = np.ogrid[-radius:radius + 1, -radius:radius + 1]
+    return x ** 2 + y ** 2 <= radius ** 2
+
+
+def close_mask(mask, radius):
+    """
+    Morphological closing with a disk, the raster counterpart of geom.buffer(r).buffer(-r).
+    Pixels outside the mask are considered empty, so that the closing never erodes the edges of the raster.
+    """
+    structure = disk(radius)
+    padded = np.pad(mask, radius)
+    closed = ndimage.binary_erosion(ndimage.binary_dilation(padded, structure), structure, border_value=1)
+    return closed[radius:-radius, radius:-radius]
+
+
+def close_components(mask, radius):
+    """
+    Closing of each 8-connected component on its own, then merged: the raster counterpart of the union of
+    geom.buffer(r).buffer(-r) over the shapes, as in geom_utils.merge_split_shapes
+    """
+    labels, _ = label_mask(mask)
+    out = np.zeros((mask.shape[0] + 2 * radius, mask.shape[1] + 2 * radius), dtype=bool)
+    for label, (rows, cols) in enumerate(ndimage.find_objects(labels), start=1):
+        component = np.pad(labels[rows, cols] == label, radius)
+        out[rows.start:rows.stop + 2 * radius, cols.start:cols.stop + 2 * radius] |= close_mask(component, radius)
+    return out[radius:-radius, radius:-radius]
+
+
+def cell_areas(transform, height, multiplier=1e6):
+    """
+    Ellipsoidal (WGS84) area of the cells of each row of a north-up EPSG:4326 raster, by default in km2
+    """
+    x_scale, _, x_origin, _, y_scale, y_origin = transform
+    geod = pyproj.Geod(ellps='WGS84')
+    lons = [x_origin, x_origin + x_scale, x_origin + x_scale, x_origin]
+    areas = np.empty(height)
+    for row in range(height):
+        top, bottom = y_origin + row * y_scale, y_origin + (row + 1) * y_scale
+        areas[row] = abs(geod.polygon_area_perimeter(lons, [top, top, bottom, bottom])[0])
+    return areas / multiplier
+
+
+def _size_block(source, window, band, threshold, transform, row_areas, radius, raster_shape):
+    row_off, col_off, height, width = window
+    if radius > 0:
+        # Read a halo around the block, the closing of a pixel depends on the pixels up to 2 x radius away
+        # (components only connected outside of the halo are closed separately)
+        halo = 2 * radius
+        r0, c0 = max(row_off - halo, 0), max(col_off - halo, 0)
+        r1, c1 = min(row_off + height + halo, raster_shape[0]), min(col_off + width + halo, raster_shape[1])
+        classes = read_window(source, (r0, c0, r1 - r0, c1 - c0), bands=band)[0]
+        with np.errstate(invalid='ignore'):
+            mask = close_components(classes >= threshold, radius)
+        mask = mask[row_off - r0:row_off - r0 + height, col_off - c0:col_off - c0 + width]
+    else:
+        classes = read_window(source, window, bands=band)[0]
+        with np.errstate(invalid='ignore'):
+            mask = classes >= threshold
+
+    labels, n_labels = label_mask(mask)
+    if n_labels == 0:
+        return {'sizes': np.zeros((0, 4)), 'edges': block_edges(labels)}
+
+    # Area, pixel count and area-weighted coordinates of the pixel centers of each label
+    index = np.arange(1, n_labels + 1)
+    areas = np.broadcast_to(row_areas[row_off:row_off + height, None], mask.shape)
+    rows, cols = np.mgrid[row_off:row_off + height, col_off:col_off + width]
+    x, y = pixel_to_coords(transform, rows + 0.5, cols + 0.5)
+    sizes = np.column_stack([ndimage.sum(areas, labels, index), ndimage.sum(mask, labels, index),
+                             ndimage.sum(areas * x, labels, index), ndimage.sum(areas * y, labels, index)])
+    return {'sizes': sizes, 'edges': block_edges(labels)}
+
+
+def city_size_table(source, profile=None, band=config.RESPONSE, threshold=config.CITY_THRESHOLD, buffer_coeff=None,
+                    metadata=None, block_size=config.BLOCK_SIZE, n_jobs=None, verbose=config.VERBOSE):
+    """
+    Fast path to the city size distribution, without vectorizing: threshold a prediction raster, label 8-connected
+    components block by block in a process pool (merging labels across block edges) and sum the ellipsoidal area of
+    their cells. Areas match reverse_geo_utils.compute_area of the polygons of vectorize_raster.
+
+    :param source: path to a GeoTIFF or .npy raster, or a numpy array (with profile), on a north-up EPSG:4326 grid
+    :param buffer_coeff: if set, each component is closed with a disk of buffer_coeff (degrees) before labeling,
+    as geom_utils.merge_split_shapes does on the vector shapes
+    :param metadata: properties added to each record (e.g. country and year)
+    :return: records with area (km2), pixels, longitude and latitude (area-weighted center) and rank, largest first
+    """
+    profile = raster_profile(source, profile)
+    b_index = band_index(profile, band)
+    transform = profile['transform']
+    radius = int(round(buffer_coeff / abs(transform[0]))) if buffer_coeff else 0
+    row_areas = cell_areas(transform, profile['height'])
+    windows = list(iter_windows(profile['height'], profile['width'], block_size=block_size))
+    if verbose:
+        print(f"Labeling {profile['height']}x{profile['width']} pixels in {len(windows)} block(s) ...")
+
+    n_jobs = n_jobs or multiprocessing.cpu_count()
+    blocks = Parallel(n_jobs=n_jobs)(delayed(_size_block)(source, w, b_index, threshold, transform, row_areas, radius,
+                                                          (profile['height'], profile['width']))
+                                     for w in tqdm(windows))
+
+    # Sum the sizes of the parts of components crossing block edges
+    keys = [(w[0] // block_size, w[1] // block_size) for w in windows]
+    roots = merge_block_labels({k: blk['edges'] for k, blk in zip(keys, blocks)})
+
+    components = []
+    groups = defaultdict(lambda: np.zeros(4))
+    for (i, j), blk in zip(keys, blocks):
+        for label, sizes in enumerate(blk['sizes'], start=1):
+            root = roots.get((i, j, label))
+            if root is None:
+                components.append(sizes)
+            else:
+                groups[root] += sizes
+    components += list(groups.values())
+
+    records = []
+    for area, pixels, x_sum, y_sum in components:
+        record = {'area': round(float(area), 3), 'pixels': int(pixels),
+                  'longitude': float(x_sum / area), 'latitude': float(y_sum / area)}
+        if metadata:
+            record.update(metadata)
+        records.append(record)
+
+    if len(records) == 0:
+        return records
+    return add_city_ranking(records)
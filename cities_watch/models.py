@@ -1,11 +1,12 @@
 import ee
 
-from cities_watch import config
-from cities_watch.image_utils import load_feature_stack
+from cities_watch import config, init_ee
+from cities_watch.image_utils import load_feature_stack, get_scaling_image_ols_dnb, load_cached_feature_stack
 from cities_watch.vector_utils import vectorize_image
 
 
 def load_model():
+    init_ee()
     model = ee.Model.fromAiPlatformPredictor(
         projectName=config.PROJECT_NAME,
         modelName=config.MODEL_NAME,
@@ -23,7 +24,7 @@ def load_model():
 
 
 def map_urban_areas(aoi, start_date, end_date, model=None, vectorized=True, verbose=config.VERBOSE,
-                    scale_multi=config.SCALE_MULTI):
+                    scale_multi=config.SCALE_MULTI, cached_stack=None):
     aoi_props = aoi['properties']
 
     if verbose:
@@ -34,10 +35,14 @@ def map_urban_areas(aoi, start_date, end_date, model=None, vectorized=True, verb
 
     feature = ee.Feature(aoi)
 
-    # Load feature stack with optical and radiance imagery
-    feature_stack = load_feature_stack(start_date=start_date,
-                                       end_date=end_date,
-                                       geometry=feature.geometry())  # .buffer(config.BUFFER_COEFF)
+    if cached_stack:
+        # Feature stack exported by a previous run (see urban_mapper.get_cached_stack)
+        feature_stack = load_cached_feature_stack(cached_stack).clip(feature.geometry())
+    else:
+        # Load feature stack with optical and radiance imagery
+        feature_stack = load_feature_stack(start_date=start_date,
+                                           end_date=end_date,
+                                           geometry=feature.geometry())  # .buffer(config.BUFFER_COEFF)
 
     if not model:
         # Load the default trained model if not defined
@@ -55,3 +60,46 @@ def map_urban_areas(aoi, start_date, end_date, model=None, vectorized=True, verb
 
     else:
         return out_images
+
+
+def map_urban_areas_multi_year(aoi, list_years, model=None, verbose=config.VERBOSE, scale_multi=config.SCALE_MULTI,
+                               cached_stacks=None):
+    """
+    Vectorized predictions of all the years in a single collection, with a year property on each feature.
+    The clipped geometry, the night lights calibration and the model are built once and shared by all years.
+    cached_stacks maps years to the file names of their exported feature stacks, when available.
+    """
+    cached_stacks = cached_stacks or {}
+    aoi_props = aoi['properties']
+
+    if verbose:
+        print(f"""
+            Mapping cities for {aoi_props} 
+            years: {list_years} ...
+            """)
+
+    feature = ee.Feature(aoi)
+    geometry = feature.geometry()
+    scaling_img = get_scaling_image_ols_dnb()
+
+    if not model:
+        # Load the default trained model if not defined
+        model = load_model()
+
+    city_vectors = ee.FeatureCollection([])
+    for year in list_years:
+        if cached_stacks.get(year):
+            feature_stack = load_cached_feature_stack(cached_stacks[year]).clip(geometry)
+        else:
+            feature_stack = load_feature_stack(start_date=f"{year}-01-01",
+                                               end_date=f"{year}-12-31",
+                                               geometry=geometry,
+                                               scaling_img=scaling_img)
+
+        predictions = model.predictImage(feature_stack.toArray()).clip(geometry)
+
+        year_vectors = vectorize_image(image=predictions, geometry=geometry, verbose=False, scale_multi=scale_multi) \
+            .map(lambda x, y=year: x.set({'year': y}))
+        city_vectors = city_vectors.merge(year_vectors)
+
+    return city_vectors
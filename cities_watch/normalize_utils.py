@@ -0,0 +1,84 @@
+import json
+import os
+from collections import defaultdict
+
+import pandas as pd
+from shapely.geometry.base import BaseGeometry
+
+from cities_watch import config
+
+SHAPE_FIELDS = ['id', 'geometry', 'area', 'rank', 'node_id']
+
+
+def get_table_path(table, country_code_gaul, iso3c, year=None, folder=config.NORMALIZED_FOLDER):
+    # nodes are per country, shapes and links per country and year
+    if table == 'nodes':
+        return os.path.join(folder, f'{country_code_gaul}_{iso3c}_nodes.json')
+    return os.path.join(folder, f'{country_code_gaul}_{iso3c}_{year}_{table}.json')
+
+
+def nodes_table(df_nodes):
+    # Records of the OSM nodes of a country, geometries as WKT (as in the local copy of the nodes)
+    df = pd.DataFrame(df_nodes).copy()
+    df['geometry'] = df['geometry'].apply(lambda x: x.wkt if isinstance(x, BaseGeometry) else x)
+    df = df.where(pd.notnull(df), None)
+    return df.to_dict(orient='records')
+
+
+def write_table(records, path):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(records, f)
+    os.replace(path + '.tmp', path)
+
+
+def load_tables(country_code_gaul, iso3c, year, folder=config.NORMALIZED_FOLDER):
+    """
+    :return: shapes, links and nodes tables of a country and year
+    """
+    tables = []
+    for table in ['shapes', 'links', 'nodes']:
+        with open(get_table_path(table, country_code_gaul, iso3c, year, folder=folder), 'r') as f:
+            tables.append(json.load(f))
+    return tuple(tables)
+
+
+def denormalize_records(shapes, links, nodes):
+    """
+    Rebuild the records of tag_nodes_to_shapes (cities of each shape, and fields of the major city copied on the
+    record) from the normalized tables, sorted by rank
+    """
+    nodes = {t['node_id']: {k: v for k, v in t.items() if k != 'geometry'} for t in nodes}
+    shape_links = defaultdict(list)
+    for t in links:
+        shape_links[t['shape_id']].append(t)
+
+    all_records = []
+    for t in sorted(shapes, key=lambda x: x['rank']):
+        cities = []
+        for link in shape_links[t['id']]:
+            city = dict(nodes[link['node_id']], tag_method=link['tag_method'])
+            if link.get('coverage') is not None:
+                city['coverage'] = link['coverage']
+            # drop None fields
+            cities.append({u: v for u, v in city.items() if v})
+        major_city = next(c for c, u in zip(cities, shape_links[t['id']]) if u['node_id'] == t['node_id'])
+        new_record = {'geometry': t['geometry'],
+                      'cities': cities,
+                      'area': t['area']}
+        new_record.update({k: v for k, v in major_city.items() if k != 'coverage'})
+        new_record.update({k: v for k, v in t.items() if k not in SHAPE_FIELDS})
+        new_record['id'] = t['id']
+        new_record['rank'] = t['rank']
+        all_records.append(new_record)
+
+    # Fields missing from some records are None, as in add_city_ranking
+    df = pd.DataFrame(all_records)
+    df = df.where(pd.notnull(df), None)
+    return df.to_dict(orient='records')
+
+
+def load_records(country_code_gaul, iso3c, year, folder=config.NORMALIZED_FOLDER):
+    """
+    Records of a country and year in the format of the files of RESUlTS_FOLDER, from the normalized tables
+    """
+    return denormalize_records(*load_tables(country_code_gaul, iso3c, year, folder=folder))
@@ -8,12 +8,13 @@ from shapely.geometry import Point
 from tqdm import tqdm
 
 from cities_watch import config
+from cities_watch.trace_utils import merge_trace, run_traced, trace_count, trace_span, worker_state
 from cities_watch.wiki_utils import get_city_pageviews
 
 
 def query_osm_places(geom, filters=config.OSM_TAGS, admin_levels=config.OSM_ADMIN_LEVELS, verbose=config.VERBOSE,
                      timeout=config.OSM_TIMEOUT, count=0):
-    api = overpy.Overpass()
+    api = overpy.Overpass(url=config.OVERPASS_URL)
 
     # get bbox from shapely geometry
     west, south, east, north = geom.bounds
@@ -30,15 +31,17 @@ def query_osm_places(geom, filters=config.OSM_TAGS, admin_levels=config.OSM_ADMI
 
     # fetch all nodes
     try:
-        result = api.query(f"""
-            [timeout:{timeout}];
-            node({south}, {west}, {north}, {east})[place~"^({params['filter']})$"];
-            foreach(
-              out;
-              is_in;
-              area._[admin_level~"{params['admin_level']}"]["place"!="county"];
-              out;
-            );
+        trace_count('osm.overpass_queries')
+        with trace_span('osm.overpass'):
+            result = api.query(f"""
+                [timeout:{timeout}];
+                node({south}, {west}, {north}, {east})[place~"^({params['filter']})$"];
+                foreach(
+                  out;
+                  is_in;
+                  area._[admin_level~"{params['admin_level']}"]["place"!="county"];
+                  out;
+                );
             """)
     except overpy.exception.OverpassTooManyRequests:
         print('Too many overpass requests, sleeping ...')
@@ -66,6 +69,7 @@ def get_node_infos(r):
 def get_tagged_nodes(geom, filters=config.OSM_TAGS, admin_levels=config.OSM_ADMIN_LEVELS, out_path=None):
     result = query_osm_places(geom, filters=filters, admin_levels=admin_levels)
 
+    trace_count('osm.nodes', len(result.nodes))
     df_nodes = pd.DataFrame([get_node_infos(n) for n in result.nodes])
     props_to_keep = ['node_id', 'name', 'name:en', 'alt_name', 'place', 'geometry', 'wikipedia']
     df_nodes = df_nodes[props_to_keep].copy()
@@ -76,9 +80,13 @@ def get_tagged_nodes(geom, filters=config.OSM_TAGS, admin_levels=config.OSM_ADMI
     wikis = df_nodes['wikipedia'].values.tolist()
 
     num_cores = multiprocessing.cpu_count()
-    results = Parallel(n_jobs=num_cores)(delayed(get_city_pageviews)(name, alt_names, wiki)
-                                         for name, alt_names, wiki in tqdm(zip(names, alt_names, wikis),
-                                                                           total=len(names)))
+    state = worker_state()
+    with trace_span('osm.pageviews'):
+        # wiki requests are counted in the workers
+        outputs = Parallel(n_jobs=num_cores)(delayed(run_traced)(state, get_city_pageviews, name, alt_names, wiki)
+                                             for name, alt_names, wiki in tqdm(zip(names, alt_names, wikis),
+                                                                               total=len(names)))
+    results = [merge_trace(t) for t in outputs]
 
     df_nodes['pageviews'] = results
 
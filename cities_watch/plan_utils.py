@@ -0,0 +1,183 @@
+"""
+Dry-run planner of urban_mapper runs: splits, pixels, model tile requests, earth-engine tasks, output size and run time
+of N countries x Y years, estimated from the cached country geometries (see geom_utils.split_feature) and from past
+runs. Nothing is submitted to earth-engine, nor read from the bucket: earth-engine is never initialized (no
+credentials or network needed).
+
+    python -m cities_watch.plan_utils --countries France India --years 2018 2019
+"""
+import argparse
+import glob
+import json
+import math
+import os
+
+import pandas as pd
+from shapely.geometry import shape
+
+from cities_watch import config
+from cities_watch.geom_utils import read_country_geometry, split_geometry
+
+M_PER_DEGREE = 111320.
+
+
+def split_pixels(geom, scale=config.SCALE):
+    """
+    Pixels at scale inside a split, and rows and columns of its bounding box (equirectangular approximation at the
+    mid-latitude of the split)
+    """
+    west, south, east, north = geom.bounds
+    cos_lat = math.cos(math.radians((south + north) / 2))
+    pixels = geom.area * (M_PER_DEGREE / scale) ** 2 * cos_lat
+    rows = max(math.ceil((north - south) * M_PER_DEGREE / scale), 1)
+    cols = max(math.ceil((east - west) * M_PER_DEGREE * cos_lat / scale), 1)
+    return int(round(pixels)), rows, cols
+
+
+def count_tiles(rows, cols, tile_size=config.INPUT_TILE_SIZE, overlap=config.INPUT_OVERLAP_SIZE):
+    # Model input tiles covering rows x cols pixels, as local_models.tile_origins
+    core = [s - 2 * o for s, o in zip(tile_size, overlap)]
+    return math.ceil(rows / core[0]) * math.ceil(cols / core[1])
+
+
+def load_calibration(summary_folder=config.SUMMARY_FOLDER, mirror_folder=config.MIRROR_FOLDER):
+    """
+    Rates measured on past runs, the defaults of config.py (PLAN_*) when there is nothing to measure them from:
+    - seconds_per_mpixel: run time of the completed shape exports of the run summaries (see
+      urban_mapper.refresh_run_summary) per million pixels of their split and year
+    - submit_seconds: mean time to build the graph of a task, from the run profiles
+    - bytes_per_mpixel: size of the exports mirrored in mirror_folder per million pixels of their split and year,
+      splits being found in the run summaries
+    """
+    task_seconds, task_mpixels = 0., 0.
+    splits = {}
+    for path in sorted(glob.glob(os.path.join(summary_folder, 'run_summary_*.json'))):
+        with open(path, 'r') as f:
+            summary = json.load(f)
+        for t in summary:
+            if 'aoi' not in t or 'feature_stack' in t:
+                continue
+            props = t['aoi']['properties']
+            mpixels = split_pixels(shape(t['aoi']))[0] / 1e6
+            splits[(f"{props['country_code_gaul']}_{props['iso3c']}", str(props['split_id']))] = mpixels
+            if t.get('state') == 'COMPLETED' and t.get('start_timestamp_ms') and t.get('update_timestamp_ms'):
+                task_seconds += (t['update_timestamp_ms'] - t['start_timestamp_ms']) / 1e3
+                task_mpixels += mpixels * len(t.get('years', [None]))
+
+    graph_seconds, n_graphs = 0., 0
+    for path in sorted(glob.glob(os.path.join(summary_folder, 'run_profile_*.json'))):
+        with open(path, 'r') as f:
+            span = json.load(f)['spans'].get('mapper.build_graph')
+        if span:
+            graph_seconds += span['total_s']
+            n_graphs += span['count']
+
+    # e.g. cities_shapes/85_FRA/2015-2016/predicted_shapes_3.geojson
+    out_bytes, out_mpixels = 0., 0.
+    for path in glob.glob(os.path.join(mirror_folder, config.FOLDER, '*', '*', f'{config.FILENAME}_*.geojson')):
+        years_folder = os.path.basename(os.path.dirname(path))
+        country = os.path.basename(os.path.dirname(os.path.dirname(path)))
+        split_id = os.path.splitext(os.path.basename(path))[0][len(config.FILENAME) + 1:]
+        if (country, split_id) in splits:
+            out_bytes += os.path.getsize(path)
+            out_mpixels += splits[(country, split_id)] * len(years_folder.split('-'))
+
+    return {'seconds_per_mpixel': task_seconds / task_mpixels if task_mpixels > 0 else config.PLAN_SECONDS_PER_MPIXEL,
+            'submit_seconds': graph_seconds / n_graphs if n_graphs > 0 else config.PLAN_SUBMIT_SECONDS,
+            'bytes_per_mpixel': out_bytes / out_mpixels if out_mpixels > 0 else config.PLAN_BYTES_PER_MPIXEL,
+            'calibrated_tasks': task_mpixels > 0, 'calibrated_profiles': n_graphs > 0,
+            'calibrated_outputs': out_mpixels > 0}
+
+
+def plan_country(aoi_meta, list_years, calibration, multi_year=config.MULTI_YEAR, cache_stacks=config.CACHE_STACKS,
+                 folder=config.COUNTRIES_FOLDER):
+    """
+    Workload of urban_mapper.main for a country, assuming none of its exports exist yet (UPDATE=True).
+    Countries without a cached geometry are reported with cached=False.
+    """
+    plan = {'country_name': aoi_meta['country_name'], 'cached': False}
+    f_geom = read_country_geometry(aoi_meta['country_na_LSIB'], folder=folder)
+    if f_geom is None:
+        return plan
+
+    n_years = len(list_years)
+    aois = split_geometry(f_geom, extra_props=aoi_meta)
+    pixels, bbox_pixels, tiles, max_mpixels = 0, 0, 0, 0.
+    for aoi in aois:
+        n_pixels, rows, cols = split_pixels(shape(aoi))
+        pixels += n_pixels
+        bbox_pixels += rows * cols
+        tiles += count_tiles(rows, cols)
+        max_mpixels = max(max_mpixels, n_pixels / 1e6)
+
+    mpixels = pixels / 1e6 * n_years
+    export_tasks = len(aois) * (1 if multi_year else n_years)
+    # Upper bound, stacks already exported are not checked
+    stack_tasks = len(aois) * n_years if cache_stacks else 0
+    plan.update({'cached': True,
+                 'splits': len(aois),
+                 'pixels': pixels * n_years,
+                 'bbox_pixels': bbox_pixels * n_years,
+                 'tiles': tiles * n_years,
+                 'export_tasks': export_tasks,
+                 'stack_tasks': stack_tasks,
+                 'output_mb': round(mpixels * calibration['bytes_per_mpixel'] / 2 ** 20, 1),
+                 'submit_s': round((export_tasks + stack_tasks) * calibration['submit_seconds'], 1),
+                 'task_s': round(mpixels * calibration['seconds_per_mpixel'], 1),
+                 'max_task_s': round(max_mpixels * (n_years if multi_year else 1)
+                                     * calibration['seconds_per_mpixel'], 1)})
+    return plan
+
+
+def plan_run(list_metas, list_years, multi_year=config.MULTI_YEAR, cache_stacks=config.CACHE_STACKS,
+             concurrent_tasks=config.PLAN_CONCURRENT_TASKS, calibration=None, folder=config.COUNTRIES_FOLDER):
+    """
+    Per-country workload of a run (see plan_country) with a total row. runtime_s is the expected wall time:
+    tasks are submitted one after the other, and run concurrent_tasks at a time once submitted.
+
+    :return: DataFrame of the plan, calibration used
+    """
+    calibration = calibration or load_calibration()
+    plans = [plan_country(t, list_years, calibration, multi_year=multi_year, cache_stacks=cache_stacks, folder=folder)
+             for t in list_metas]
+    cached = [t for t in plans if t['cached']]
+    if len(cached) > 0:
+        total = {k: sum(t[k] for t in cached) for k in cached[0] if k not in ['country_name', 'cached']}
+        total.update({'country_name': 'total', 'cached': len(cached) == len(plans),
+                      'max_task_s': max(t['max_task_s'] for t in cached)})
+        plans.append(total)
+    for t in plans:
+        if 'task_s' in t:
+            t['runtime_s'] = round(t['submit_s'] + max(t['task_s'] / concurrent_tasks, t['max_task_s']), 1)
+    return pd.DataFrame(plans), calibration
+
+
+def load_metas(countries=None):
+    # Registry of countries with metadata, as in urban_mapper
+    file_path = os.path.join(config.ROOT_DIR, 'data', 'references', 'un_countries_sampled.csv')
+    aois_metas = pd.read_csv(file_path).drop(['shape_area', 'status'], axis=1).to_dict('records')
+    if countries:
+        aois_metas = [pp for pp in aois_metas if pp['country_name'] in countries]
+    return aois_metas
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--countries', nargs='+', default=None, help='country names, all countries if not set')
+    parser.add_argument('--years', nargs='+', type=int, default=[2015, 2016, 2017, 2018, 2019])
+    parser.add_argument('--multi-year', action='store_true', default=config.MULTI_YEAR)
+    parser.add_argument('--cache-stacks', action='store_true', default=config.CACHE_STACKS)
+    parser.add_argument('--concurrent-tasks', type=int, default=config.PLAN_CONCURRENT_TASKS)
+    parser.add_argument('--out', default=None, help='CSV file to write the plan to')
+    args = parser.parse_args()
+
+    plan, used_calibration = plan_run(load_metas(args.countries), args.years, multi_year=args.multi_year,
+                                      cache_stacks=args.cache_stacks, concurrent_tasks=args.concurrent_tasks)
+    with pd.option_context('display.max_columns', None, 'display.width', 200):
+        print(plan.to_string(index=False))
+    print(f'Calibration: {used_calibration}')
+    missing = plan.loc[~plan['cached'].astype(bool), 'country_name'].tolist()
+    if missing:
+        print(f'No cached geometry for {missing}, run urban_mapper or urban_tagger.load_country_shape once to cache it')
+    if args.out:
+        plan.to_csv(args.out, index=False)
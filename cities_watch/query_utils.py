@@ -0,0 +1,216 @@
+import glob
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+from rtree import index
+from shapely import wkb
+from shapely.geometry import Point, box, mapping, shape
+from tqdm import tqdm
+
+from cities_watch import config
+
+STORE_FOLDER = os.path.join(config.CACHE_FOLDER, 'shape_store')
+ATTRIBUTES = ['id', 'name', 'area', 'rank']
+
+
+def _manifest(folder):
+    return {os.path.basename(t): os.path.getmtime(t) for t in sorted(glob.glob(os.path.join(folder, '*_*_*.json')))}
+
+
+def build_shape_store(folder=config.RESUlTS_FOLDER, store_folder=STORE_FOLDER, force=False, verbose=config.VERBOSE):
+    """
+    Read-only store of all the city shapes written by urban_tagger, rebuilt only when the result files change:
+    - geometries.bin: WKB geometries one after the other, read through a memory map, with offsets.npy
+    - attributes.csv: id, name, area, rank, country and year of each shape
+    - bounds.npy: bounding boxes, bulk loaded into an in-memory R-tree by ShapeStore
+    Files are streamed one by one, so that the build never holds all the shapes in memory.
+    """
+    os.makedirs(store_folder, exist_ok=True)
+    manifest_path = os.path.join(store_folder, 'manifest.json')
+    manifest = _manifest(folder)
+    if not force and os.path.exists(manifest_path) and os.path.exists(os.path.join(store_folder, 'bounds.npy')):
+        with open(manifest_path, 'r') as f:
+            if json.load(f) == manifest:
+                return store_folder
+
+    for name in ['manifest.json', 'bounds.npy']:
+        if os.path.exists(os.path.join(store_folder, name)):
+            os.remove(os.path.join(store_folder, name))
+
+    offsets, bounds, attributes = [0], [], []
+    with open(os.path.join(store_folder, 'geometries.bin'), 'wb') as f_geoms:
+        for file_name in tqdm(manifest, disable=not verbose):
+            gaul, iso3c, year = os.path.splitext(file_name)[0].split('_')
+            with open(os.path.join(folder, file_name), 'r') as f:
+                records = json.load(f)
+            for t in records:
+                geom = shape(json.loads(t['geometry']))
+                data = wkb.dumps(geom)
+                f_geoms.write(data)
+                offsets.append(offsets[-1] + len(data))
+                bounds.append(geom.bounds)
+                attributes.append([t.get(k) for k in ATTRIBUTES] + [int(gaul), iso3c, int(year)])
+
+    np.save(os.path.join(store_folder, 'offsets.npy'), np.array(offsets, dtype=np.int64))
+    pd.DataFrame(attributes, columns=ATTRIBUTES + ['country_code_gaul', 'iso3c', 'year']) \
+        .to_csv(os.path.join(store_folder, 'attributes.csv'), index=False)
+
+    np.save(os.path.join(store_folder, 'bounds.npy'), np.array(bounds, dtype=np.float64).reshape(-1, 4))
+
+    # Written last: an interrupted build is never reused
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+    return store_folder
+
+
+class ShapeStore:
+    """
+    Point, bounding box and attribute queries over the shape store (see build_shape_store).
+    Only the R-tree and the attributes are held in memory, geometries are decoded from the memory map on demand.
+    libspatialindex handles are not safe to share between threads: concurrent queries only take turns for the
+    in-memory R-tree lookup (microseconds), geometries are decoded and tested outside the lock.
+    """
+
+    def __init__(self, store_folder=STORE_FOLDER):
+        self.attributes = pd.read_csv(os.path.join(store_folder, 'attributes.csv'))
+        self.area = self.attributes['area'].values
+        self.year = self.attributes['year'].values
+        self.offsets = np.load(os.path.join(store_folder, 'offsets.npy'))
+        self.geometries = np.memmap(os.path.join(store_folder, 'geometries.bin'), dtype=np.uint8, mode='r')
+        bounds = np.load(os.path.join(store_folder, 'bounds.npy'))
+        # Bulk loading the R-tree from a stream is much faster than inserting the boxes one by one
+        self.rtree = index.Index(((i, tuple(b), None) for i, b in enumerate(bounds))) if len(bounds) else index.Index()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def geometry(self, i):
+        return wkb.loads(self.geometries[self.offsets[i]:self.offsets[i + 1]].tobytes())
+
+    def _candidates(self, bounds, year=None, min_area=None):
+        with self._lock:
+            idx = np.fromiter(self.rtree.intersection(bounds), dtype=np.int64)
+        mask = np.ones(len(idx), dtype=bool)
+        if year is not None:
+            mask &= self.year[idx] == int(year)
+        if min_area is not None:
+            mask &= self.area[idx] >= min_area
+        return idx[mask]
+
+    def records(self, idx, with_geometry=False):
+        # NaN is not valid JSON
+        df = self.attributes.iloc[idx].astype(object)
+        out = df.where(pd.notnull(df), None).to_dict('records')
+        if with_geometry:
+            for t, i in zip(out, idx):
+                t['geometry'] = mapping(self.geometry(i))
+        return out
+
+    def at_point(self, lon, lat, year=None, with_geometry=False):
+        """
+        Cities containing the point (one per year unless year is set)
+        """
+        point = Point(lon, lat)
+        idx = [i for i in self._candidates((lon, lat, lon, lat), year=year) if self.geometry(i).contains(point)]
+        return self.records(idx, with_geometry=with_geometry)
+
+    def in_bbox(self, west, south, east, north, year=None, min_area=None, top_k=None, exact=False,
+                with_geometry=False):
+        """
+        Cities intersecting the bounding box, largest first. Bounding boxes are compared unless exact.
+        """
+        idx = self._candidates((west, south, east, north), year=year, min_area=min_area)
+        idx = idx[np.argsort(-self.area[idx], kind='stable')]
+        if exact:
+            # Largest first, so that only the geometries needed for the top_k are decoded
+            bbox = box(west, south, east, north)
+            exact_idx = []
+            for i in idx:
+                if top_k is not None and len(exact_idx) >= top_k:
+                    break
+                if self.geometry(i).intersects(bbox):
+                    exact_idx.append(i)
+            idx = np.array(exact_idx, dtype=np.int64)
+        return self.records(idx[:top_k], with_geometry=with_geometry)
+
+    def select(self, year=None, min_area=None, iso3c=None, top_k=None, with_geometry=False):
+        """
+        Cities by attributes only, largest first
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if year is not None:
+            mask &= self.year == int(year)
+        if min_area is not None:
+            mask &= self.area >= min_area
+        if iso3c is not None:
+            mask &= (self.attributes['iso3c'] == iso3c).values
+        idx = np.nonzero(mask)[0]
+        idx = idx[np.argsort(-self.area[idx], kind='stable')][:top_k]
+        return self.records(idx, with_geometry=with_geometry)
+
+
+def _query_params(query):
+    params = {k: v[0] for k, v in parse_qs(query).items()}
+    out = {}
+    for k, v in params.items():
+        if k in ['year', 'top_k']:
+            out[k] = int(v)
+        elif k in ['lon', 'lat', 'west', 'south', 'east', 'north', 'min_area']:
+            out[k] = float(v)
+        elif k in ['exact', 'with_geometry']:
+            out[k] = v.lower() in ['1', 'true']
+        else:
+            out[k] = v
+    return out
+
+
+def make_server(store, host='127.0.0.1', port=8000):
+    """
+    Small read-only HTTP endpoint over a ShapeStore, answering JSON:
+    /point?lon=..&lat=..[&year=..], /bbox?west=..&south=..&east=..&north=..[&year=..&min_area=..&top_k=..]
+    and /select?[year=..&min_area=..&iso3c=..&top_k=..]
+    Bad parameters are answered with a 400, failed queries with a 500, both with an error message.
+    """
+    routes = {'/point': store.at_point, '/bbox': store.in_bbox, '/select': store.select}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path not in routes:
+                status, payload = 404, {'error': f'Unknown route {url.path}'}
+            else:
+                try:
+                    status, payload = 200, routes[url.path](**_query_params(url.query))
+                except (TypeError, ValueError) as e:
+                    status, payload = 400, {'error': str(e)}
+                except KeyError as e:
+                    status, payload = 400, {'error': f'Unknown field {e}'}
+                except Exception as e:
+                    status, payload = 500, {'error': f'{type(e).__name__}: {e}'}
+            body = json.dumps(payload, default=str).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+def serve(store, host='127.0.0.1', port=8000):
+    server = make_server(store, host=host, port=port)
+    print(f'Serving {len(store)} shapes on http://{host}:{port}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    serve(ShapeStore(build_shape_store()))
@@ -0,0 +1,148 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from cities_watch import config
+
+
+def stack_key(extra=None):
+    """
+    Short hash of the compositing parameters of a feature stack (cloud cover filter, night lights calibration range,
+    scale and bands), naming the cached stacks so that a change of parameters never reads a stale one
+    """
+    params = {'max_cloud_cover': config.MAX_CLOUD_COVER, 'common_range_ntl': config.COMMON_RANGE_NTL,
+              'scale': config.SCALE, 'ms_level': config.MS_LEVEL, 'ms_bands': config.MS_BANDS_CORRESPONDENCE,
+              'rgb_bands': config.RGB_bands, 'ndvi_bands': config.NDVI_bands,
+              'rad_collection': config.REF_RAD_COLLECTION, 'stack_bands': config.STACK_BANDS, 'extra': extra}
+    return hashlib.md5(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:12]
+
+
+def _sidecar_path(path):
+    return f"{os.path.splitext(path)[0]}.json"
+
+
+def is_geotiff(path):
+    return isinstance(path, str) and path.lower().endswith(('.tif', '.tiff'))
+
+
+def raster_profile(source, profile=None):
+    """
+    Profile of a raster: {'height', 'width', 'count', 'bands', 'transform', 'crs', 'nodata'}.
+    transform follows the earth-engine crsTransform (affine) order:
+    [x_scale, x_shear, x_origin, y_shear, y_scale, y_origin]
+
+    Supported sources:
+    - (bands, rows, cols) .npy arrays, memory-mapped, with their profile in a .json file with the same name
+    - GeoTIFF files (requires rasterio)
+    - numpy arrays, with the profile passed explicitly
+    """
+    if isinstance(source, np.ndarray):
+        if profile is None:
+            raise ValueError('A profile with the transform is required for in-memory arrays')
+        shape = source.shape if source.ndim == 3 else (1,) + source.shape
+        out = {'count': shape[0], 'height': shape[1], 'width': shape[2], 'crs': 'EPSG:4326', 'nodata': None}
+        out.update(profile)
+        out.setdefault('bands', [f'b{i}' for i in range(out['count'])])
+        return out
+
+    if is_geotiff(source):
+        import rasterio
+
+        with rasterio.open(source) as src:
+            return {'count': src.count, 'height': src.height, 'width': src.width,
+                    'bands': [t or f'b{i}' for i, t in enumerate(src.descriptions)],
+                    'transform': list(src.transform)[:6], 'crs': str(src.crs), 'nodata': src.nodata}
+
+    with open(_sidecar_path(source), 'r') as f:
+        out = json.load(f)
+    shape = np.load(source, mmap_mode='r').shape
+    out.update({'count': shape[0], 'height': shape[1], 'width': shape[2]})
+    return out
+
+
+def band_index(profile, band):
+    if isinstance(band, int):
+        return band
+    if band in profile['bands']:
+        return profile['bands'].index(band)
+    raise ValueError(f"Band {band} not found in {profile['bands']}")
+
+
+def read_window(source, window, bands=None):
+    """
+    Read a (row_off, col_off, height, width) window as a float32 (bands, height, width) array,
+    nodata values are converted to nan
+    """
+    row_off, col_off, height, width = window
+    if bands is not None and not isinstance(bands, (list, tuple)):
+        bands = [bands]
+
+    if is_geotiff(source):
+        import rasterio
+        from rasterio.windows import Window
+
+        with rasterio.open(source) as src:
+            indexes = [t + 1 for t in bands] if bands is not None else None
+            data = src.read(indexes=indexes, window=Window(col_off, row_off, width, height)).astype(np.float32)
+            nodata = src.nodata
+    else:
+        if isinstance(source, np.ndarray):
+            array = source if source.ndim == 3 else source[np.newaxis]
+            nodata = None
+        else:
+            array = np.load(source, mmap_mode='r')
+            nodata = raster_profile(source).get('nodata')
+        if bands is not None:
+            array = array[bands]
+        data = np.array(array[:, row_off:row_off + height, col_off:col_off + width], dtype=np.float32)
+
+    if nodata is not None and not np.isnan(nodata):
+        data[data == nodata] = np.nan
+    return data
+
+
+def create_raster(path, count, height, width, transform, bands=None, dtype=np.float32, crs='EPSG:4326',
+                  nodata=None, fill_value=None):
+    """
+    Create a memory-mapped (count, height, width) .npy raster with its .json profile, opened in read/write mode
+    """
+    array = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(count, height, width))
+    if fill_value is not None:
+        array[:] = fill_value
+    profile = {'bands': bands or [f'b{i}' for i in range(count)], 'transform': list(transform), 'crs': crs,
+               'nodata': nodata}
+    with open(_sidecar_path(path), 'w') as f:
+        json.dump(profile, f)
+    return array
+
+
+def iter_windows(height, width, block_size=config.BLOCK_SIZE):
+    """
+    Split a raster into (row_off, col_off, height, width) windows of at most block_size x block_size pixels
+    """
+    for row_off in range(0, height, block_size):
+        for col_off in range(0, width, block_size):
+            yield row_off, col_off, min(block_size, height - row_off), min(block_size, width - col_off)
+
+
+def pixel_to_coords(transform, rows, cols):
+    # Coordinates of the upper left corner of the pixels (rows, cols)
+    x_scale, x_shear, x_origin, y_shear, y_scale, y_origin = transform
+    return x_origin + cols * x_scale + rows * x_shear, y_origin + cols * y_shear + rows * y_scale
+
+
+def bounds_to_window(transform, bounds, height, width):
+    """
+    Smallest window of a north-up raster covering the (west, south, east, north) bounds, clipped to the raster
+    """
+    x_scale, _, x_origin, _, y_scale, y_origin = transform
+    west, south, east, north = bounds
+    col_0 = int(np.floor((west - x_origin) / x_scale))
+    col_1 = int(np.ceil((east - x_origin) / x_scale))
+    row_0 = int(np.floor((north - y_origin) / y_scale))
+    row_1 = int(np.ceil((south - y_origin) / y_scale))
+    col_0, col_1 = max(0, col_0), min(width, col_1)
+    row_0, row_1 = max(0, row_0), min(height, row_1)
+    return row_0, col_0, max(0, row_1 - row_0), max(0, col_1 - col_0)
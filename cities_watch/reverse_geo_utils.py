@@ -8,10 +8,13 @@ import pandas as pd
 import pyproj
 from joblib import Parallel, delayed
 from scipy.spatial import cKDTree
-from shapely.geometry import mapping
-from shapely.ops import transform
+from shapely.geometry import box, mapping
+from shapely.ops import nearest_points, transform
 from tqdm import tqdm
 
+from cities_watch import config
+from cities_watch.trace_utils import trace_span
+
 
 def ckdnearest(gd1, gd2, geom_field1='geometry', geom_field2='geometry'):
     # adapted from https://gis.stackexchange.com/questions/222315/geopandas-find-nearest-point-in-other-dataframe
@@ -24,6 +27,84 @@ def ckdnearest(gd1, gd2, geom_field1='geometry', geom_field2='geometry'):
     return gdf
 
 
+def to_unit_vectors(lon, lat):
+    # Points on the unit sphere, so that euclidean nearest neighbours are great-circle nearest neighbours
+    lon, lat = np.radians(lon), np.radians(lat)
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+def grid_cells(geometries, grid_size=config.GRID_SIZE):
+    """
+    Cells of about grid_size x grid_size meters covering the bounds of each geometry, generated for all geometries
+    at once
+
+    :return: index of the geometry of each cell, and cell bounds (n_cells, 4)
+    """
+    bounds = np.array([g.bounds for g in geometries]).reshape(-1, 4)
+    d_lat = grid_size / 111320.
+    d_lon = d_lat / np.cos(np.radians((bounds[:, 1] + bounds[:, 3]) / 2))
+    nx = np.maximum(np.ceil((bounds[:, 2] - bounds[:, 0]) / d_lon), 1).astype(int)
+    ny = np.maximum(np.ceil((bounds[:, 3] - bounds[:, 1]) / d_lat), 1).astype(int)
+
+    counts = nx * ny
+    owner = np.repeat(np.arange(len(bounds)), counts)
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    x0 = bounds[owner, 0] + (k % nx[owner]) * d_lon[owner]
+    y0 = bounds[owner, 1] + (k // nx[owner]) * d_lat
+    return owner, np.column_stack([x0, y0, x0 + d_lon[owner], y0 + d_lat])
+
+
+def grid_pieces(geometries, grid_size=config.GRID_SIZE):
+    """
+    Intersection of each geometry with its grid cells (cells inside the geometry are kept whole)
+
+    :return: index of the geometry, longitude and latitude of the centroid, and area (km2) of each piece
+    """
+    owner, cells = grid_cells(geometries, grid_size=grid_size)
+    df_cells = gpd.GeoDataFrame({'cell_owner': owner}, geometry=[box(*t) for t in cells])
+    df_shapes = gpd.GeoDataFrame({'shape': np.arange(len(geometries))}, geometry=list(geometries))
+
+    # cells inside their geometry are kept whole, without intersection
+    df_inside = gpd.sjoin(df_cells, df_shapes, op='within', how='inner')
+    inside = np.zeros(len(df_cells), dtype=bool)
+    inside[df_inside.index[df_inside['cell_owner'] == df_inside['shape']]] = True
+
+    # the others are cut along the border of their geometry
+    df_border = gpd.overlay(df_cells[~inside], df_shapes, how='intersection')
+    df_border = df_border[(df_border['cell_owner'] == df_border['shape']) & (df_border.area > 0)]
+
+    pieces = pd.concat([df_cells[inside], df_border[['cell_owner', 'geometry']]], ignore_index=True)
+    idx = pieces['cell_owner'].values.astype(int)
+    centroids = pieces.centroid
+    lon, lat = centroids.x.values, centroids.y.values
+    # degrees2 to km2
+    area = pieces.area.values * 111.32 ** 2 * np.cos(np.radians(lat))
+    return idx, lon, lat, area
+
+
+def tag_grid(df_cities, gdf_nodes, grid_size=config.GRID_SIZE):
+    """
+    Tag each city with the OSM nodes nearest to its grid cells, weighted by the area of the cells: large
+    agglomerations get all their constituent cities instead of the few nodes they contain.
+
+    :return: one row per (city, node) with the node properties and coverage, the fraction of the city area
+    """
+    idx, lon, lat, area = grid_pieces(list(df_cities['geometry']), grid_size=grid_size)
+    nodes_xy = np.array(list(gdf_nodes['geometry'].apply(lambda x: (x.x, x.y))))
+    btree = cKDTree(to_unit_vectors(nodes_xy[:, 0], nodes_xy[:, 1]))
+    _, nearest = btree.query(to_unit_vectors(lon, lat), k=1)
+
+    df_cover = pd.DataFrame({'city': idx, 'node': nearest, 'coverage': area}).groupby(['city', 'node']).sum()
+    df_cover['coverage'] /= df_cover.groupby(level='city')['coverage'].transform('sum')
+    df_cover = df_cover.reset_index()
+
+    df_grid = pd.concat([df_cities.iloc[df_cover['city'].values].reset_index(drop=True),
+                         gdf_nodes.iloc[df_cover['node'].values].drop(columns=['geometry']).reset_index(drop=True)],
+                        axis=1)
+    df_grid['coverage'] = df_cover['coverage'].round(4).values
+    return df_grid.sort_values(['index', 'coverage'], ascending=[True, False])
+
+
 def compute_area(geom, multiplier=1e6):
     geom_area = transform(
         partial(
@@ -38,19 +119,29 @@ def compute_area(geom, multiplier=1e6):
     return round(geom_area.area / multiplier, 3)
 
 
+def get_major_city(list_cities):
+    """
+    City giving its name to a shape: the node covering the largest part of the shape with the grid method (the most
+    pageviews on ties), the node with the most pageviews otherwise. First of the list on ties.
+    """
+    if any(t.get('coverage') for t in list_cities):
+        return max(list_cities, key=lambda i: (i.get('coverage') or 0, i.get('pageviews') or 0))
+    return max(list_cities, key=lambda i: i.get('pageviews') or 0)
+
+
 def form_new_city_record(idx, df_i, metadata=None, id_prefix=None):
     # Replace nan values by None
     df_i = df_i.where(pd.notnull(df_i), None)
     list_cities_i = df_i.drop(['index', 'geometry'], axis=1).to_dict('records')
     # drop None fields
     list_cities_i = [{u: v for u, v in t.items() if v} for t in list_cities_i]
-    major_city = sorted(list_cities_i, key=lambda i: i.get('pageviews') if i.get('pageviews') else 0,
-                        reverse=True)[0]
+    major_city = get_major_city(list_cities_i)
     geom = df_i['geometry'].values[0]
     new_record = {'geometry': json.dumps(mapping(geom)),
                   'cities': list_cities_i,
                   'area': compute_area(geom)}
-    new_record.update(major_city)
+    # coverage stays in cities, records keep the fields of the table schema
+    new_record.update({k: v for k, v in major_city.items() if k != 'coverage'})
     if metadata:
         new_record.update(metadata)
     # add uid
@@ -72,14 +163,116 @@ def add_city_ranking(all_records):
     return df.to_dict(orient='records')
 
 
-def tag_nodes_to_shapes(df_nodes, city_geometries, metadata=None, add_ranks=True):
-    # convert to geo-DataFrames
-    gdf_nodes = gpd.GeoDataFrame(df_nodes)
+def tag_cities(gdf_nodes, city_geometries, tag_method=config.TAG_METHOD, grid_size=config.GRID_SIZE):
+    # One row per (city, node), index is the position of the city in city_geometries
     df_cities = gpd.GeoDataFrame(city_geometries, columns=['geometry'])
     df_cities.reset_index(inplace=True)
 
+    if tag_method == 'grid':
+        with trace_span('tag.grid'):
+            df_cities_tagged = tag_grid(df_cities, gdf_nodes.reset_index(drop=True), grid_size=grid_size)
+        df_cities_tagged['tag_method'] = 'grid'
+    else:
+        df_cities_tagged = tag_contain_nearest(df_cities, gdf_nodes)
+    return df_cities_tagged
+
+
+def tag_nodes_to_shapes(df_nodes, city_geometries, metadata=None, add_ranks=True, tag_method=config.TAG_METHOD,
+                        grid_size=config.GRID_SIZE, n_jobs=None):
+    # convert to geo-DataFrames
+    gdf_nodes = gpd.GeoDataFrame(df_nodes)
+    df_cities_tagged = tag_cities(gdf_nodes, city_geometries, tag_method=tag_method, grid_size=grid_size)
+
+    # post-process to get the final results
+    num_cores = n_jobs or multiprocessing.cpu_count()
+    # set prefix of uid of a record
+    id_prefix = f"{metadata['country_code_gaul']}_{metadata['iso3c']}_{metadata['year']}"
+    with trace_span('tag.records'):
+        all_records = Parallel(n_jobs=num_cores)(delayed(form_new_city_record)(idx, df_i, metadata, id_prefix)
+                                                 for idx, df_i in tqdm(df_cities_tagged.groupby(['index']),
+                                                                       total=len(df_cities_tagged['index'].unique())))
+
+    if add_ranks:
+        with trace_span('tag.ranking'):
+            all_records = add_city_ranking(all_records)
+
+    return all_records
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    # great-circle distance in km
+    lon1, lat1, lon2, lat2 = map(np.radians, [lon1, lat1, lon2, lat2])
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371.0088 * np.arcsin(np.sqrt(a))
+
+
+def link_distance(geom, point):
+    # km between a node and the closest point of a shape, 0 when the shape contains it
+    if geom.contains(point):
+        return 0.
+    closest = nearest_points(geom, point)[0]
+    return round(float(haversine(point.x, point.y, closest.x, closest.y)), 3)
+
+
+def form_shape_record(idx, df_i, metadata=None, id_prefix=None):
+    """
+    Normalized version of form_new_city_record: the shape record only holds the node_id of its major city, and each
+    city is a link (shape_id, node_id, tag_method, distance, coverage for the grid method)
+
+    :return: shape record and its links
+    """
+    df_i = df_i.where(pd.notnull(df_i), None)
+    geom = df_i['geometry'].values[0]
+    shape_id = f"{id_prefix}_{idx}" if id_prefix else idx
+    list_cities_i = df_i.to_dict('records')
+    major_city = get_major_city(list_cities_i)
+    record = {'id': shape_id,
+              'geometry': json.dumps(mapping(geom)),
+              'area': compute_area(geom),
+              'node_id': major_city['node_id']}
+    if metadata:
+        record.update(metadata)
+    links = [{'shape_id': shape_id,
+              'node_id': t['node_id'],
+              'tag_method': t['tag_method'],
+              'distance': link_distance(geom, t['node_geometry']),
+              'coverage': t.get('coverage')} for t in list_cities_i]
+    return record, links
+
+
+def tag_nodes_to_tables(df_nodes, city_geometries, metadata=None, add_ranks=True, tag_method=config.TAG_METHOD,
+                        grid_size=config.GRID_SIZE, n_jobs=None):
+    """
+    Same tagging as tag_nodes_to_shapes, without repeating the properties of the nodes in the records (see
+    normalize_utils for the nodes table and to rebuild the records)
+
+    :return: dict of the shapes and links tables (lists of records)
+    """
+    gdf_nodes = gpd.GeoDataFrame(df_nodes)
+    df_cities_tagged = tag_cities(gdf_nodes, city_geometries, tag_method=tag_method, grid_size=grid_size)
+    node_geometries = dict(zip(gdf_nodes['node_id'], gdf_nodes['geometry']))
+    df_cities_tagged['node_geometry'] = df_cities_tagged['node_id'].map(node_geometries)
+
+    num_cores = n_jobs or multiprocessing.cpu_count()
+    id_prefix = f"{metadata['country_code_gaul']}_{metadata['iso3c']}_{metadata['year']}"
+    with trace_span('tag.records'):
+        results = Parallel(n_jobs=num_cores)(delayed(form_shape_record)(idx, df_i, metadata, id_prefix)
+                                             for idx, df_i in tqdm(df_cities_tagged.groupby(['index']),
+                                                                   total=len(df_cities_tagged['index'].unique())))
+    shapes = [t[0] for t in results]
+    links = [u for t in results for u in t[1]]
+
+    if add_ranks:
+        with trace_span('tag.ranking'):
+            shapes = add_city_ranking(shapes)
+
+    return {'shapes': shapes, 'links': links}
+
+
+def tag_contain_nearest(df_cities, gdf_nodes):
     # get first all cities containing OSM nodes
-    df_contained = gpd.sjoin(df_cities, gdf_nodes, op='contains', how='inner').drop(['index_right'], axis=1)
+    with trace_span('tag.sjoin'):
+        df_contained = gpd.sjoin(df_cities, gdf_nodes, op='contains', how='inner').drop(['index_right'], axis=1)
     df_contained['tag_method'] = 'contain'
 
     # get all cities near OSM node but not containing one
@@ -87,21 +280,11 @@ def tag_nodes_to_shapes(df_nodes, city_geometries, metadata=None, add_ranks=True
     df_closest['centroid'] = df_closest['geometry'].apply(lambda x: x.centroid)
     gdf_nodes_c = gdf_nodes.copy()
     gdf_nodes_c['node_geometry'] = gdf_nodes_c['geometry']
-    df_closest = ckdnearest(df_closest, gdf_nodes_c, geom_field1='centroid')
+    with trace_span('tag.nearest'):
+        df_closest = ckdnearest(df_closest, gdf_nodes_c, geom_field1='centroid')
     df_closest['tag_method'] = 'nearest'
 
     # concatenate the results
     df_cities_tagged = pd.concat([df_contained, df_closest[df_contained.columns]], axis=0)
 
-    # post-process to get the final results
-    num_cores = multiprocessing.cpu_count()
-    # set prefix of uid of a record
-    id_prefix = f"{metadata['country_code_gaul']}_{metadata['iso3c']}_{metadata['year']}"
-    all_records = Parallel(n_jobs=num_cores)(delayed(form_new_city_record)(idx, df_i, metadata, id_prefix)
-                                             for idx, df_i in tqdm(df_cities_tagged.groupby(['index']),
-                                                                   total=len(df_cities_tagged['index'].unique())))
-
-    if add_ranks:
-        all_records = add_city_ranking(all_records)
-
-    return all_records
+    return df_cities_tagged
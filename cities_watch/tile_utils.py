@@ -0,0 +1,362 @@
+import glob
+import gzip
+import json
+import multiprocessing
+import os
+import sqlite3
+import struct
+
+import numpy as np
+from joblib import Parallel, delayed
+from shapely.geometry import Polygon, box, shape
+from shapely.ops import transform
+from shapely.strtree import STRtree
+from tqdm import tqdm
+
+from cities_watch import config
+
+EARTH_RADIUS = 6378137.
+ORIGIN = np.pi * EARTH_RADIUS
+MAX_LATITUDE = 85.0511287798
+LAYER_NAME = 'cities'
+PROPERTIES = ['id', 'name', 'area', 'rank']
+
+
+def to_mercator(lon, lat):
+    # Web Mercator (EPSG:3857) meters
+    lat = np.clip(np.asarray(lat, dtype=float), -MAX_LATITUDE, MAX_LATITUDE)
+    return EARTH_RADIUS * np.radians(lon), EARTH_RADIUS * np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+
+
+def tile_bounds(z, x, y):
+    # Mercator bounds of a XYZ tile (y from the north)
+    size = 2 * ORIGIN / 2 ** z
+    return -ORIGIN + x * size, ORIGIN - (y + 1) * size, -ORIGIN + (x + 1) * size, ORIGIN - y * size
+
+
+def tile_range(bounds, z, buffer=0.):
+    """
+    Range of the XYZ tiles of zoom z covering mercator bounds, buffer is a fraction of the tile size
+
+    :return: x_min, y_min, x_max, y_max (inclusive)
+    """
+    size = 2 * ORIGIN / 2 ** z
+    x0, x1 = np.floor((bounds[0] + ORIGIN) / size - buffer), np.floor((bounds[2] + ORIGIN) / size + buffer)
+    y0, y1 = np.floor((ORIGIN - bounds[3]) / size - buffer), np.floor((ORIGIN - bounds[1]) / size + buffer)
+    return tuple(int(np.clip(t, 0, 2 ** z - 1)) for t in [x0, y0, x1, y1])
+
+
+def covered_tiles(geom, zooms, buffer=0.):
+    for z in zooms:
+        x0, y0, x1, y1 = tile_range(geom.bounds, z, buffer=buffer)
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                yield z, x, y
+
+
+def _varint(n):
+    out = bytearray()
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _zigzag(n):
+    return (n << 1) ^ (n >> 63)
+
+
+def _key(number, wire_type):
+    return _varint(number << 3 | wire_type)
+
+
+def _message(number, data):
+    return _key(number, 2) + _varint(len(data)) + data
+
+
+def _packed(number, values):
+    return _message(number, b''.join(_varint(v) for v in values))
+
+
+def _value(v):
+    # vector_tile.proto Value: string (1), double (3), sint (6), bool (7)
+    if isinstance(v, (bool, np.bool_)):
+        return _key(7, 0) + _varint(int(v))
+    if isinstance(v, (int, np.integer)):
+        return _key(6, 0) + _varint(_zigzag(int(v)))
+    if isinstance(v, (float, np.floating)):
+        return _key(3, 1) + struct.pack('<d', v)
+    return _message(1, str(v).encode('utf-8'))
+
+
+def _tile_rings(polygon, x0, y1, scale):
+    """
+    Rings of a polygon in integer tile coordinates (y down), without repeated points. Exterior rings have a positive
+    surveyor's area and interior rings a negative one, as required by the MVT spec. Rings collapsed by the
+    quantization are dropped (with their holes for exterior rings).
+    """
+    rings = []
+    for k, ring in enumerate([polygon.exterior] + list(polygon.interiors)):
+        xy = np.asarray(ring.coords)[:-1]
+        pts = np.column_stack([np.round((xy[:, 0] - x0) * scale), np.round((y1 - xy[:, 1]) * scale)]).astype(np.int64)
+        pts = pts[np.any(pts != np.roll(pts, 1, axis=0), axis=1)]
+        area = (pts[:, 0] * np.roll(pts[:, 1], -1) - np.roll(pts[:, 0], -1) * pts[:, 1]).sum() if len(pts) >= 3 else 0
+        if area == 0:
+            if k == 0:
+                return []
+            continue
+        rings.append(pts if (area > 0) == (k == 0) else pts[::-1])
+    return rings
+
+
+def _ring_commands(pts, cursor):
+    # MoveTo the first point, LineTo the others and ClosePath, with zigzag-encoded deltas from the cursor
+    deltas = np.diff(np.vstack([cursor, pts]), axis=0)
+    cursor[:] = pts[-1]
+    commands = [1 | 1 << 3, _zigzag(int(deltas[0, 0])), _zigzag(int(deltas[0, 1])), 2 | (len(pts) - 1) << 3]
+    for dx, dy in deltas[1:]:
+        commands += [_zigzag(int(dx)), _zigzag(int(dy))]
+    return commands + [7 | 1 << 3]
+
+
+def _polygons(geom):
+    if isinstance(geom, Polygon):
+        return [] if geom.is_empty else [geom]
+    # Multi-polygons, or geometry collections left by the clipping
+    return [t for part in getattr(geom, 'geoms', []) for t in _polygons(part)]
+
+
+def encode_tile(features, z, x, y, extent=config.TILE_EXTENT, buffer=config.TILE_BUFFER, min_pixels=1.):
+    """
+    Mapbox Vector Tile (spec v2) of the features, with a single polygon layer.
+    Geometries are clipped to the tile and its buffer, and simplified with a tolerance of one tile unit, so that the
+    generalization follows the zoom. Shapes smaller than min_pixels tile units are dropped.
+
+    :param features: list of (properties, mercator geometry)
+    :return: tile bytes, None if the tile is empty
+    """
+    x0, y0, x1, y1 = tile_bounds(z, x, y)
+    scale = extent / (x1 - x0)
+    pad = buffer / scale
+    clip = box(x0 - pad, y0 - pad, x1 + pad, y1 + pad)
+
+    keys, values, encoded = {}, {}, []
+    for properties, geom in features:
+        if geom.area * scale ** 2 < min_pixels or not clip.intersects(geom):
+            continue
+        if not clip.contains(geom):
+            geom = geom.intersection(clip)
+        geom = geom.simplify(1 / scale, preserve_topology=True)
+
+        cursor = np.zeros(2, dtype=np.int64)
+        geometry = [c for p in _polygons(geom) for ring in _tile_rings(p, x0, y1, scale)
+                    for c in _ring_commands(ring, cursor)]
+        if len(geometry) == 0:
+            continue
+        tags = []
+        for k, v in properties.items():
+            if v is not None:
+                tags += [keys.setdefault(k, len(keys)), values.setdefault((type(v).__name__, v), len(values))]
+        # Feature: tags (2), type (3) = POLYGON, geometry (4)
+        encoded.append(_message(2, _packed(2, tags) + _key(3, 0) + _varint(3) + _packed(4, geometry)))
+
+    if len(encoded) == 0:
+        return None
+    # Layer: version (15), name (1), features (2), keys (3), values (4), extent (5)
+    layer = _key(15, 0) + _varint(2) + _message(1, LAYER_NAME.encode('utf-8')) + b''.join(encoded)
+    layer += b''.join(_message(3, k.encode('utf-8')) for k in keys)
+    layer += b''.join(_message(4, _value(v)) for _, v in values)
+    layer += _key(5, 0) + _varint(extent)
+    return _message(3, layer)
+
+
+def load_features(file_path):
+    """
+    (properties, mercator geometry) of the city shapes of a result file written by urban_tagger
+    """
+    gaul, iso3c, year = os.path.splitext(os.path.basename(file_path))[0].split('_')
+    with open(file_path, 'r') as f:
+        records = json.load(f)
+    features = []
+    for t in records:
+        geom = shape(json.loads(t['geometry']))
+        if not geom.is_valid:
+            geom = geom.buffer(0)
+        properties = {k: t.get(k) for k in PROPERTIES}
+        properties.update({'country_code_gaul': int(gaul), 'iso3c': iso3c, 'year': int(year)})
+        features.append((properties, transform(to_mercator, geom)))
+    return features
+
+
+def _encode_batch(tiles, features, extent, buffer, min_pixels):
+    geoms = [t[1] for t in features]
+    tree = STRtree(geoms) if geoms else None
+    index_by_id = {id(g): i for i, g in enumerate(geoms)}
+
+    out = []
+    for z, x, y in tiles:
+        pad = buffer / extent * 2 * ORIGIN / 2 ** z
+        x0, y0, x1, y1 = tile_bounds(z, x, y)
+        candidates = sorted(index_by_id[id(g)] for g in tree.query(box(x0 - pad, y0 - pad, x1 + pad, y1 + pad))) \
+            if tree else []
+        data = encode_tile([features[i] for i in candidates], z, x, y, extent=extent, buffer=buffer,
+                           min_pixels=min_pixels)
+        out.append((z, x, y, gzip.compress(data) if data else None))
+    return out
+
+
+def open_mbtiles(path):
+    """
+    MBTiles archive (sqlite), with the tables sources and source_tiles recording the result files used for the
+    tiles, and the XYZ tiles covered by each file
+    """
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB);
+        CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row);
+        CREATE TABLE IF NOT EXISTS sources (file TEXT PRIMARY KEY, mtime REAL);
+        CREATE TABLE IF NOT EXISTS source_tiles (file TEXT, z INTEGER, x INTEGER, y INTEGER);
+        CREATE INDEX IF NOT EXISTS source_tiles_file ON source_tiles (file);
+        CREATE INDEX IF NOT EXISTS source_tiles_tile ON source_tiles (z, x, y);
+    """)
+    return conn
+
+
+def read_tile(path, z, x, y):
+    # Decompressed MVT bytes of a XYZ tile, None if the tile is empty
+    conn = sqlite3.connect(path)
+    row = conn.execute('SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                       (z, x, 2 ** z - 1 - y)).fetchone()
+    conn.close()
+    return gzip.decompress(row[0]) if row else None
+
+
+def _batches(tiles, n_batches):
+    # Tiles of the same zoom, contiguous in x then y, so that each batch only needs the features of a strip
+    batches = []
+    for z in sorted({t[0] for t in tiles}):
+        tiles_z = sorted(t for t in tiles if t[0] == z)
+        size = max(1, -(-len(tiles_z) // n_batches))
+        batches += [tiles_z[i:i + size] for i in range(0, len(tiles_z), size)]
+    return batches
+
+
+def _update_tiles(conn, year, folder, min_zoom, max_zoom, extent, buffer, min_pixels, n_jobs, verbose):
+    # Tiles of the files added, changed or removed since the last build (see build_tiles)
+    zooms = range(min_zoom, max_zoom + 1)
+    params = json.dumps({'minzoom': min_zoom, 'maxzoom': max_zoom, 'extent': extent, 'buffer': buffer,
+                         'min_pixels': min_pixels})
+    row = conn.execute("SELECT value FROM metadata WHERE name='build_params'").fetchone()
+    # New parameters: all the tiles are re-encoded, the archive is reset when they are written
+    reset = row is None or row[0] != params
+
+    files = {os.path.basename(t): os.path.getmtime(t) for t in glob.glob(os.path.join(folder, f'*_*_{year}.json'))}
+    sources = {} if reset else dict(conn.execute('SELECT file, mtime FROM sources'))
+    changed = sorted(t for t, mtime in files.items() if sources.get(t) != mtime)
+    removed = sorted(t for t in sources if t not in files)
+    if not reset and len(changed) == 0 and len(removed) == 0:
+        return
+
+    n_jobs = n_jobs or multiprocessing.cpu_count()
+    features = dict(zip(changed, Parallel(n_jobs=n_jobs)(delayed(load_features)(os.path.join(folder, t))
+                                                         for t in tqdm(changed, disable=not verbose))))
+    source_tiles = {t: {tile for _, geom in features[t] for tile in covered_tiles(geom, zooms, buffer / extent)}
+                    for t in changed}
+
+    # Tiles covered by the changed files, before and after the change
+    affected = set().union(*source_tiles.values())
+    for t in ([] if reset else changed + removed):
+        affected.update(conn.execute('SELECT z, x, y FROM source_tiles WHERE file=?', (t,)))
+
+    # Unchanged files covering these tiles are needed to re-encode them
+    conn.execute('CREATE TEMP TABLE affected (z INTEGER, x INTEGER, y INTEGER)')
+    conn.executemany('INSERT INTO affected VALUES (?, ?, ?)', affected)
+    others = [t for t, in conn.execute('SELECT DISTINCT s.file FROM source_tiles s JOIN affected a '
+                                       'ON s.z = a.z AND s.x = a.x AND s.y = a.y')
+              if t in files and t not in features]
+    features.update(zip(others, Parallel(n_jobs=n_jobs)(delayed(load_features)(os.path.join(folder, t))
+                                                        for t in others)))
+    # Sorted by file, so that incremental and full builds encode the features of a tile in the same order
+    all_features = [t for file_name in sorted(features) for t in features[file_name]]
+
+    # Each batch is sent with the features intersecting its tiles only
+    geoms = [t[1] for t in all_features]
+    tree = STRtree(geoms) if geoms else None
+    index_by_id = {id(g): i for i, g in enumerate(geoms)}
+    batches = _batches(affected, 4 * n_jobs)
+    batch_features = []
+    for batch in batches:
+        bounds = np.array([tile_bounds(*t) for t in batch])
+        pad = buffer / extent * 2 * ORIGIN / 2 ** batch[0][0]
+        bbox = box(bounds[:, 0].min() - pad, bounds[:, 1].min() - pad, bounds[:, 2].max() + pad,
+                   bounds[:, 3].max() + pad)
+        batch_features.append([all_features[i] for i in sorted(index_by_id[id(g)] for g in tree.query(bbox))]
+                              if tree else [])
+
+    if verbose:
+        print(f'Encoding {len(affected)} tile(s) of {year} from {len(features)} file(s) ...')
+    results = Parallel(n_jobs=n_jobs)(delayed(_encode_batch)(batch, batch_features[i], extent, buffer, min_pixels)
+                                      for i, batch in enumerate(tqdm(batches, disable=not verbose)))
+
+    with conn:
+        if reset:
+            for table in ['tiles', 'sources', 'source_tiles']:
+                conn.execute(f'DELETE FROM {table}')
+        for z, x, y, data in (t for batch in results for t in batch):
+            # MBTiles rows are TMS (y from the south)
+            if data is None:
+                conn.execute('DELETE FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                             (z, x, 2 ** z - 1 - y))
+            else:
+                conn.execute('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)', (z, x, 2 ** z - 1 - y, data))
+        conn.executemany('DELETE FROM source_tiles WHERE file=?', [(t,) for t in changed + removed])
+        conn.executemany('DELETE FROM sources WHERE file=?', [(t,) for t in removed])
+        conn.executemany('INSERT OR REPLACE INTO sources VALUES (?, ?)', [(t, files[t]) for t in changed])
+        conn.executemany('INSERT INTO source_tiles VALUES (?, ?, ?, ?)',
+                         [(t,) + tile for t in changed for tile in source_tiles[t]])
+        fields = {k: 'String' if k in ['id', 'name', 'iso3c'] else 'Number'
+                  for k in PROPERTIES + ['country_code_gaul', 'iso3c', 'year']}
+        metadata = {'name': f'cities_{year}', 'format': 'pbf', 'type': 'overlay', 'minzoom': min_zoom,
+                    'maxzoom': max_zoom, 'bounds': f'-180,{-MAX_LATITUDE},180,{MAX_LATITUDE}',
+                    'json': json.dumps({'vector_layers': [{'id': LAYER_NAME, 'fields': fields,
+                                                           'minzoom': min_zoom, 'maxzoom': max_zoom}]}),
+                    'build_params': params}
+        conn.executemany('INSERT OR REPLACE INTO metadata VALUES (?, ?)', [(k, str(v)) for k, v in metadata.items()])
+
+
+def build_tiles(year, folder=config.RESUlTS_FOLDER, tiles_folder=config.TILES_FOLDER, min_zoom=config.TILE_MIN_ZOOM,
+                max_zoom=config.TILE_MAX_ZOOM, extent=config.TILE_EXTENT, buffer=config.TILE_BUFFER, min_pixels=1.,
+                n_jobs=None, verbose=config.VERBOSE):
+    """
+    Vector tiles (MVT, zoom levels min_zoom to max_zoom) of the city shapes of all countries for a year, stored in
+    tiles_folder/cities_<year>.mbtiles.
+    Builds are incremental: only the tiles covered by the result files added, changed (modification time) or
+    removed since the last build are re-encoded, from all the files covering them. Tiles are encoded in a process
+    pool and written in a single transaction, so an interrupted build leaves the previous tiles untouched. A change
+    of the build parameters re-encodes all the tiles, and the previous ones are dropped in the same transaction.
+
+    :return: path of the archive
+    """
+    path = os.path.join(tiles_folder, f'cities_{year}.mbtiles')
+    conn = open_mbtiles(path)
+    try:
+        _update_tiles(conn, year, folder, min_zoom, max_zoom, extent, buffer, min_pixels, n_jobs, verbose)
+    finally:
+        # An interrupted build must not keep a read lock on the archive
+        conn.close()
+    return path
+
+
+def build_all_tiles(folder=config.RESUlTS_FOLDER, years=None, **kwargs):
+    """
+    Incremental tile build of every year found in the results folder (or the requested years)
+    """
+    years = years or sorted({int(os.path.splitext(t)[0].split('_')[-1])
+                             for t in glob.glob(os.path.join(folder, '*_*_*.json'))})
+    return [build_tiles(year, folder=folder, **kwargs) for year in years]
+
+
+if __name__ == '__main__':
+    build_all_tiles()
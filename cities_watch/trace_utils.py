@@ -0,0 +1,191 @@
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from functools import wraps
+
+from cities_watch import config
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+_state = {'enabled': config.TRACE, 'start': time.time()}
+_lock = threading.Lock()
+_spans = defaultdict(lambda: [0, 0., 0.])  # name -> [count, total time, max time]
+_counters = defaultdict(float)
+
+
+class _NullSpan:
+    # Shared no-op context manager returned when tracing is disabled
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        with _lock:
+            stats = _spans[self.name]
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+        return False
+
+
+def is_tracing():
+    return _state['enabled']
+
+
+def enable_tracing(enabled=True, reset=True):
+    _state['enabled'] = enabled
+    if reset:
+        reset_tracing()
+
+
+def reset_tracing():
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+        _state['start'] = time.time()
+
+
+def trace_span(name):
+    """
+    Context manager timing a block of code, aggregated by name (count, total and max durations)
+    """
+    if not _state['enabled']:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def trace_count(name, value=1):
+    """
+    Increment a counter, e.g. number of remote calls or bytes transferred
+    """
+    if not _state['enabled']:
+        return
+    with _lock:
+        _counters[name] += value
+
+
+def traced(name):
+    """
+    Decorator version of trace_span
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _state['enabled']:
+                return func(*args, **kwargs)
+            with _Span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def worker_state():
+    # Tracing state of the parent, passed to run_traced
+    return {'enabled': _state['enabled'], 'pid': os.getpid()}
+
+
+def run_traced(state, func, *args, **kwargs):
+    """
+    Run func in a joblib or process pool worker with the tracing state of the parent (see worker_state).
+    Spans and counters of a worker process are lost with it, they are returned along with the result instead:
+
+        outputs = Parallel(n_jobs=n_jobs)(delayed(run_traced)(worker_state(), func, t) for t in items)
+        results = [merge_trace(t) for t in outputs]
+
+    :return: result, trace recorded by the call (None when run in the parent process, where it is already recorded)
+    """
+    if not state['enabled'] or os.getpid() == state['pid']:
+        return func(*args, **kwargs), None
+
+    # Workers run one call at a time, their own spans and counters are never reported otherwise
+    enabled = _state['enabled']
+    enable_tracing(True)
+    try:
+        result = func(*args, **kwargs)
+        with _lock:
+            trace = {'spans': {k: list(v) for k, v in _spans.items()}, 'counters': dict(_counters)}
+    finally:
+        enable_tracing(enabled)
+    return result, trace
+
+
+def merge_trace(output):
+    """
+    Add the trace of a run_traced output to the spans and counters of the current process
+
+    :return: result of the call
+    """
+    result, trace = output
+    if trace is not None:
+        with _lock:
+            for name, (count, total, longest) in trace['spans'].items():
+                stats = _spans[name]
+                stats[0] += count
+                stats[1] += total
+                stats[2] = max(stats[2], longest)
+            for name, value in trace['counters'].items():
+                _counters[name] += value
+    return result
+
+
+def peak_rss_mb(children=False):
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, kilobytes on Linux
+    return usage / 2 ** 20 if sys.platform == 'darwin' else usage / 2 ** 10
+
+
+def get_profile():
+    with _lock:
+        spans = {k: {'count': v[0], 'total_s': round(v[1], 6), 'mean_s': round(v[1] / v[0], 6) if v[0] else 0.,
+                     'max_s': round(v[2], 6)}
+                 for k, v in sorted(_spans.items(), key=lambda x: -x[1][1])}
+        counters = dict(sorted(_counters.items()))
+
+    return {'start_timestamp': _state['start'],
+            'duration_s': round(time.time() - _state['start'], 6),
+            'spans': spans,
+            'counters': counters,
+            'peak_rss_mb': peak_rss_mb(),
+            'peak_rss_children_mb': peak_rss_mb(children=True)}
+
+
+def write_profile(file_name, folder=config.SUMMARY_FOLDER, verbose=config.VERBOSE):
+    """
+    Write the profile of the run as JSON. Spans and counters of worker processes are only included for the calls
+    made through run_traced, other work done inside workers is covered by the span wrapping the parallel call.
+    """
+    if not _state['enabled']:
+        return None
+
+    file_path = os.path.join(folder, file_name)
+    with open(file_path, 'w') as f:
+        json.dump(get_profile(), f, indent=2)
+    if verbose:
+        print(f'Run profile written at {file_path}')
+    return file_path
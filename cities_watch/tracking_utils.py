@@ -0,0 +1,123 @@
+import glob
+import json
+import multiprocessing
+import os
+
+import pandas as pd
+from joblib import Parallel, delayed
+from shapely.geometry import shape
+from shapely.strtree import STRtree
+from tqdm import tqdm
+
+from cities_watch import config
+from cities_watch.zipf_utils import GROUP_COLS, load_results
+
+
+def load_country_shapes(country_code_gaul, iso3c, folder=config.RESUlTS_FOLDER):
+    """
+    Shapes of all the years available for a country in the results written by urban_tagger
+    """
+    df = load_results(folder, columns=('id', 'area', 'geometry'), pattern=f'{country_code_gaul}_{iso3c}_*.json',
+                      n_jobs=1)
+    df['geometry'] = df['geometry'].apply(lambda t: shape(json.loads(t)))
+    return df
+
+
+def overlap_links(previous, current, min_overlap=0.):
+    """
+    Pairs of overlapping shapes between two sets of geometries, using an STRtree over the current shapes so that
+    only candidates with intersecting bounding boxes are compared.
+
+    :param min_overlap: minimum intersection area, as a fraction of the smaller shape
+    :return: list of (index in previous, index in current, intersection area)
+    """
+    if len(previous) == 0 or len(current) == 0:
+        return []
+    tree = STRtree(current)
+    index_by_id = {id(g): i for i, g in enumerate(current)}
+
+    links = []
+    for i, geom in enumerate(previous):
+        for candidate in tree.query(geom):
+            overlap = geom.intersection(candidate).area
+            if overlap > 0 and overlap >= min_overlap * min(geom.area, candidate.area):
+                links.append((i, index_by_id[id(candidate)], overlap))
+    return links
+
+
+def track_cities(df_shapes, min_overlap=0., max_gap=1):
+    """
+    Stable city ids across years. Shapes of each year are linked to the overlapping shapes of the cities seen
+    in the previous max_gap years, and links are matched greedily by decreasing overlap:
+    - a shape continues the city of its largest matched overlap
+    - when a city splits, the other overlapping shapes start new cities (split event)
+    - when cities merge, the city with the largest overlap continues and the others end (merge event)
+    City ids are the id of their first shape.
+
+    :param df_shapes: shapes with columns id, year, area and geometry (shapely), e.g. from load_country_shapes
+    :return: tracks (one row per shape with its city_id) and events (year, event, city_id, other_id)
+    """
+    df_shapes = df_shapes.sort_values('year').reset_index(drop=True)
+    city_ids = pd.Series(index=df_shapes.index, dtype=object)
+    events = []
+    # city_id -> (index of its last shape, last year seen)
+    active = {}
+
+    for year, df_year in df_shapes.groupby('year', sort=True):
+        alive = [(c, i) for c, (i, y) in active.items() if year - y <= max_gap]
+        previous = [df_shapes.at[i, 'geometry'] for _, i in alive]
+        current = list(df_year['geometry'])
+        links = overlap_links(previous, current, min_overlap=min_overlap)
+
+        continued, assigned, best_link = set(), {}, {}
+        for p, c, overlap in sorted(links, key=lambda t: -t[2]):
+            best_link.setdefault(c, p)
+            if p not in continued and c not in assigned:
+                continued.add(p)
+                assigned[c] = alive[p][0]
+
+        for c, idx in enumerate(df_year.index):
+            city_id = assigned.get(c, df_shapes.at[idx, 'id'])
+            if c not in assigned and c in best_link:
+                events.append({'year': year, 'event': 'split', 'city_id': city_id, 'other_id': alive[best_link[c]][0]})
+            city_ids[idx] = city_id
+            active[city_id] = (idx, year)
+
+        # Cities overlapping a shape continued by another city merged into it
+        for p, c, _ in links:
+            if p not in continued and assigned.get(c):
+                events.append({'year': year, 'event': 'merge', 'city_id': alive[p][0], 'other_id': assigned[c]})
+                continued.add(p)
+                active.pop(alive[p][0], None)
+
+    tracks = df_shapes.drop(columns=['geometry']).assign(city_id=city_ids)
+    return tracks, pd.DataFrame(events, columns=['year', 'event', 'city_id', 'other_id'])
+
+
+def growth_series(tracks):
+    """
+    Area time series of each city (rows) by year (columns)
+    """
+    return tracks.pivot_table(index='city_id', columns='year', values='area', aggfunc='sum')
+
+
+def _track_country(country_code_gaul, iso3c, folder, min_overlap, max_gap):
+    tracks, events = track_cities(load_country_shapes(country_code_gaul, iso3c, folder=folder),
+                                  min_overlap=min_overlap, max_gap=max_gap)
+    events['country_code_gaul'], events['iso3c'] = country_code_gaul, iso3c
+    return tracks, events
+
+
+def track_results(folder=config.RESUlTS_FOLDER, min_overlap=0., max_gap=1, n_jobs=None):
+    """
+    Track the cities of every country in the results folder, countries in parallel
+    """
+    files = glob.glob(os.path.join(folder, '*_*_*.json'))
+    countries = sorted({tuple(os.path.basename(t).split('_')[:2]) for t in files})
+    n_jobs = n_jobs or multiprocessing.cpu_count()
+    results = Parallel(n_jobs=n_jobs)(delayed(_track_country)(int(gaul), iso3c, folder, min_overlap, max_gap)
+                                      for gaul, iso3c in tqdm(countries))
+    if len(results) == 0:
+        return pd.DataFrame(columns=['id', 'year', 'area', 'city_id'] + GROUP_COLS[:2]), pd.DataFrame()
+    tracks, events = zip(*results)
+    return pd.concat(tracks, ignore_index=True), pd.concat(events, ignore_index=True)
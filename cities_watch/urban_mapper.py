@@ -1,3 +1,4 @@
+import glob
 import json
 import os
 import time
@@ -6,26 +7,96 @@ import ee
 import pandas as pd
 from tqdm import tqdm
 
-from cities_watch import config
-from cities_watch.gcloud_utils import export_shapes_to_bucket, list_objects_from_bucket
+from cities_watch import config, init_ee
+from cities_watch.gcloud_utils import export_image_to_bucket, export_shapes_to_bucket, list_exported_objects
 from cities_watch.geom_utils import split_feature
-from cities_watch.models import map_urban_areas, load_model
+from cities_watch.image_utils import get_stack_file_name, load_feature_stack
+from cities_watch.models import map_urban_areas, map_urban_areas_multi_year, load_model
+from cities_watch.trace_utils import trace_count, trace_span, traced, write_profile
+
+
+def get_years_folder(list_years):
+    # e.g. 2015-2016-2017 for the exports holding several years
+    return '-'.join(str(t) for t in sorted(list_years))
 
 
 def get_file_name(aoi_props, ref_year):
     """
 
     :param aoi_props:
-    :param ref_year:
+    :param ref_year: year, or list of years for multi-year exports
     :return: File name (e.g: FOLDER/85_FRA/2015/predicted_shapes_1.geosjon)
     """
+    if isinstance(ref_year, (list, tuple)):
+        ref_year = get_years_folder(ref_year)
     ff_prefix = f"{aoi_props['country_code_gaul']}_{aoi_props['iso3c']}"
     sp_id = aoi_props['split_id']
     return f"{config.FOLDER}/{ff_prefix}/{ref_year}/{config.FILENAME}_{sp_id}"
 
 
-def main(list_metas, list_years, model, verbose=config.VERBOSE):
+ACTIVE_STATES = ['UNSUBMITTED', 'READY', 'RUNNING']
+
+
+def pending_stack_exports(summary_folder=config.SUMMARY_FOLDER):
+    """
+    Feature stack exports started by previous runs (see the run summaries) and still running: their status is
+    refreshed with a single request.
+
+    :return: {stack file name: task id}
+    """
+    candidates = {}
+    for path in sorted(glob.glob(os.path.join(summary_folder, 'run_summary_*.json'))):
+        with open(path, 'r') as f:
+            summary = json.load(f)
+        for t in summary:
+            if t.get('feature_stack') and t.get('id') and t.get('state') in ACTIVE_STATES:
+                candidates[t['id']] = t['feature_stack']
+    if len(candidates) == 0:
+        return {}
+
+    init_ee()
+    trace_count('ee.getTaskStatus_calls')
+    states = {t['id']: t['state'] for t in ee.data.getTaskStatus(list(candidates))}
+    return {stack_name: task_id for task_id, stack_name in candidates.items() if states.get(task_id) in ACTIVE_STATES}
+
+
+def get_cached_stack(aoi, year, s3=None, pending=None):
+    """
+    File names of the feature stack of the split and year (a single file, or its tiles) when already exported to the
+    bucket. Otherwise its export is started (the stack is computed from the raw collections for this run) and the
+    task summary is returned instead, unless an export of the stack is pending (see pending_stack_exports, pending is
+    updated with the exports started).
+    """
+    stack_name = get_stack_file_name(aoi['properties'], year)
+    files = list_exported_objects(stack_name, 'tif', s3=s3, tiled=True)
+    if len(files) > 0:
+        return [t.key[:-len('.tif')] for t in files], None
+    if pending is not None and stack_name in pending:
+        print(f'Export of {stack_name} still running (task_id={pending[stack_name]}), not submitted again')
+        return None, None
+
+    init_ee()
+    geometry = ee.Feature(aoi).geometry()
+    with trace_span('mapper.build_graph'):
+        feature_stack = load_feature_stack(start_date=f"{year}-01-01", end_date=f"{year}-12-31", geometry=geometry)
+    description = f"stack_{aoi['properties']['country_name']}_{year}_{aoi['properties']['split_id']}"
+    task = export_image_to_bucket(image=feature_stack, description=description, file_name=stack_name,
+                                  region=geometry, wait_finish=False)
+    task_summary = task.status()
+    task_summary['aoi'] = aoi
+    task_summary['feature_stack'] = stack_name
+    if pending is not None:
+        pending[stack_name] = task.id
+    return None, task_summary
+
+
+@traced('mapper.main')
+def main(list_metas, list_years, model, verbose=config.VERBOSE, s3=None, multi_year=config.MULTI_YEAR,
+         cache_stacks=config.CACHE_STACKS):
+    init_ee()
     output = []
+    # Stacks still exported by previous runs are not submitted again
+    pending = pending_stack_exports(summary_folder=config.SUMMARY_FOLDER) if cache_stacks else None
 
     for aoi_meta in tqdm(list_metas):
         # Load the country borders from the Large Scale International Boundary Polygons - Simplified 2017 version.
@@ -35,9 +106,16 @@ def main(list_metas, list_years, model, verbose=config.VERBOSE):
         # Split the country when the shape is too big
         if verbose:
             print('AOI split check ...')
-        aois = split_feature(aoi_collection, extra_props=aoi_meta)
+        with trace_span('mapper.split'):
+            aois = split_feature(aoi_collection, extra_props=aoi_meta, cache_as=aoi_meta['country_na_LSIB'])
         print(f'AOI split into {len(aois)} part(s)')
 
+        if multi_year:
+            # Single task by split, exporting all years at once
+            output += export_multi_year(aois, list_years, model, s3=s3, cache_stacks=cache_stacks,
+                                            pending=pending)
+            continue
+
         for year in list_years:
             start_date = f"{year}-01-01"
             end_date = f"{year}-12-31"
@@ -46,11 +124,18 @@ def main(list_metas, list_years, model, verbose=config.VERBOSE):
             for aoi in aois:
                 # Check if existing file available
                 file_name = get_file_name(aoi['properties'], year)
-                old_content = list_objects_from_bucket(file_name)
+                old_content = list_exported_objects(file_name, 'geojson', s3=s3)
 
                 if (len(old_content) == 0) | config.UPDATE:
-                    _, city_vectors = map_urban_areas(aoi=aoi, start_date=start_date, end_date=end_date,
-                                                      model=model, vectorized=True)
+                    cached_stack = None
+                    if cache_stacks:
+                        cached_stack, stack_summary = get_cached_stack(aoi, year, s3=s3, pending=pending)
+                        if stack_summary:
+                            output.append(stack_summary)
+
+                    with trace_span('mapper.build_graph'):
+                        _, city_vectors = map_urban_areas(aoi=aoi, start_date=start_date, end_date=end_date,
+                                                          model=model, vectorized=True, cached_stack=cached_stack)
 
                     # Export shapes to cloud storage
                     description = f"{aoi['properties']['country_name']}_{year}_{aoi['properties']['split_id']}"
@@ -67,6 +152,65 @@ def main(list_metas, list_years, model, verbose=config.VERBOSE):
     return output
 
 
+def export_multi_year(aois, list_years, model, s3=None, cache_stacks=config.CACHE_STACKS, pending=None):
+    init_ee()
+    output = []
+    for aoi in aois:
+        # Check if existing file available
+        file_name = get_file_name(aoi['properties'], list_years)
+        old_content = list_exported_objects(file_name, 'geojson', s3=s3)
+
+        if (len(old_content) == 0) | config.UPDATE:
+            cached_stacks = {}
+            if cache_stacks:
+                for year in list_years:
+                    cached_stacks[year], stack_summary = get_cached_stack(aoi, year, s3=s3, pending=pending)
+                    if stack_summary:
+                        output.append(stack_summary)
+
+            with trace_span('mapper.build_graph'):
+                city_vectors = map_urban_areas_multi_year(aoi=aoi, list_years=list_years, model=model,
+                                                          cached_stacks=cached_stacks)
+
+            # Export shapes of all years to cloud storage
+            description = f"{aoi['properties']['country_name']}_{get_years_folder(list_years)}_" \
+                          f"{aoi['properties']['split_id']}"
+            task = export_shapes_to_bucket(city_vectors=city_vectors,
+                                           file_name=file_name,
+                                           description=description,
+                                           wait_finish=False)
+            task_summary = task.status()
+            task_summary['aoi'] = aoi
+            task_summary['years'] = list(list_years)
+            output.append(task_summary)
+        else:
+            print(f'Found {len(old_content)} existing record for filename={file_name}, UPDATE={config.UPDATE}')
+
+    return output
+
+
+def refresh_run_summary(summary_path):
+    """
+    Update the status of the tasks of a run summary (state, start and update timestamps) in place, e.g. once they are
+    finished, so that the run time of the tasks can be used by plan_utils
+    """
+    with open(summary_path, 'r') as f:
+        summary = json.load(f)
+    task_ids = [t['id'] for t in summary if t.get('id')]
+    if len(task_ids) == 0:
+        return summary
+
+    init_ee()
+    trace_count('ee.getTaskStatus_calls')
+    statuses = {t['id']: t for t in ee.data.getTaskStatus(task_ids)}
+    for t in summary:
+        t.update(statuses.get(t.get('id'), {}))
+    with open(summary_path + '.tmp', 'w') as f:
+        json.dump(summary, f)
+    os.replace(summary_path + '.tmp', summary_path)
+    return summary
+
+
 if __name__ == '__main__':
 
     # Define the desired countries and years to process
@@ -87,8 +231,12 @@ if __name__ == '__main__':
     results = main(list_metas=aois_metas, list_years=years_list, model=loaded_model)
 
     # Write summary with task ids
+    run_ts = int(time.time())
     if len(results) > 0:
-        out_summary = os.path.join(config.SUMMARY_FOLDER, f'run_summary_{int(time.time())}.json')
+        out_summary = os.path.join(config.SUMMARY_FOLDER, f'run_summary_{run_ts}.json')
         with open(out_summary, 'w') as f:
             json.dump(results, f)
         print(f'Run summary written at {out_summary}')
+
+    # Write timings and counters when tracing is enabled
+    write_profile(f'run_profile_{run_ts}.json')
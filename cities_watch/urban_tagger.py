@@ -2,111 +2,537 @@ import os
 import ee
 import copy
 import json
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
+from joblib.externals.loky import get_reusable_executor
+from shapely import wkt
 from shapely.geometry import shape
-from shapely.ops import unary_union
 from tqdm.notebook import tqdm
 
-from cities_watch import config
+from cities_watch import config, init_ee
+from cities_watch.fgb_utils import list_mirrored_files, read_features
 from cities_watch.gcloud_utils import list_objects_from_bucket
+from cities_watch.geom_utils import merge_split_shapes, read_country_geometry, write_country_geometry
 from cities_watch.osm_utils import get_tagged_nodes
-from cities_watch.reverse_geo_utils import tag_nodes_to_shapes
+from cities_watch.normalize_utils import get_table_path, nodes_table, write_table
+from cities_watch.reverse_geo_utils import tag_nodes_to_shapes, tag_nodes_to_tables
 from cities_watch.bigquery_utils import push_records_to_bq
+from cities_watch.trace_utils import merge_trace, run_traced, trace_count, trace_span, worker_state, write_profile
+
+_WORKER_NODES = {}
 
 
 def load_country_shape(country):
+    # Local copy first (cached by urban_mapper, or by a previous call)
+    country_shape = read_country_geometry(country, folder=config.COUNTRIES_FOLDER)
+    if country_shape is not None:
+        return country_shape
 
     # Load country bbox
+    init_ee()
     aoi_collection = ee.FeatureCollection("USDOS/LSIB_SIMPLE/2017") \
         .filter(ee.Filter.eq('country_na', country))
 
-    t = aoi_collection.geometry().getInfo()
-    return shape(t).buffer(0)
+    trace_count('ee.getInfo_calls')
+    with trace_span('ee.getInfo'):
+        t = aoi_collection.geometry().getInfo()
+    country_shape = shape(t).buffer(0)
+    write_country_geometry(country, country_shape, folder=config.COUNTRIES_FOLDER)
+    return country_shape
+
+
+def get_modified_time(file):
+    # Bucket objects have a last_modified date, mirrored files a local path
+    if getattr(file, 'last_modified', None) is not None:
+        return file.last_modified.timestamp()
+    if getattr(file, 'path', None) and os.path.exists(file.path):
+        return os.path.getmtime(file.path)
+    return 0
+
+
+def select_year_files(files, prefix, ref_year):
+    """
+    Files of the year folder (e.g. .../2015/) when available, otherwise files of the most recent multi-year export
+    (e.g. .../2015-2016-2017/) including the year (last modified, then folder name). Returns the files and whether
+    features must be filtered by year.
+    """
+    folders = [t.key[len(prefix):].split('/')[0] for t in files]
+    single_year = [t for t, f in zip(files, folders) if f == str(ref_year)]
+    if len(single_year) > 0:
+        return single_year, False
 
+    multi_year = {}
+    for t, f in zip(files, folders):
+        if str(ref_year) in f.split('-'):
+            multi_year.setdefault(f, []).append(t)
+    if len(multi_year) == 0:
+        return [], True
+    # Several exports may hold the year (e.g. 2015-2016/ and 2015-2016-2017/), reading both would duplicate shapes
+    folder = max(multi_year, key=lambda f: (max(get_modified_time(t) for t in multi_year[f]), f))
+    return multi_year[folder], True
 
-def load_cities_shapes(aoi_props, ref_year, buffer_coeff=5 * 1e-3):
-    # Load city shapes
+
+def list_cities_files(aoi_props, ref_year, s3=None):
+    # Bucket objects of the city shapes of a country and year, and whether features must be filtered by year
     ff_prefix = f"{aoi_props['country_code_gaul']}_{aoi_props['iso3c']}"
-    prefix = f"{config.FOLDER}/{ff_prefix}/{ref_year}"
+    prefix = f"{config.FOLDER}/{ff_prefix}/"
 
-    files = list_objects_from_bucket(prefix=prefix)
+    files = list_objects_from_bucket(prefix=prefix, s3=s3)
     files = [t for t in files if (config.FILENAME in t.key) & (t.key.endswith('.geojson'))]
+    return select_year_files(files, prefix, ref_year)
+
+
+def list_mirrored_cities_files(aoi_props, ref_year, mirror_folder=config.MIRROR_FOLDER):
+    # Same as list_cities_files, for the FlatGeobuf files ingested in mirror_folder
+    prefix = f"{config.FOLDER}/{aoi_props['country_code_gaul']}_{aoi_props['iso3c']}/"
+    return select_year_files(list_mirrored_files(prefix, mirror_folder=mirror_folder), prefix, ref_year)
+
+
+def download_cities_shapes(aoi_props, ref_year, s3=None, listing=None):
+    """
+    Features of the city shapes of a country and year from the bucket, and the number of bytes downloaded.
+    listing is the output of list_cities_files, when already listed.
+    """
+    files, filter_year = listing or list_cities_files(aoi_props, ref_year, s3=s3)
 
-    all_shapes = []
+    all_shapes, n_bytes = [], 0
     for file in tqdm(files):
         try:
-            file_content = file.get()['Body'].read().decode('utf-8')
-            json_content = json.loads(file_content)
-            all_shapes += json_content['features']
+            with trace_span('bucket.download'):
+                file_content = file.get()['Body'].read()
+            trace_count('bucket.get_calls')
+            trace_count('bucket.bytes_downloaded', len(file_content))
+            n_bytes += len(file_content)
+            json_content = json.loads(file_content.decode('utf-8'))
+            if filter_year:
+                # multi-year exports hold the features of all years, with a year property
+                all_shapes += [t for t in json_content['features'] if t['properties'].get('year') == int(ref_year)]
+            else:
+                all_shapes += json_content['features']
         except Exception as e:
             print(e)
             print(f'Failed loading shape from {file.key}')
 
+    trace_count('tagger.shapes_loaded', len(all_shapes))
+    return all_shapes, n_bytes
+
+
+def read_mirrored_shapes(aoi_props, ref_year, bbox=None, mirror_folder=config.MIRROR_FOLDER, listing=None):
+    """
+    Features of the city shapes of a country and year from the FlatGeobuf files ingested in mirror_folder, only those
+    intersecting bbox (west, south, east, north) when set, and the size of the files read.
+    listing is the output of list_mirrored_cities_files, when already listed.
+    """
+    files, filter_year = listing or list_mirrored_cities_files(aoi_props, ref_year, mirror_folder=mirror_folder)
+
+    all_shapes, n_bytes = [], 0
+    for file in files:
+        n_bytes += os.path.getsize(file.path)
+        with trace_span('mirror.read'):
+            features = list(read_features(file.path, bbox=bbox))
+        if filter_year:
+            features = [t for t in features if t['properties'].get('year') == int(ref_year)]
+        all_shapes += features
+
+    trace_count('tagger.shapes_loaded', len(all_shapes))
+    return all_shapes, n_bytes
+
+
+def load_cities_shapes(aoi_props, ref_year, buffer_coeff=5 * 1e-3, s3=None, source=config.SHAPES_SOURCE, bbox=None):
+    # Load city shapes, bbox only applies to the FlatGeobuf source
+    if source == 'fgb':
+        all_shapes, _ = read_mirrored_shapes(aoi_props, ref_year, bbox=bbox)
+    else:
+        all_shapes, _ = download_cities_shapes(aoi_props, ref_year, s3=s3)
+
     # merge shapes potentially split
-    # process shapes to correct split features and holes
-    all_geoms = [shape(t['geometry']).buffer(buffer_coeff).buffer(-buffer_coeff) for t in all_shapes]
-    all_geoms = unary_union(all_geoms)
+    with trace_span('tagger.merge'):
+        return merge_split_shapes(all_shapes, buffer_coeff=buffer_coeff)
 
-    return all_geoms
 
+def get_nodes_path(aoi_meta):
+    # Local copy of the OSM nodes of a country
+    return os.path.join(config.OSM_NODES_FOLDER, f"{aoi_meta['country_code_gaul']}_{aoi_meta['iso3c']}.csv")
 
-if __name__ == '__main__':
 
-    # Define the desired countries and years to process
-    selected_countries = ['India']  # Set to None for all countries
-    years_list = [2015, 2016, 2017, 2018, 2019]
+def read_nodes(file_node):
+    # The local copy is written with its index (see osm_utils.get_tagged_nodes)
+    df_nodes = pd.read_csv(file_node, index_col=0)
+    # geometries are stored as WKT in the local copy
+    df_nodes['geometry'] = df_nodes['geometry'].apply(wkt.loads)
+    return df_nodes
+
+
+def load_country_nodes(aoi_meta, country_shape=None):
+    file_node = get_nodes_path(aoi_meta)
+    try:
+        df_nodes = read_nodes(file_node)
+    except Exception as e:
+        print('Loading nodes from OSM ...')
+        if country_shape is None:
+            country_shape = load_country_shape(aoi_meta['country_na_LSIB'])
+        df_nodes = get_tagged_nodes(country_shape, out_path=file_node)
+    return df_nodes
+
+
+def get_props(aoi_meta, year):
+    # Country metadata of the records
+    props = copy.deepcopy(aoi_meta)
+    props['year'] = year
+    props.pop('country_na_LSIB')
+    return props
+
+
+def tag_shapes(df_nodes, city_geometries, props, output_mode=config.OUTPUT_MODE, n_jobs=None):
+    # Records of the shapes, or shapes and links tables in the normalized output mode
+    if output_mode == 'normalized':
+        return tag_nodes_to_tables(df_nodes, city_geometries, metadata=props, add_ranks=True, n_jobs=n_jobs)
+    return tag_nodes_to_shapes(df_nodes, city_geometries, metadata=props, add_ranks=True, n_jobs=n_jobs)
+
+
+def merge_and_tag(all_shapes, df_nodes, props, buffer_coeff=5 * 1e-3, n_jobs=None, output_mode=config.OUTPUT_MODE):
+    city_geometries = merge_split_shapes(all_shapes, buffer_coeff=buffer_coeff)
+    return tag_shapes(df_nodes, city_geometries, props, output_mode=output_mode, n_jobs=n_jobs)
+
+
+def merge_and_tag_stored(all_shapes, node_path, props, n_jobs=None, output_mode=config.OUTPUT_MODE):
+    """
+    merge_and_tag in a pool worker, with the nodes read from their local copy rather than sent with each country-year.
+    Workers keep the nodes of the last country they tagged, so that they read each country once.
+    """
+    key = (node_path, os.path.getmtime(node_path))
+    if key not in _WORKER_NODES:
+        _WORKER_NODES.clear()
+        _WORKER_NODES[key] = read_nodes(node_path)
+    return merge_and_tag(all_shapes, _WORKER_NODES[key], props, n_jobs=n_jobs, output_mode=output_mode)
+
+
+def push_table(records, table_name, file_name, client=None):
+    """
+    Push records to a BigQuery table, failed pushes are saved locally. Returns the failed records.
+    """
+    path_to_schema = os.path.join(config.SCHEMA_FOLDER, f"{table_name}.json")
+    table_id = f"{config.PROJECT_NAME}.{config.DATASET_NAME}.{table_name}"
+    with trace_span('tagger.bq_push'):
+        fails = push_records_to_bq(bq_records=records, table_id=table_id, path_to_schema=path_to_schema,
+                                   client=client)
+
+    if len(fails) > 0:
+        # save failed records to local
+        print(f'Saving failed push records to {file_name} ...')
+        file_path = os.path.join(config.FAILS_FOLDER, file_name)
+        with open(file_path, 'w') as f:
+            json.dump(fails, f)
+    return fails
+
+
+def sink_records(aoi_meta, year, all_records, client=None):
+    """
+    Save the records of a country and year locally and push them to BigQuery, failed pushes are saved locally.
+    Returns the failed records.
+    """
+    print(f'Saving results for year={year} ...')
+    file_name = f"{aoi_meta['country_code_gaul']}_{aoi_meta['iso3c']}_{year}.json"
+    file_path = os.path.join(config.RESUlTS_FOLDER, file_name)
+    with trace_span('tagger.write'), open(file_path, 'w') as f:
+        json.dump(all_records, f)
+
+    # Push to BigQuery table
+    return push_table(all_records, config.TABLE_NAME, file_name, client=client)
 
-    # Load registry of countries with metadata
-    file_path = os.path.join(config.ROOT_DIR, 'data', 'references', 'un_countries_sampled.csv')
-    aois_metas = pd.read_csv(file_path).drop(['shape_area', 'status'], axis=1).to_dict('records')
 
-    for country_name in selected_countries:
-        aoi_meta = [t for t in aois_metas if t['country_name'] == country_name][0]
+def sink_tables(aoi_meta, year, tables, client=None):
+    """
+    Normalized version of sink_records: the shapes and links tables of a country and year are saved in
+    NORMALIZED_FOLDER and pushed to the TABLE_NAME_shapes and TABLE_NAME_links tables.
+    Returns the failed records.
+    """
+    print(f'Saving tables for year={year} ...')
+    fails = []
+    for table in ['shapes', 'links']:
+        file_path = get_table_path(table, aoi_meta['country_code_gaul'], aoi_meta['iso3c'], year,
+                                   folder=config.NORMALIZED_FOLDER)
+        with trace_span('tagger.write'):
+            write_table(tables[table], file_path)
+        fails += push_table(tables[table], f'{config.TABLE_NAME}_{table}', os.path.basename(file_path),
+                            client=client)
+    return fails
 
+
+def sink_nodes(aoi_meta, df_nodes, client=None, force=False):
+    """
+    Save the nodes table of a country and push it to the TABLE_NAME_nodes table, only once: skipped when already
+    saved unless force. Returns the failed records.
+    """
+    file_path = get_table_path('nodes', aoi_meta['country_code_gaul'], aoi_meta['iso3c'],
+                               folder=config.NORMALIZED_FOLDER)
+    if os.path.exists(file_path) and not force:
+        return []
+    records = nodes_table(df_nodes)
+    fails = push_table(records, f'{config.TABLE_NAME}_nodes', os.path.basename(file_path), client=client)
+    # Written after the push, so that a failed run pushes the nodes again
+    with trace_span('tagger.write'):
+        write_table(records, file_path)
+    return fails
+
+
+def sink_output(aoi_meta, year, output, client=None, output_mode=config.OUTPUT_MODE):
+    # Save and push the output of tag_shapes, returns the number of shapes and the failed records
+    if output_mode == 'normalized':
+        return len(output['shapes']), sink_tables(aoi_meta, year, output, client=client)
+    return len(output), sink_records(aoi_meta, year, output, client=client)
+
+
+def main(list_metas, list_years, s3=None, client=None, output_mode=config.OUTPUT_MODE):
+    for aoi_meta in list_metas:
         print('Loading country shape and nodes from OSM ...')
         country_shape = load_country_shape(aoi_meta['country_na_LSIB'])
-        node_name = f"{aoi_meta['country_code_gaul']}_{aoi_meta['iso3c']}.csv"
-        file_node = os.path.join(config.OSM_NODES_FOLDER, node_name)
-        try:
-            df_nodes = pd.read_csv(file_node)
-        except Exception as e:
-            print('Loading nodes from OSM ...')
-            df_nodes = get_tagged_nodes(country_shape, out_path=file_node)
+        with trace_span('tagger.load_nodes'):
+            df_nodes = load_country_nodes(aoi_meta, country_shape=country_shape)
+        if output_mode == 'normalized':
+            sink_nodes(aoi_meta, df_nodes, client=client)
 
-        for year in tqdm(years_list):
+        for year in tqdm(list_years):
             # Get country metadata
-            props = copy.deepcopy(aoi_meta)
-            props['year'] = year
-            props.pop('country_na_LSIB')
+            props = get_props(aoi_meta, year)
 
             # Load shapes form cloud storage
             print(f"Loading city shapes for {aoi_meta}, year={year}")
-            city_geometries = load_cities_shapes(aoi_meta, year)
+            with trace_span('tagger.load_shapes'):
+                city_geometries = load_cities_shapes(aoi_meta, year, s3=s3)
 
             # Tag nodes to each shape
             print('Tagging nodes ...')
-            all_records = tag_nodes_to_shapes(df_nodes, city_geometries, metadata=props, add_ranks=True)
+            with trace_span('tagger.tag'):
+                output = tag_shapes(df_nodes, city_geometries, props, output_mode=output_mode)
+
+            # save results local and push to BigQuery
+            sink_output(aoi_meta, year, output, client=client, output_mode=output_mode)
+
+
+class MemoryBudget:
+    """
+    Bytes held by the items in flight. acquire blocks while the budget is exceeded, unless no item is in flight so
+    that an item larger than the budget still goes through (alone).
+    Bytes held with hold (the nodes of the countries in progress) count against the budget without ever blocking,
+    since they are only released once the items of their country are done.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.held = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, n):
+        with self._condition:
+            while self.used > self.held and self.used + n > self.limit:
+                self._condition.wait()
+            self.used += n
+
+    def release(self, n):
+        with self._condition:
+            self.used -= n
+            self._condition.notify_all()
+
+    def hold(self, n):
+        with self._condition:
+            self.used += n
+            self.held += n
+
+    def unhold(self, n):
+        with self._condition:
+            self.held -= n
+            self.used -= n
+            self._condition.notify_all()
+
+
+class CountryNodes:
+    """
+    Local copies of the OSM nodes of each country, read by the tag workers (see merge_and_tag_stored). The first
+    fetch of a country stores its nodes, which are only loaded when they are not stored yet or for on_load(aoi_meta,
+    df_nodes), called once per country.
+    With a budget, the size of the local copy is held once per worker that may load it (copies), from the first fetch
+    until all the years of the country are released (release must be called once per country-year, whether it
+    succeeded or not).
+    """
+
+    def __init__(self, list_metas, n_years, on_load=None, budget=None, copies=1):
+        self._remaining = {(t['country_code_gaul'], t['iso3c']): n_years for t in list_metas}
+        self._on_load = on_load
+        self._budget = budget
+        self._copies = copies
+        self._paths, self._sizes = {}, {}
+        self._locks = {k: threading.Lock() for k in self._remaining}
+        self._lock = threading.Lock()
+
+    def get(self, aoi_meta):
+        key = (aoi_meta['country_code_gaul'], aoi_meta['iso3c'])
+        with self._locks[key]:
+            if key not in self._paths:
+                # Next fetch of the country tries again on failure
+                node_path = get_nodes_path(aoi_meta)
+                if self._on_load is not None or not os.path.exists(node_path):
+                    # The country shape is only requested when the nodes are not stored locally
+                    df_nodes = load_country_nodes(aoi_meta)
+                    if self._on_load is not None:
+                        self._on_load(aoi_meta, df_nodes)
+                if self._budget is not None:
+                    self._sizes[key] = os.path.getsize(node_path) * self._copies
+                    self._budget.hold(self._sizes[key])
+                self._paths[key] = node_path
+            return self._paths[key]
+
+    def release(self, aoi_meta):
+        key = (aoi_meta['country_code_gaul'], aoi_meta['iso3c'])
+        with self._lock:
+            self._remaining[key] -= 1
+            if self._remaining[key] > 0:
+                return
+            self._paths.pop(key, None)
+            size = self._sizes.pop(key, None)
+        if size is not None:
+            self._budget.unhold(size)
 
-            # save results local
-            print(f'Saving results for year={year} ...')
-            file_name = f"{aoi_meta['country_code_gaul']}_{aoi_meta['iso3c']}_{year}.json"
-            file_path = os.path.join(config.RESUlTS_FOLDER, file_name)
-            with open(file_path, 'w') as f:
-                json.dump(all_records, f)
 
-            # Push to BigQuery table
-            path_to_schema = os.path.join(config.SCHEMA_FOLDER, f"{config.TABLE_NAME}.json")
-            table_id = f"{config.PROJECT_NAME}.{config.DATASET_NAME}.{config.TABLE_NAME}"
-            fails = push_records_to_bq(bq_records=all_records, table_id=table_id, path_to_schema=path_to_schema)
+def run_pipeline(list_metas, list_years, s3=None, client=None, fetch_workers=config.TAGGER_FETCH_WORKERS,
+                 tag_workers=config.TAGGER_TAG_WORKERS, sink_workers=config.TAGGER_SINK_WORKERS,
+                 queue_size=config.TAGGER_QUEUE_SIZE, memory_mb=config.TAGGER_MEMORY_MB, source=config.SHAPES_SOURCE,
+                 output_mode=config.OUTPUT_MODE):
+    """
+    Same as main, with the country-years flowing through three concurrent stages so that downloads and pushes
+    overlap the CPU-bound merge and tagging:
+    - fetch: threads downloading the shapes, or reading them from the mirror with source='fgb' (and storing the
+      nodes of each country once, saving its nodes table with output_mode='normalized')
+    - merge and tag: a process pool, fed by one thread per worker, reading the nodes of each country once per worker
+    - sink: threads writing the records (or the shapes and links tables) and pushing them to BigQuery
+    Stages are connected by queues of queue_size items, and fetches wait before loading while the shapes in flight
+    (listed sizes) and the nodes of the countries in progress (once per worker) exceed memory_mb. Country-years are
+    fetched country by country, so that only the nodes of the few countries in flight are held. A country-year
+    failing at any stage is reported and does not stop the others.
 
-            if len(fails) > 0:
-                # save failed records to local
-                print(f'Saving failed push records for year={year} ...')
-                file_name = f"{aoi_meta['country_code_gaul']}_{aoi_meta['iso3c']}_{year}.json"
-                file_path = os.path.join(config.FAILS_FOLDER, file_name)
-                with open(file_path, 'w') as f:
-                    json.dump(fails, f)
+    :return: one summary per country-year, with the number of records and failed pushes, or the error
+    """
+    tag_workers = tag_workers or multiprocessing.cpu_count()
+    # Country by country, the nodes of a country are dropped once its years are done
+    jobs = [(aoi_meta, year) for aoi_meta in list_metas for year in list_years]
+    fetched, tagged = queue.Queue(maxsize=queue_size), queue.Queue(maxsize=queue_size)
+    budget = MemoryBudget(memory_mb * 1024 ** 2)
+    on_load = (lambda aoi_meta, df_nodes: sink_nodes(aoi_meta, df_nodes, client=client)) \
+        if output_mode == 'normalized' else None
+    nodes = CountryNodes(list_metas, len(list_years), on_load=on_load, budget=budget,
+                         copies=min(tag_workers, len(list_years)))
+    summaries = []
 
+    def summarize(aoi_meta, year, stage, n_records=None, fails=None, error=None):
+        if error is not None:
+            print(f"Failed {stage} for {aoi_meta['iso3c']}, year={year}: {error}")
+        summaries.append({'country_code_gaul': aoi_meta['country_code_gaul'], 'iso3c': aoi_meta['iso3c'],
+                          'year': year, 'stage': stage,
+                          'records': n_records,
+                          'fails': None if fails is None else len(fails),
+                          'error': None if error is None else str(error)})
+
+    def fetch(job):
+        aoi_meta, year = job
+        n_bytes = 0
+        try:
+            print(f"Loading city shapes for {aoi_meta}, year={year}")
+            # Sizes are known from the listing, the budget is acquired before loading anything
+            if source == 'fgb':
+                listing = list_mirrored_cities_files(aoi_meta, year)
+                n_bytes = sum(os.path.getsize(t.path) for t in listing[0])
+            else:
+                listing = list_cities_files(aoi_meta, year, s3=s3)
+                n_bytes = sum(t.size for t in listing[0])
+            budget.acquire(n_bytes)
+            with trace_span('tagger.load_shapes'):
+                if source == 'fgb':
+                    all_shapes, _ = read_mirrored_shapes(aoi_meta, year, listing=listing)
+                else:
+                    all_shapes, _ = download_cities_shapes(aoi_meta, year, s3=s3, listing=listing)
+            with trace_span('tagger.load_nodes'):
+                node_path = nodes.get(aoi_meta)
+        except Exception as e:
+            budget.release(n_bytes)
+            nodes.release(aoi_meta)
+            summarize(aoi_meta, year, 'fetch', error=e)
+            return
+        fetched.put((aoi_meta, year, all_shapes, node_path, n_bytes))
+
+    def tag(executor):
+        while True:
+            item = fetched.get()
+            if item is None:
+                return
+            aoi_meta, year, all_shapes, node_path, n_bytes = item
+            del item
+            try:
+                with trace_span('tagger.tag'):
+                    output = merge_trace(executor.submit(run_traced, worker_state(), merge_and_tag_stored, all_shapes,
+                                                         node_path, get_props(aoi_meta, year), n_jobs=1,
+                                                         output_mode=output_mode).result())
+            except Exception as e:
+                budget.release(n_bytes)
+                nodes.release(aoi_meta)
+                summarize(aoi_meta, year, 'tag', error=e)
+                continue
+            del all_shapes
+            tagged.put((aoi_meta, year, output, n_bytes))
+
+    def sink():
+        while True:
+            item = tagged.get()
+            if item is None:
+                return
+            aoi_meta, year, output, n_bytes = item
+            try:
+                n_records, fails = sink_output(aoi_meta, year, output, client=client, output_mode=output_mode)
+                summarize(aoi_meta, year, 'sink', n_records=n_records, fails=fails)
+            except Exception as e:
+                summarize(aoi_meta, year, 'sink', error=e)
+            finally:
+                budget.release(n_bytes)
+                nodes.release(aoi_meta)
+
+    executor = get_reusable_executor(max_workers=tag_workers)
+    tag_threads = [threading.Thread(target=tag, args=(executor,), daemon=True) for _ in range(tag_workers)]
+    sink_threads = [threading.Thread(target=sink, daemon=True) for _ in range(sink_workers)]
+    for t in tag_threads + sink_threads:
+        t.start()
+
+    with ThreadPoolExecutor(max_workers=fetch_workers) as pool:
+        list(pool.map(fetch, jobs))
+
+    # Each stage stops once the previous one is done
+    for threads, stage_queue in [(tag_threads, fetched), (sink_threads, tagged)]:
+        for _ in threads:
+            stage_queue.put(None)
+        for t in threads:
+            t.join()
+    return summaries
+
+
+if __name__ == '__main__':
+
+    # Define the desired countries and years to process
+    selected_countries = ['India']  # Set to None for all countries
+    years_list = [2015, 2016, 2017, 2018, 2019]
+
+    # Load registry of countries with metadata
+    file_path = os.path.join(config.ROOT_DIR, 'data', 'references', 'un_countries_sampled.csv')
+    aois_metas = pd.read_csv(file_path).drop(['shape_area', 'status'], axis=1).to_dict('records')
 
+    if selected_countries:
+        aois_metas = [pp for pp in aois_metas if pp['country_name'] in selected_countries]
 
+    # Tag city shapes of each country and push to BigQuery, countries and years flowing through the stages concurrently
+    run_pipeline(list_metas=aois_metas, list_years=years_list)
 
+    # Write timings and counters when tracing is enabled
+    write_profile(f'tagger_profile_{int(time.time())}.json')
@@ -3,12 +3,16 @@ import requests
 import pandas as pd
 
 from cities_watch import config
+from cities_watch.trace_utils import trace_count, trace_span
 
 
 def request_wikimedia(name, language='en', start='20100101', end='20200101', granularity='monthly',
                       ref_url=config.REF_WIKI_URL):
     url = ref_url.format(language=language, name=name, start=start, end=end, granularity=granularity)
-    r = requests.get(url=url)
+    with trace_span('wiki.request'):
+        r = requests.get(url=url)
+    trace_count('wiki.requests')
+    trace_count('wiki.bytes_downloaded', len(r.content))
     return r.json()
 
 
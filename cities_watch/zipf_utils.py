@@ -0,0 +1,190 @@
+import glob
+import json
+import multiprocessing
+import os
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from tqdm import tqdm
+
+from cities_watch import config
+
+GROUP_COLS = ['country_code_gaul', 'iso3c', 'year']
+
+
+def _load_result_file(file_path, columns):
+    # File names follow urban_tagger: <gaul>_<iso3>_<year>.json
+    gaul, iso3c, year = os.path.splitext(os.path.basename(file_path))[0].split('_')
+    with open(file_path, 'r') as f:
+        records = json.load(f)
+    df = pd.DataFrame([{k: t.get(k) for k in columns} for t in records], columns=columns)
+    df['country_code_gaul'], df['iso3c'], df['year'] = int(gaul), iso3c, int(year)
+    return df
+
+
+def load_results(folder=config.RESUlTS_FOLDER, columns=('id', 'area', 'rank', 'name'), pattern='*_*_*.json',
+                 n_jobs=None):
+    """
+    Long table of the ranked city records written by urban_tagger, one row per city and GROUP_COLS identifying
+    the country and year. Files are parsed in a process pool and only the requested columns are kept.
+    pattern selects the files, e.g. '85_FRA_*.json' for a single country.
+    """
+    files = sorted(glob.glob(os.path.join(folder, pattern)))
+    n_jobs = n_jobs or multiprocessing.cpu_count()
+    dfs = Parallel(n_jobs=n_jobs)(delayed(_load_result_file)(t, list(columns)) for t in tqdm(files))
+    if len(dfs) == 0:
+        return pd.DataFrame(columns=list(columns) + GROUP_COLS)
+    df = pd.concat(dfs, ignore_index=True)
+    return df[pd.notnull(df['area']) & (df['area'] > 0)].reset_index(drop=True)
+
+
+def fit_rank_size(df, group_cols=GROUP_COLS, min_area=None, rank_shift=0.5):
+    """
+    OLS fit of log(rank - rank_shift) = intercept - zipf * log(area) for all groups at once, from group sums.
+    rank_shift=0.5 is the Gabaix-Ibragimov correction of the small sample bias, ranks are recomputed within
+    each group after the min_area cut.
+
+    :return: one row per group with zipf (exponent), intercept, r2 and n
+    """
+    if min_area:
+        df = df[df['area'] >= min_area]
+    rank = df.groupby(group_cols)['area'].rank(ascending=False, method='first')
+    stats = pd.DataFrame({'x': np.log(df['area'].values), 'y': np.log(rank.values - rank_shift)}, index=df.index)
+    stats['xx'], stats['xy'], stats['yy'] = stats['x'] ** 2, stats['x'] * stats['y'], stats['y'] ** 2
+    stats[group_cols] = df[group_cols]
+
+    sums = stats.groupby(group_cols).sum()
+    n = stats.groupby(group_cols).size()
+    var_x = sums['xx'] - sums['x'] ** 2 / n
+    var_y = sums['yy'] - sums['y'] ** 2 / n
+    cov = sums['xy'] - sums['x'] * sums['y'] / n
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = cov / var_x
+        out = pd.DataFrame({'zipf': -slope,
+                            'intercept': (sums['y'] - slope * sums['x']) / n,
+                            'r2': cov ** 2 / (var_x * var_y),
+                            'n': n})
+    return out.reset_index()
+
+
+def _power_law_fits(x, candidates):
+    """
+    Continuous power-law MLE and KS distance of the tail x >= xmin for each candidate xmin (Clauset et al., 2009)
+
+    :param x: sorted (ascending) values
+    :param candidates: indices in x of the candidate xmin
+    """
+    log_x = np.log(x)
+    # Sums of log(x) over the tails
+    suffix = np.cumsum(log_x[::-1])[::-1]
+    alphas, distances = np.empty(len(candidates)), np.empty(len(candidates))
+    for k, i in enumerate(candidates):
+        n = len(x) - i
+        alpha = 1 + n / (suffix[i] - n * log_x[i])
+        cdf = 1 - np.exp((1 - alpha) * (log_x[i:] - log_x[i]))
+        steps = np.arange(n + 1) / n
+        alphas[k] = alpha
+        distances[k] = max(np.abs(steps[1:] - cdf).max(), np.abs(steps[:-1] - cdf).max())
+    return alphas, distances
+
+
+def xmin_candidates(x, max_candidates=100, min_tail=50):
+    # Indices of the first occurrence of each value, quantile-spaced when there are too many
+    _, first = np.unique(x[:max(len(x) - min_tail, 1)], return_index=True)
+    if len(first) > max_candidates:
+        first = first[np.unique(np.linspace(0, len(first) - 1, max_candidates).astype(int))]
+    return first
+
+
+def fit_power_law(x, xmin=None, max_candidates=100, min_tail=50):
+    """
+    Power-law MLE of the areas x, xmin is selected by minimising the KS distance if not set.
+    The tail (x >= xmin) must hold at least min_tail values, otherwise a ValueError is raised.
+
+    :return: {'alpha': pdf exponent, 'zipf': alpha - 1, 'xmin', 'ks', 'n_tail'}
+    """
+    x = np.sort(np.asarray(x, dtype=float))
+    if xmin is None:
+        candidates = xmin_candidates(x, max_candidates=max_candidates, min_tail=min_tail)
+    else:
+        candidates = np.array([np.searchsorted(x, xmin)])
+    n_tail = len(x) - candidates[0] if len(candidates) > 0 else 0
+    if n_tail < max(min_tail, 1):
+        raise ValueError(f'{n_tail} value(s) in the tail (xmin={xmin}), at least {max(min_tail, 1)} required')
+    alphas, distances = _power_law_fits(x, candidates)
+    best = np.nanargmin(distances)
+    return {'alpha': alphas[best], 'zipf': alphas[best] - 1, 'xmin': x[candidates[best]], 'ks': distances[best],
+            'n_tail': len(x) - candidates[best]}
+
+
+def bootstrap_fits(x, xmin, n_boot=200, reselect_xmin=False, max_candidates=20, min_tail=50, rank_shift=0.5, seed=0):
+    """
+    Bootstrap samples of the rank-size (OLS) and power-law (MLE) Zipf exponents, vectorized over the samples.
+    The MLE is conditional on xmin unless reselect_xmin, which re-selects it for each sample (slower, with fewer
+    candidates than the point estimate).
+    """
+    rng = np.random.default_rng(seed)
+    x = np.asarray(x, dtype=float)
+    samples = np.sort(rng.choice(x, size=(n_boot, len(x)), replace=True), axis=1)
+    log_x = np.log(samples)
+
+    # Largest area gets rank 1
+    log_rank = np.log(np.arange(len(x), 0, -1) - rank_shift)
+    dx = log_x - log_x.mean(axis=1, keepdims=True)
+    ols = -(dx * (log_rank - log_rank.mean())).sum(axis=1) / (dx ** 2).sum(axis=1)
+
+    if reselect_xmin:
+        mle = np.array([fit_power_law(t, max_candidates=max_candidates, min_tail=min_tail)['zipf'] for t in samples])
+    else:
+        tail = samples >= xmin
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mle = tail.sum(axis=1) / np.where(tail, log_x - np.log(xmin), 0).sum(axis=1)
+    return ols, mle
+
+
+def _analyze_group(key, x, n_boot, reselect_xmin, min_tail, alpha_ci, seed):
+    out = dict(key)
+    out.update(fit_power_law(x, min_tail=min_tail))
+    if n_boot:
+        ols, mle = bootstrap_fits(x, out['xmin'], n_boot=n_boot, reselect_xmin=reselect_xmin, min_tail=min_tail,
+                                  seed=seed)
+        q = [alpha_ci / 2 * 100, (1 - alpha_ci / 2) * 100]
+        out['zipf_ols_low'], out['zipf_ols_high'] = np.nanpercentile(ols, q)
+        out['zipf_mle_low'], out['zipf_mle_high'] = np.nanpercentile(mle, q)
+    return out
+
+
+def _analyze_batch(groups, n_boot, reselect_xmin, min_tail, alpha_ci, seed):
+    return [_analyze_group(key, x, n_boot, reselect_xmin, min_tail, alpha_ci, seed) for key, x in groups]
+
+
+def analyze_results(df, group_cols=GROUP_COLS, n_boot=200, reselect_xmin=False, min_tail=50, alpha_ci=0.05, seed=0,
+                    n_jobs=None, verbose=config.VERBOSE):
+    """
+    Zipf exponents by group (country and year by default): rank-size OLS on all cities, power-law MLE on the
+    tail above the selected xmin, and bootstrap confidence intervals (1 - alpha_ci) of both.
+    Groups with less than min_tail cities are only fitted with OLS. Groups are sent in batches to a process pool.
+
+    :param df: long table of city areas, as returned by load_results
+    :return: one row per group
+    """
+    ols = fit_rank_size(df, group_cols=group_cols).rename(columns={'zipf': 'zipf_ols'})
+
+    groups = [(dict(zip(group_cols, key if isinstance(key, tuple) else (key,))), g['area'].values)
+              for key, g in df.groupby(group_cols) if len(g) >= min_tail]
+    if len(groups) == 0:
+        return ols
+
+    # Largest groups first, dealt round-robin so that batches have similar costs
+    groups = sorted(groups, key=lambda t: -len(t[1]))
+    n_jobs = n_jobs or multiprocessing.cpu_count()
+    n_batches = min(len(groups), 4 * n_jobs)
+    batches = [groups[i::n_batches] for i in range(n_batches)]
+    if verbose:
+        print(f'Fitting {len(groups)} group(s) in {n_batches} batch(es) ...')
+    results = Parallel(n_jobs=n_jobs)(delayed(_analyze_batch)(t, n_boot, reselect_xmin, min_tail, alpha_ci, seed)
+                                      for t in tqdm(batches))
+
+    mle = pd.DataFrame([t for batch in results for t in batch]).rename(columns={'zipf': 'zipf_mle'})
+    return ols.merge(mle, on=group_cols, how='left')
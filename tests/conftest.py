@@ -0,0 +1,4 @@
+import os
+
+# Tests never need earth-engine
+os.environ.setdefault('CITIES_WATCH_OFFLINE', '1')
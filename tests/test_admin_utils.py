@@ -0,0 +1,58 @@
+import json
+
+import geopandas as gpd
+import pytest
+from shapely.geometry import Polygon, box, mapping
+
+from cities_watch.admin_utils import aggregate_by_region, assign_regions, build_admin_index, load_admin_regions
+
+# Two regions side by side, split at x=1
+REGIONS = gpd.GeoDataFrame({'code': ['W', 'E'], 'label': ['West', 'East'], 'geometry': [box(0, 0, 1, 1),
+                                                                                         box(1, 0, 2, 1)]})
+
+
+def write_regions(tmp_path):
+    file_path = str(tmp_path / 'regions.geojson')
+    REGIONS.set_crs(epsg=4326).to_file(file_path, driver='GeoJSON')
+    return file_path
+
+
+def test_assign_regions():
+    admin_index = build_admin_index(REGIONS.rename(columns={'code': 'region_id', 'label': 'region_name'}))
+    geometries = [box(.2, .2, .4, .4), box(.5, .2, 1.5, .4), box(.9, .2, 1.1, .4), box(.9995, .2, 1.9995, .4),
+                  Polygon(), box(5, 5, 6, 6)]
+    links = {(i, r): f for i, r, f in assign_regions(geometries, admin_index)}
+    # Contained shapes go whole to their region, the others are apportioned by area
+    assert links[(0, 0)] == 1.
+    assert links[(1, 0)] == pytest.approx(.5) and links[(1, 1)] == pytest.approx(.5)
+    assert links[(2, 0)] == pytest.approx(.5) and links[(2, 1)] == pytest.approx(.5)
+    # Slivers below min_fraction are dropped, empty shapes and shapes outside all regions are skipped
+    assert (3, 0) not in links and links[(3, 1)] == pytest.approx(.9995)
+    assert {i for i, _ in links} == {0, 1, 2, 3}
+
+
+def test_load_admin_regions(tmp_path):
+    gdf = load_admin_regions(write_regions(tmp_path), 'code', name_col='label')
+    assert list(gdf.columns) == ['region_id', 'region_name', 'geometry']
+    assert list(gdf['region_name']) == ['West', 'East']
+
+
+def test_aggregate_by_region(tmp_path):
+    records = [{'id': 'a', 'name': 'A', 'area': 100., 'geometry': json.dumps(mapping(box(.2, .2, .4, .4)))},
+               {'id': 'b', 'name': 'B', 'area': 80., 'geometry': json.dumps(mapping(box(.5, .2, 1.3, .4)))},
+               {'id': 'c', 'name': 'C', 'area': 50., 'geometry': json.dumps(mapping(box(1.5, .2, 1.7, .4)))}]
+    results_folder = tmp_path / 'results'
+    results_folder.mkdir()
+    with open(results_folder / '1_AAA_2019.json', 'w') as f:
+        json.dump(records, f)
+
+    df = aggregate_by_region(write_regions(tmp_path), 'code', name_col='label', folder=str(results_folder),
+                             batch_size=2, n_jobs=1)
+    rows = {(t['id'], t['region_id']): t for t in df.to_dict('records')}
+    assert set(rows) == {('a', 'W'), ('b', 'W'), ('b', 'E'), ('c', 'E')}
+    # b is split 5/8 west, 3/8 east: its east part ranks after c
+    assert rows[('b', 'W')]['area'] == pytest.approx(50.) and rows[('b', 'E')]['area'] == pytest.approx(30.)
+    assert rows[('b', 'W')]['fraction'] == pytest.approx(.625)
+    assert [rows[('a', 'W')]['rank'], rows[('b', 'W')]['rank']] == [1, 2]
+    assert [rows[('c', 'E')]['rank'], rows[('b', 'E')]['rank']] == [1, 2]
+    assert set(df['year']) == {2019}
@@ -0,0 +1,32 @@
+import pytest
+from shapely.geometry import shape
+from shapely.ops import unary_union
+
+from benchmarks import synthetic
+from benchmarks.measure import compare_to_baseline, measure
+
+
+def test_measure():
+    result = measure(sorted, list(range(1000))[::-1], repeat=2)
+    assert set(result) == {'time_min', 'time_mean', 'peak_mem_mb'}
+    assert 0 < result['time_min'] <= result['time_mean']
+    assert result['peak_mem_mb'] > 0
+
+
+def test_compare_to_baseline():
+    baseline = {'a': {'time_min': 1., 'peak_mem_mb': 10.}, 'b': {'time_min': 1., 'peak_mem_mb': 10.}}
+    results = {'a': {'time_min': 1.1, 'peak_mem_mb': 10.}, 'b': {'time_min': 1., 'peak_mem_mb': 20.},
+               'c': {'time_min': 1., 'peak_mem_mb': 1.}}
+    df = compare_to_baseline(results, baseline, tolerance=.2).set_index('case')
+    assert not df.loc['a', 'regression']
+    assert df.loc['b', 'regression']
+    assert df.loc['b', 'mem_ratio'] == pytest.approx(2.)
+    # Cases missing from the baseline are reported, never flagged
+    assert df['regression'].isnull()['c']
+
+
+def test_split_features_cover_shapes():
+    shapes = synthetic.make_city_shapes(200, bounds=(0., 0., 1., 1.), seed=3, min_radius=.02)
+    features = synthetic.make_split_features(shapes, n_splits=4, seed=3)
+    assert len(features) > len(shapes)
+    assert unary_union([shape(t['geometry']) for t in features]).area == pytest.approx(unary_union(shapes).area)
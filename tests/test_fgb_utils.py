@@ -0,0 +1,70 @@
+import json
+import os
+
+from shapely.geometry import MultiPolygon, Point, box, mapping, shape
+
+from benchmarks.fake_s3 import FakeS3
+from cities_watch import config
+from cities_watch.fgb_utils import geojson_to_fgb, ingest, list_mirrored_files, read_features, read_seam_features
+
+PREFIX = f'{config.FOLDER}/85_FRA'
+
+
+def write_geojson(path, geometries):
+    features = [{'type': 'Feature', 'geometry': mapping(g), 'properties': {'city': i, 'year': 2019}}
+                for i, g in enumerate(geometries)]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f)
+    return path
+
+
+def test_geojson_to_fgb(tmp_path):
+    geojson_path = write_geojson(str(tmp_path / 'shapes.geojson'),
+                                 [box(0, 0, 1, 1), MultiPolygon([box(2, 0, 3, 1), box(4, 0, 5, 1)]), Point(0, 0)])
+    fgb_path = geojson_to_fgb(geojson_path)
+    assert fgb_path == str(tmp_path / 'shapes.fgb')
+    # Points are dropped, polygons stored as multipolygons (in the order of the spatial index)
+    features = sorted(read_features(fgb_path), key=lambda t: t['properties']['city'])
+    assert [t['properties']['city'] for t in features] == [0, 1]
+    assert all(t['geometry']['type'] == 'MultiPolygon' for t in features)
+    assert shape(features[1]['geometry']).area == 2
+    assert os.path.getmtime(fgb_path) == os.path.getmtime(geojson_path)
+    assert not os.path.exists(str(tmp_path / '.shapes.fgb'))
+
+    # Converted once, unless forced
+    inode = os.stat(fgb_path).st_ino
+    geojson_to_fgb(geojson_path)
+    assert os.stat(fgb_path).st_ino == inode
+    geojson_to_fgb(geojson_path, force=True)
+    assert os.stat(fgb_path).st_ino != inode
+
+
+def test_read_features_bbox(tmp_path):
+    geometries = [box(x, y, x + .5, y + .5) for x in range(10) for y in range(10)]
+    fgb_path = geojson_to_fgb(write_geojson(str(tmp_path / 'grid.geojson'), geometries))
+    features = list(read_features(fgb_path, bbox=(2.2, 3.2, 4.2, 4.2)))
+    expected = [i for i, g in enumerate(geometries) if g.intersects(box(2.2, 3.2, 4.2, 4.2))]
+    assert sorted(t['properties']['city'] for t in features) == expected
+    assert list(read_features(fgb_path, bbox=(20, 20, 21, 21))) == []
+    assert len(list(read_features(fgb_path))) == 100
+
+
+def test_ingest(tmp_path):
+    s3 = FakeS3()
+    for split_id, geometries in enumerate([[box(0, 0, .8, 1), box(.9, .9, 1.05, 1.05)], [box(1.01, 0, 2, 1)]]):
+        features = [{'type': 'Feature', 'geometry': mapping(g), 'properties': {'city': i}}
+                    for i, g in enumerate(geometries)]
+        s3.Bucket(config.BUCKET_NAME).put_object(Key=f'{PREFIX}/2019/{config.FILENAME}_{split_id}.geojson',
+                                                 Body=json.dumps({'type': 'FeatureCollection', 'features': features}))
+    # Other objects are not mirrored
+    s3.Bucket(config.BUCKET_NAME).put_object(Key=f'{PREFIX}/2019/readme.txt', Body='')
+
+    fgb_paths = ingest(prefix=PREFIX, mirror_folder=str(tmp_path), s3=s3, n_jobs=1, verbose=False)
+    mirrored = list_mirrored_files(PREFIX, mirror_folder=str(tmp_path))
+    assert [t.key for t in mirrored] == [f'{PREFIX}/2019/{config.FILENAME}_{i}.geojson' for i in range(2)]
+    assert [t.path for t in mirrored] == sorted(fgb_paths)
+
+    # Only the shapes near the seam between the two splits are read
+    seam = read_seam_features(sorted(fgb_paths), buffer=.01)
+    assert sorted(shape(t['geometry']).bounds for t in seam) == [(.9, .9, 1.05, 1.05), (1.01, 0., 2., 1.)]
@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+
+from cities_watch import config
+from cities_watch.local_image_utils import (DMSP_OLS, NL_BANDS_CORRESPONDENCE, VIIRS_DNB, cloud_mask,
+                                            composite_ms_image, composite_nl_image, get_scaling_image)
+from cities_watch.raster_utils import create_raster, raster_profile
+
+TRANSFORM = [0.001, 0., 5., 0., -0.001, 45.]
+L8 = 'LANDSAT/LC08/C01'
+CLOUD, CLOUD_CONFIDENCE, CLOUD_SHADOW = 1 << 5, 1 << 7, 1 << 3
+
+
+def write_scene(folder, name, values, qa, collection=L8, date='2018-06-01', cloud_cover=5.):
+    # Scene with each raw band set to values[band name] and the pixel_qa band
+    raw_bands = list(config.MS_BANDS_CORRESPONDENCE[collection])
+    path = str(folder / f'{name}.npy')
+    out = create_raster(path, len(raw_bands) + 1, qa.shape[0], qa.shape[1], TRANSFORM, bands=raw_bands + ['pixel_qa'])
+    for k, band in enumerate(raw_bands):
+        out[k] = values[config.MS_BANDS_CORRESPONDENCE[collection][band]]
+    out[-1] = qa
+    out.flush()
+    return {'path': path, 'collection': collection, 'date': date, 'CLOUD_COVER': cloud_cover}
+
+
+def test_cloud_mask():
+    qa = np.array([0, CLOUD, CLOUD_CONFIDENCE, CLOUD | CLOUD_CONFIDENCE, CLOUD_SHADOW, 1 << 1])
+    # Same bits as image_utils.mask2clouds: cloud with high confidence, or cloud shadow
+    assert cloud_mask(qa).tolist() == [False, False, False, True, True, False]
+
+
+def test_composite_ms_image(tmp_path):
+    shape = (9, 11)
+    clear = np.zeros(shape)
+    cloudy = clear.copy()
+    cloudy[:3] = CLOUD | CLOUD_CONFIDENCE
+    bands = ['blue', 'green', 'red', 'nir', 'swir1', 'swir2']
+    scenes = [write_scene(tmp_path, 'a', dict({b: 1000. for b in bands}, nir=3000.), clear),
+              write_scene(tmp_path, 'b', {b: 2000. for b in bands}, clear, collection='LANDSAT/LE07/C01'),
+              write_scene(tmp_path, 'c', dict({b: 5000. for b in bands}, nir=9000.), cloudy),
+              # Filtered out: too cloudy, and after the end date
+              write_scene(tmp_path, 'd', {b: 1e4 for b in bands}, clear, cloud_cover=50.),
+              write_scene(tmp_path, 'e', {b: 1e4 for b in bands}, clear, date='2019-01-01')]
+
+    out_path = composite_ms_image(scenes, '2018-01-01', '2019-01-01', str(tmp_path / 'ms.npy'), block_size=4,
+                                  n_jobs=1, verbose=False)
+    assert raster_profile(out_path)['bands'] == ['R', 'G', 'B', 'NDVI']
+    red, green, blue, ndvi = np.load(out_path)
+    # Median of the clear observations, scaled
+    np.testing.assert_allclose(red[:3], .15)
+    np.testing.assert_allclose(red[3:], .2)
+    assert (green == red).all() and (blue == red).all()
+    np.testing.assert_allclose(ndvi[:3], (.25 - .15) / (.25 + .15), rtol=1e-5)
+    np.testing.assert_allclose(ndvi[3:], (.3 - .2) / (.3 + .2), rtol=1e-5)
+
+
+def test_composite_without_scenes(tmp_path):
+    with pytest.raises(ValueError):
+        composite_ms_image([], '2018-01-01', '2019-01-01', str(tmp_path / 'ms.npy'), verbose=False)
+
+
+def write_nl(folder, name, collection, date, values):
+    path = str(folder / f'{name}.npy')
+    out = create_raster(path, 1, values.shape[0], values.shape[1], TRANSFORM,
+                        bands=[NL_BANDS_CORRESPONDENCE[collection]])
+    out[0] = values
+    out.flush()
+    return {'path': path, 'collection': collection, 'date': date}
+
+
+@pytest.fixture
+def nl_images(tmp_path):
+    # Over the common range: DMSP-OLS at 10 but dark at (0, 0), VIIRS at 20, no data at (3, 3)
+    dmsp, viirs = np.full((4, 4), 10.), np.full((4, 4), 20.)
+    dmsp[0, 0] = 0.
+    dmsp[3, 3] = viirs[3, 3] = np.nan
+    images = [write_nl(tmp_path, f'dmsp_{k}', DMSP_OLS, f'{year}-01-01', dmsp) for k, year in enumerate([2012, 2013])]
+    images += [write_nl(tmp_path, f'viirs_{k}', VIIRS_DNB, f'2013-0{k + 1}-01', viirs) for k in range(3)]
+    # Before the common range, DMSP-OLS only
+    early = np.full((4, 4), 5.)
+    early[3, 3] = np.nan
+    images += [write_nl(tmp_path, 'dmsp_2010', DMSP_OLS, '2010-01-01', early)]
+    return images
+
+
+def test_scaling_image(tmp_path, nl_images):
+    scaling = np.load(get_scaling_image(nl_images, common_range=['2012-04-01', '2014-01-01'],
+                                        cache_folder=str(tmp_path), n_jobs=1, verbose=False))[0]
+    # 0 where DMSP-OLS is dark, as ee divide, nan only without data
+    assert scaling[0, 0] == 0.
+    assert np.isnan(scaling[3, 3])
+    assert np.isfinite(scaling).sum() == 15
+    np.testing.assert_allclose(scaling[np.isfinite(scaling)][1:], 2.)
+
+
+def test_composite_nl_image(tmp_path, nl_images):
+    out_path = composite_nl_image(nl_images, '2010-01-01', '2011-01-01', str(tmp_path / 'nl_2010.npy'),
+                                  common_range=['2012-04-01', '2014-01-01'], cache_folder=str(tmp_path), n_jobs=1,
+                                  block_size=2, verbose=False)
+    radiance = np.load(out_path)[0]
+    # DMSP-OLS only composite: pixels dark over the common range are 0, not masked
+    assert radiance[0, 0] == 0.
+    assert np.isnan(radiance[3, 3])
+    np.testing.assert_allclose(radiance[1:3], 10.)
+
+    unscaled = np.load(composite_nl_image(nl_images, '2010-01-01', '2011-01-01', str(tmp_path / 'nl_raw.npy'),
+                                          apply_scaling=False, n_jobs=1, verbose=False))[0]
+    np.testing.assert_allclose(unscaled[:3], 5.)
+
+
+def test_composite_nl_image_merged(tmp_path, nl_images):
+    out_path = composite_nl_image(nl_images, '2013-01-01', '2014-01-01', str(tmp_path / 'nl_2013.npy'),
+                                  common_range=['2012-04-01', '2014-01-01'], cache_folder=str(tmp_path), n_jobs=1,
+                                  verbose=False)
+    radiance = np.load(out_path)[0]
+    # Median of the scaled DMSP-OLS image and of the VIIRS images
+    np.testing.assert_allclose(radiance[1:3], 20.)
+    assert radiance[0, 0] == 20.
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from cities_watch.local_models import blending_weights, predict_raster, tile_origins
+
+PROFILE = {'transform': [0.001, 0., 5., 0., -0.001, 45.]}
+TILE_SIZE, OVERLAP = (16, 16), (4, 4)
+
+
+def pixel_model(batch):
+    # Prediction of each pixel from its own bands only: blending overlapping tiles must not change it
+    return batch.mean(axis=-1, keepdims=True)
+
+
+def tile_model(batch):
+    # Same prediction for every pixel of a tile: its mean input
+    return np.broadcast_to(batch.mean(axis=(1, 2, 3))[:, None, None], batch.shape[:3])
+
+
+def test_tile_cores_cover_raster():
+    height, width = 37, 50
+    core = [s - 2 * o for s, o in zip(TILE_SIZE, OVERLAP)]
+    covered = np.zeros((height, width), dtype=int)
+    for r, c in tile_origins(height, width, tile_size=TILE_SIZE, overlap=OVERLAP):
+        covered[max(r + OVERLAP[0], 0):r + OVERLAP[0] + core[0], max(c + OVERLAP[1], 0):c + OVERLAP[1] + core[1]] += 1
+    assert (covered == 1).all()
+
+
+def test_tile_origins_overlap_too_large():
+    with pytest.raises(ValueError):
+        tile_origins(10, 10, tile_size=(8, 8), overlap=(4, 4))
+
+
+def test_blending_weights():
+    weights = blending_weights(tile_size=TILE_SIZE, overlap=OVERLAP)
+    assert weights.shape == TILE_SIZE
+    assert (weights[OVERLAP[0]:-OVERLAP[0], OVERLAP[1]:-OVERLAP[1]] == 1).all()
+    assert 0 < weights.min() < weights[0, OVERLAP[1]] < 1
+    np.testing.assert_allclose(weights, weights[::-1, ::-1])
+
+
+@pytest.mark.parametrize('n_jobs', [1, 2])
+def test_pixel_predictions_match_untiled(tmp_path, n_jobs):
+    rng = np.random.default_rng(0)
+    stack = rng.random((5, 37, 50)).astype(np.float32)
+    stack[:, 3, 7] = np.nan
+    out_path = predict_raster(stack, str(tmp_path / 'classes.npy'), pixel_model, profile=PROFILE,
+                              tile_size=TILE_SIZE, overlap=OVERLAP, batch_size=3, n_jobs=n_jobs, block_size=16,
+                              verbose=False)
+    classes = np.load(out_path)[0]
+    expected = stack.mean(axis=0)
+    # Pixels without valid input are masked
+    assert np.isnan(classes[3, 7])
+    np.testing.assert_allclose(classes[np.isfinite(expected)], expected[np.isfinite(expected)], rtol=1e-5)
+
+
+def test_blended_overlaps(tmp_path):
+    stack = np.zeros((1, 12, 40), dtype=np.float32)
+    stack[:, :, 20:] = 1.
+    out_path = predict_raster(stack, str(tmp_path / 'classes.npy'), tile_model, profile=PROFILE,
+                              tile_size=TILE_SIZE, overlap=OVERLAP, n_jobs=1, verbose=False)
+    classes = np.load(out_path)[0]
+    # Values stay within the range of the tile predictions and are continuous across the tile seams
+    assert classes.min() >= 0 and classes.max() <= 1
+    assert np.abs(np.diff(classes, axis=1)).max() < .5
+    assert classes[0, 0] < classes[0, -1]
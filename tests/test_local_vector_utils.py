@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+from shapely.geometry import shape
+from shapely.ops import unary_union
+
+from cities_watch.local_vector_utils import EIGHT_CONNECTED, city_size_table, vectorize_raster
+
+PROFILE = {'transform': [0.001, 0., 5., 0., -0.001, 45.], 'bands': ['classes']}
+THRESHOLD = .5
+
+
+def make_raster(height=45, width=53, seed=0):
+    # Random blobs, with components crossing the edges and corners of 8 x 8 blocks
+    rng = np.random.default_rng(seed)
+    classes = ndimage.uniform_filter(rng.random((height, width)), size=3)
+    classes = (classes - classes.min()) / (classes.max() - classes.min())
+    # A bar across several blocks, and diagonal chains only connected through block corners
+    classes[20, 3:50] = 1.
+    classes[3:14, 3:14] = classes[3:14, 26:37] = 0.
+    for k in range(-3, 4):
+        classes[8 + k, 8 + k] = classes[8 + k, 31 - k] = 1.
+    return classes[np.newaxis]
+
+
+def components(collection):
+    # (pixel count from the area, mean) of each feature, in a comparable order
+    pixel_area = PROFILE['transform'][0] ** 2
+    return sorted((int(round(shape(t['geometry']).area / pixel_area)), round(t['properties']['mean'], 6))
+                  for t in collection['features'])
+
+
+@pytest.mark.parametrize('block_size', [8, 13])
+def test_vectorize_blocks_match_whole_array(block_size):
+    classes = make_raster()
+    whole = vectorize_raster(classes, PROFILE, threshold=THRESHOLD, block_size=1024, n_jobs=1, verbose=False)
+    blocks = vectorize_raster(classes, PROFILE, threshold=THRESHOLD, block_size=block_size, n_jobs=1, verbose=False)
+
+    _, n_labels = ndimage.label(classes[0] >= THRESHOLD, structure=EIGHT_CONNECTED)
+    assert len(whole['features']) == n_labels
+    assert components(blocks) == components(whole)
+    union = unary_union([shape(t['geometry']) for t in whole['features']])
+    for t in blocks['features']:
+        geom = shape(t['geometry'])
+        assert geom.is_valid
+        assert geom.difference(union).area < 1e-12
+
+
+def test_vectorize_holes():
+    # A ring of pixels: one polygon with a hole, as reduceToVectors
+    classes = np.zeros((1, 10, 10))
+    classes[0, 2:8, 2:8] = 1.
+    classes[0, 4:6, 4:6] = 0.
+    [feature] = vectorize_raster(classes, PROFILE, threshold=THRESHOLD, block_size=4, n_jobs=1,
+                                 verbose=False)['features']
+    geom = shape(feature['geometry'])
+    assert geom.geom_type == 'Polygon' and len(geom.interiors) == 1
+    assert geom.area == pytest.approx(32 * PROFILE['transform'][0] ** 2)
+    assert geom.bounds == pytest.approx((5.002, 44.992, 5.008, 44.998))
+
+
+def by_position(record):
+    return round(record['longitude'], 6), round(record['latitude'], 6)
+
+
+@pytest.mark.parametrize('block_size', [8, 13])
+def test_size_table_blocks_match_whole_array(block_size):
+    classes = make_raster(seed=1)
+    whole = city_size_table(classes, PROFILE, threshold=THRESHOLD, block_size=1024, n_jobs=1, verbose=False)
+    blocks = city_size_table(classes, PROFILE, threshold=THRESHOLD, block_size=block_size, n_jobs=1, verbose=False)
+
+    labels, n_labels = ndimage.label(classes[0] >= THRESHOLD, structure=EIGHT_CONNECTED)
+    assert len(whole) == n_labels
+    assert sorted(t['pixels'] for t in whole) == sorted(np.bincount(labels.ravel())[1:].tolist())
+    # Ranks of components of the same area may differ, compare them by position
+    for key in ['pixels', 'area', 'longitude', 'latitude']:
+        assert [t[key] for t in sorted(blocks, key=by_position)] == pytest.approx(
+            [t[key] for t in sorted(whole, key=by_position)])
+
+
+def test_size_table_closing():
+    # Closing fills the small holes of each component, without merging components, as merge_split_shapes does with
+    # the buffered shapes
+    classes = np.zeros((1, 12, 20))
+    classes[0, 2:8, 2:8] = classes[0, 2:8, 10:16] = 1.
+    classes[0, 4, 4] = 0.
+    records = city_size_table(classes, PROFILE, threshold=THRESHOLD, n_jobs=1, verbose=False)
+    assert sorted(t['pixels'] for t in records) == [35, 36]
+    records = city_size_table(classes, PROFILE, threshold=THRESHOLD, buffer_coeff=.002, block_size=8, n_jobs=1,
+                              metadata={'year': 2019}, verbose=False)
+    assert [t['pixels'] for t in records] == [36, 36]
+    assert [t['rank'] for t in records] == [1, 2] and records[0]['year'] == 2019
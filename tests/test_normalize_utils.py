@@ -0,0 +1,36 @@
+import json
+
+import pytest
+
+from benchmarks import synthetic
+from cities_watch.normalize_utils import get_table_path, load_records, nodes_table, write_table
+from cities_watch.reverse_geo_utils import tag_nodes_to_shapes, tag_nodes_to_tables
+
+METADATA = {'country_code_gaul': 85, 'iso3c': 'FRA', 'year': 2019}
+BOUNDS = (5., 45., 6., 46.)
+
+
+@pytest.mark.parametrize('tag_method', ['contain', 'grid'])
+def test_denormalize_records(tmp_path, tag_method):
+    shapes = synthetic.make_city_shapes(40, bounds=BOUNDS, seed=1, min_radius=.01)
+    df_nodes = synthetic.make_osm_nodes(30, bounds=BOUNDS, seed=2)
+    # Records as written to RESUlTS_FOLDER
+    records = json.loads(json.dumps(tag_nodes_to_shapes(df_nodes, shapes, metadata=dict(METADATA),
+                                                        tag_method=tag_method, grid_size=5000, n_jobs=1)))
+
+    tables = tag_nodes_to_tables(df_nodes, shapes, metadata=dict(METADATA), tag_method=tag_method, grid_size=5000,
+                                 n_jobs=1)
+    tables['nodes'] = nodes_table(df_nodes)
+    for table, table_records in tables.items():
+        write_table(table_records, get_table_path(table, 85, 'FRA', 2019, folder=str(tmp_path)))
+    assert 'name' not in tables['shapes'][0]
+    if tag_method == 'grid':
+        assert any(t['coverage'] for t in tables['links'])
+
+    rebuilt = load_records(85, 'FRA', 2019, folder=str(tmp_path))
+    assert len(rebuilt) == len(records) == 40
+    by_id = {t['id']: t for t in records}
+    for t in rebuilt:
+        # Compared as written to the files (missing pageviews are NaN in both)
+        assert json.dumps(t, sort_keys=True) == json.dumps(by_id[t['id']], sort_keys=True)
+    assert [t['rank'] for t in rebuilt] == list(range(1, 41))
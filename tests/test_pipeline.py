@@ -0,0 +1,63 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from benchmarks.pipeline import summarize_stages
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The stand-ins must be installed before cities_watch is imported: each run is a separate interpreter
+RUN_LOAD = """
+import json, sys
+from benchmarks.pipeline import run_load
+kwargs = json.loads(sys.argv[1])
+report = run_load(getinfo_latency=0, task_latency=0.01, s3_latency=0, http_latency=0, bq_latency=0,
+                  country_radius=1., shapes_per_degree2=5, nodes_per_degree2=5, **kwargs)
+print(json.dumps({k: v for k, v in report.items() if k != 'stages'}, default=str))
+"""
+
+
+def run_load(**kwargs):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT_DIR, os.environ.get('PYTHONPATH', '')]))
+    out = subprocess.run([sys.executable, '-W', 'ignore', '-c', RUN_LOAD, json.dumps(kwargs)], cwd=ROOT_DIR, env=env,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    assert out.returncode == 0, out.stderr
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+@pytest.fixture(scope='module')
+def report():
+    return run_load(n_countries=2, list_years=[2018, 2019])
+
+
+def test_run_load(report):
+    # One export task per split and year, each read back once by the tagger
+    assert report['ee_tasks'] > 0 and report['ee_tasks'] % 2 == 0
+    assert report['bucket_calls']['put'] == report['ee_tasks']
+    assert report['bucket_calls']['get'] == report['ee_tasks']
+    assert report['http_calls']['overpass'] == 2
+    assert report['bq_rows'] > 0
+    assert report['wall_time_s'] >= report['tagging_s'] > 0
+
+
+
+def test_pipelined_run_load(report):
+    pipelined = run_load(n_countries=2, list_years=[2018, 2019], pipelined=True)
+    # Same records as the sequential run, the nodes of each country fetched once
+    assert (pipelined['bq_rows'], pipelined['bq_bytes']) == (report['bq_rows'], report['bq_bytes'])
+    assert pipelined['http_calls']['overpass'] == 2
+
+
+def test_summarize_stages():
+    spans = [{'stage': 'fetch', 'start': 0., 'end': 2.}, {'stage': 'fetch', 'start': 1., 'end': 3.},
+             {'stage': 'fetch', 'start': 5., 'end': 6.}, {'stage': 'tag', 'start': 2., 'end': 6.}]
+    df = summarize_stages(spans, wall_time=10.).set_index('stage')
+    assert df.loc['fetch', 'calls'] == 3
+    assert df.loc['fetch', 'total_s'] == pytest.approx(5.)
+    # Overlapping calls are counted once in the busy time
+    assert df.loc['fetch', 'busy_s'] == pytest.approx(4.)
+    assert df.loc['fetch', 'max_concurrency'] == 2
+    assert df.loc['tag', 'busy_share'] == pytest.approx(.4)
@@ -0,0 +1,87 @@
+import os
+import subprocess
+import sys
+from types import SimpleNamespace
+
+import pytest
+from shapely.geometry import MultiPolygon, box
+
+import cities_watch
+from cities_watch.geom_utils import write_country_geometry
+from cities_watch.plan_utils import load_calibration, plan_country, plan_run, split_pixels
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CALIBRATION = {'seconds_per_mpixel': 10., 'submit_seconds': 2., 'bytes_per_mpixel': 2 ** 20}
+METAS = [{'country_name': 'Small', 'country_na_LSIB': 'Small', 'country_code_gaul': 1, 'iso3c': 'SML'},
+         {'country_name': 'Missing', 'country_na_LSIB': 'Missing', 'country_code_gaul': 2, 'iso3c': 'MIS'}]
+
+
+@pytest.fixture
+def countries_folder(tmp_path):
+    # Country geometries are MultiPolygons, as loaded from LSIB
+    write_country_geometry('Small', MultiPolygon([box(0, 0, 2, 1)]), folder=str(tmp_path))
+    return str(tmp_path)
+
+
+def test_import_without_earth_engine():
+    # Credentials are not needed: earth-engine is neither imported nor initialized
+    env = {k: v for k, v in os.environ.items() if k != 'CITIES_WATCH_OFFLINE'}
+    out = subprocess.run([sys.executable, '-W', 'ignore', '-c',
+                          "import sys; sys.modules['ee'] = None; import cities_watch.plan_utils"],
+                         cwd=ROOT_DIR, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         universal_newlines=True)
+    assert out.returncode == 0, out.stderr
+
+
+def test_init_ee_once(monkeypatch):
+    calls = []
+    fake_ee = SimpleNamespace(ServiceAccountCredentials=lambda account, path: (account, path),
+                              Initialize=lambda credentials: calls.append(credentials))
+    monkeypatch.setitem(sys.modules, 'ee', fake_ee)
+    monkeypatch.setattr(cities_watch, '_EE_INITIALIZED', False)
+    cities_watch.init_ee()
+    assert calls == []
+    # Initialized on first use only, once running online
+    monkeypatch.delenv('CITIES_WATCH_OFFLINE')
+    cities_watch.init_ee()
+    cities_watch.init_ee()
+    assert len(calls) == 1
+
+
+def test_plan_country(countries_folder):
+    pixels = split_pixels(box(0, 0, 2, 1))[0]
+    plan = plan_country(METAS[0], [2018, 2019], CALIBRATION, multi_year=False, cache_stacks=True,
+                        folder=countries_folder)
+    assert plan['cached'] and plan['splits'] == 1
+    assert plan['pixels'] == 2 * pixels and plan['bbox_pixels'] >= plan['pixels']
+    assert plan['export_tasks'] == 2 and plan['stack_tasks'] == 2
+    assert plan['task_s'] == pytest.approx(2 * pixels / 1e6 * 10., abs=.1)
+    assert plan['output_mb'] == pytest.approx(2 * pixels / 1e6, abs=.1)
+    assert plan['submit_s'] == 8.
+
+    # A single export task runs all the years
+    plan = plan_country(METAS[0], [2018, 2019], CALIBRATION, multi_year=True, cache_stacks=False,
+                        folder=countries_folder)
+    assert plan['export_tasks'] == 1 and plan['stack_tasks'] == 0
+    assert plan['max_task_s'] == plan['task_s']
+    assert plan_country(METAS[1], [2018], CALIBRATION, folder=countries_folder) == {'country_name': 'Missing',
+                                                                                   'cached': False}
+
+
+def test_plan_run(countries_folder):
+    df, calibration = plan_run(METAS, [2018, 2019], multi_year=False, cache_stacks=False, concurrent_tasks=2,
+                               calibration=CALIBRATION, folder=countries_folder)
+    plans = df.set_index('country_name')
+    assert list(plans.index) == ['Small', 'Missing', 'total'] and calibration == CALIBRATION
+    # Not all countries are cached, the total covers the cached ones
+    assert not plans.loc['total', 'cached'] and not plans.loc['Missing', 'cached']
+    assert plans.loc['total', 'pixels'] == plans.loc['Small', 'pixels']
+    small = plans.loc['Small']
+    assert small['runtime_s'] == pytest.approx(small['submit_s'] + max(small['task_s'] / 2, small['max_task_s']),
+                                               abs=.1)
+
+
+def test_load_calibration_defaults(tmp_path):
+    calibration = load_calibration(summary_folder=str(tmp_path), mirror_folder=str(tmp_path))
+    assert not any(calibration[k] for k in ['calibrated_tasks', 'calibrated_profiles', 'calibrated_outputs'])
+    assert calibration['seconds_per_mpixel'] > 0
@@ -0,0 +1,94 @@
+import json
+import threading
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import pytest
+from shapely.geometry import box, mapping
+
+from cities_watch.query_utils import ShapeStore, build_shape_store, make_server
+
+# An L-shaped city, whose bounding box covers (1.5, 1.5) but not the shape itself
+L_SHAPE = box(0, 0, 2, 1).union(box(0, 0, 1, 2))
+SHAPES = {2018: [('a', L_SHAPE, 3.), ('b', box(5, 5, 6, 6), 1.)],
+          2019: [('a', box(0, 0, 2, 2), 4.), ('b', box(5, 5, 6, 6), 1.), ('c', box(5.5, 5.5, 5.6, 5.6), .01)]}
+
+
+@pytest.fixture
+def store(tmp_path):
+    results_folder = tmp_path / 'results'
+    results_folder.mkdir()
+    for year, shapes in SHAPES.items():
+        records = [{'id': f'{name}_{year}', 'name': name, 'area': area, 'rank': i + 1,
+                    'geometry': json.dumps(mapping(g))} for i, (name, g, area) in enumerate(shapes)]
+        with open(results_folder / f'1_AAA_{year}.json', 'w') as f:
+            json.dump(records, f)
+    store_folder = build_shape_store(folder=str(results_folder), store_folder=str(tmp_path / 'store'), verbose=False)
+    return ShapeStore(store_folder)
+
+
+def test_at_point(store):
+    assert len(store) == 5
+    assert sorted(t['id'] for t in store.at_point(.5, .5)) == ['a_2018', 'a_2019']
+    # Inside the bounding box of the L but outside the shape
+    assert [t['id'] for t in store.at_point(1.5, 1.5)] == ['a_2019']
+    assert [t['id'] for t in store.at_point(.5, .5, year=2018)] == ['a_2018']
+    assert store.at_point(10, 10) == []
+    record = store.at_point(5.2, 5.2, year=2019, with_geometry=True)[0]
+    assert record['iso3c'] == 'AAA' and record['geometry']['type'] == 'Polygon'
+
+
+def test_in_bbox(store):
+    assert [t['id'] for t in store.in_bbox(4, 4, 7, 7, year=2019)] == ['b_2019', 'c_2019']
+    assert [t['id'] for t in store.in_bbox(-1, -1, 7, 7, year=2019, top_k=2)] == ['a_2019', 'b_2019']
+    assert [t['id'] for t in store.in_bbox(4, 4, 7, 7, min_area=.1)] == ['b_2018', 'b_2019']
+    # Only the exact test drops the L, whose bounding box intersects the query
+    assert [t['id'] for t in store.in_bbox(1.4, 1.4, 1.6, 1.6, year=2018)] == ['a_2018']
+    assert store.in_bbox(1.4, 1.4, 1.6, 1.6, year=2018, exact=True) == []
+
+
+def test_select(store):
+    assert [t['id'] for t in store.select(year=2019)] == ['a_2019', 'b_2019', 'c_2019']
+    assert [t['id'] for t in store.select(min_area=2, top_k=1)] == ['a_2019']
+    assert store.select(iso3c='BBB') == []
+
+
+def test_store_is_rebuilt_on_change(tmp_path, store):
+    results_folder, store_folder = str(tmp_path / 'results'), str(tmp_path / 'store')
+    with open(tmp_path / 'results' / '1_AAA_2020.json', 'w') as f:
+        json.dump([{'id': 'd_2020', 'name': 'd', 'area': 1., 'rank': 1,
+                    'geometry': json.dumps(mapping(box(8, 8, 9, 9)))}], f)
+    build_shape_store(folder=results_folder, store_folder=store_folder, verbose=False)
+    assert [t['id'] for t in ShapeStore(store_folder).at_point(8.5, 8.5)] == ['d_2020']
+
+
+def get(server, path):
+    try:
+        with urlopen(f'http://127.0.0.1:{server.server_address[1]}{path}') as r:
+            return r.status, json.load(r)
+    except HTTPError as e:
+        return e.code, json.load(e)
+
+
+def test_server(store, monkeypatch):
+    # A selection of fields, as pandas fails on unknown columns
+    monkeypatch.setattr(store, 'select', lambda fields: store.attributes[fields.split(',')].to_dict('records'))
+    server = make_server(store, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        status, payload = get(server, '/point?lon=5.2&lat=5.2&year=2019')
+        assert status == 200 and [t['id'] for t in payload] == ['b_2019']
+        status, payload = get(server, '/bbox?west=4&south=4&east=7&north=7&top_k=1&with_geometry=1')
+        assert status == 200 and payload[0]['geometry']['type'] == 'Polygon'
+        assert get(server, '/point?lon=east&lat=5')[0] == 400
+        assert get(server, '/point?lon=5&lat=5&color=red')[0] == 400
+        # Unknown fields are bad requests, other failures server errors, all answered in JSON
+        status, payload = get(server, '/select?fields=color')
+        assert status == 400 and 'color' in payload['error']
+        monkeypatch.setattr(store, 'records', lambda *args, **kwargs: 1 / 0)
+        status, payload = get(server, '/point?lon=5.2&lat=5.2')
+        assert status == 500 and 'ZeroDivisionError' in payload['error']
+        assert get(server, '/nowhere')[0] == 404
+    finally:
+        server.shutdown()
+        server.server_close()
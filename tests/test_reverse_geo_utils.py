@@ -0,0 +1,55 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import Point, box
+
+from cities_watch.reverse_geo_utils import get_major_city, grid_pieces, tag_grid, tag_nodes_to_shapes
+
+METADATA = {'country_code_gaul': 1, 'iso3c': 'AAA', 'year': 2015}
+
+
+def make_nodes():
+    # a covers two thirds of the shape, b (with more pageviews) the last third
+    return pd.DataFrame({'name': ['a', 'b', 'c'], 'pageviews': [10, 100, 1000],
+                         'geometry': [Point(.05, .05), Point(.35, .05), Point(5, 5)]})
+
+
+def test_grid_pieces():
+    geometries = [Point(0, 0).buffer(.2), box(1, 1, 1.1, 1.1)]
+    idx, lon, lat, area = grid_pieces(geometries, grid_size=2000)
+    assert set(idx) == {0, 1}
+    for i, g in enumerate(geometries):
+        # Pieces cover the geometry exactly, centroids fall inside it
+        expected = g.area * 111.32 ** 2 * np.cos(np.radians(g.centroid.y))
+        assert area[idx == i].sum() == pytest.approx(expected, rel=1e-3)
+        assert all(g.buffer(1e-9).contains(Point(x, y)) for x, y in zip(lon[idx == i], lat[idx == i]))
+
+
+def test_tag_grid():
+    df_cities = gpd.GeoDataFrame([box(0, 0, .3, .1), box(.34, 0, .36, .1)], columns=['geometry']).reset_index()
+    df_grid = tag_grid(df_cities, gpd.GeoDataFrame(make_nodes()), grid_size=1000)
+    coverage = {(i, n): c for i, n, c in zip(df_grid['index'], df_grid['name'], df_grid['coverage'])}
+    assert coverage[(0, 'a')] == pytest.approx(2 / 3, abs=.02)
+    assert coverage[(0, 'b')] == pytest.approx(1 / 3, abs=.02)
+    assert coverage[(1, 'b')] == 1
+    # Nodes nearest to no cell are left out, coverage sums to 1 per city
+    assert 'c' not in set(df_grid['name'])
+    assert df_grid.groupby('index')['coverage'].sum().tolist() == pytest.approx([1, 1], abs=1e-3)
+
+
+def test_major_city_by_coverage():
+    records = tag_nodes_to_shapes(make_nodes(), [box(0, 0, .3, .1)], metadata=METADATA, tag_method='grid',
+                                  grid_size=1000, n_jobs=1)
+    assert len(records) == 1
+    # The node covering most of the shape names it, despite fewer pageviews
+    assert records[0]['name'] == 'a' and 'coverage' not in records[0]
+    assert {t['name'] for t in records[0]['cities']} == {'a', 'b'}
+
+
+def test_get_major_city():
+    cities = [{'name': 'a', 'pageviews': 10, 'coverage': .4}, {'name': 'b', 'pageviews': 5, 'coverage': .6}]
+    assert get_major_city(cities)['name'] == 'b'
+    # Pageviews break ties on coverage, and decide without coverage
+    assert get_major_city([dict(t, coverage=.5) for t in cities])['name'] == 'a'
+    assert get_major_city([{'name': 'a', 'pageviews': 1}, {'name': 'b', 'pageviews': 2}])['name'] == 'b'
@@ -0,0 +1,158 @@
+import gzip
+import json
+import os
+import sqlite3
+import struct
+
+import pytest
+from shapely.geometry import box, mapping
+
+from cities_watch import tile_utils
+from cities_watch.tile_utils import LAYER_NAME, build_tiles, encode_tile, read_tile, tile_bounds
+
+
+def read_varint(data, pos):
+    value, shift = 0, 0
+    while True:
+        byte = data[pos]
+        value |= (byte & 0x7f) << shift
+        pos, shift = pos + 1, shift + 7
+        if byte < 0x80:
+            return value, pos
+
+
+def read_fields(data):
+    # Protobuf fields as [(number, value)], length-delimited values as bytes
+    fields, pos = [], 0
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = read_varint(data, pos)
+        elif wire_type == 1:
+            value, pos = struct.unpack('<d', data[pos:pos + 8])[0], pos + 8
+        else:
+            size, pos = read_varint(data, pos)
+            value, pos = data[pos:pos + size], pos + size
+        fields.append((number, value))
+    return fields
+
+
+def read_packed(data):
+    values, pos = [], 0
+    while pos < len(data):
+        value, pos = read_varint(data, pos)
+        values.append(value)
+    return values
+
+
+def unzigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+
+def test_encode_square():
+    z, x, y = 10, 530, 360
+    x0, y0, x1, y1 = tile_bounds(z, x, y)
+    size = x1 - x0
+    # Square over the center quarter of the tile
+    geom = box(x0 + size / 4, y0 + size / 4, x0 + 3 * size / 4, y0 + 3 * size / 4)
+    tile = encode_tile([({'id': 'a', 'area': 2.5, 'rank': 1, 'name': None}, geom)], z, x, y, extent=4096)
+
+    [(number, layer)] = read_fields(tile)
+    assert number == 3
+    layer = read_fields(layer)
+    fields = dict((k, v) for k, v in layer if k != 2)
+    features = [read_fields(v) for k, v in layer if k == 2]
+    assert fields[15] == 2 and fields[1].decode() == LAYER_NAME and fields[5] == 4096
+    assert [v.decode() for k, v in layer if k == 3] == ['id', 'area', 'rank']
+    assert len(features) == 1
+
+    feature = dict(features[0])
+    assert feature[3] == 3
+    assert len(read_packed(feature[2])) == 6
+    commands = read_packed(feature[4])
+    # MoveTo, LineTo x 3, ClosePath, with deltas from the previous point
+    assert commands[0] == 1 | 1 << 3 and commands[3] == 2 | 3 << 3 and commands[-1] == 7 | 1 << 3
+    x_pts, y_pts = [unzigzag(commands[1])], [unzigzag(commands[2])]
+    for dx, dy in zip(commands[4:-1:2], commands[5:-1:2]):
+        x_pts.append(x_pts[-1] + unzigzag(dx))
+        y_pts.append(y_pts[-1] + unzigzag(dy))
+    assert sorted(set(x_pts)) == [1024, 3072] and sorted(set(y_pts)) == [1024, 3072]
+    # Exterior ring with a positive surveyor's area (clockwise with y down)
+    area = sum(x_pts[i] * y_pts[i - 3] - x_pts[i - 3] * y_pts[i] for i in range(4))
+    assert area != 0
+
+
+def test_encode_outside_tile():
+    x0, y0, x1, y1 = tile_bounds(10, 530, 360)
+    geom = box(x1 + (x1 - x0), y0, x1 + 2 * (x1 - x0), y1)
+    assert encode_tile([({'id': 'a'}, geom)], 10, 530, 360) is None
+
+
+def write_results(folder, name, shapes, mtime):
+    records = [{'id': k, 'name': k, 'area': g.area, 'rank': i + 1, 'geometry': json.dumps(mapping(g))}
+               for i, (k, g) in enumerate(shapes.items())]
+    file_path = os.path.join(folder, name)
+    with open(file_path, 'w') as f:
+        json.dump(records, f)
+    os.utime(file_path, (mtime, mtime))
+
+
+def read_tiles(path):
+    conn = sqlite3.connect(path)
+    rows = conn.execute('SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles').fetchall()
+    conn.close()
+    return {(z, x, y): gzip.decompress(data) for z, x, y, data in rows}
+
+
+@pytest.fixture
+def results(tmp_path):
+    folder = tmp_path / 'results'
+    folder.mkdir()
+    write_results(folder, '1_AAA_2019.json', {'a': box(2, 2, 3, 3), 'b': box(40, 10, 42, 11)}, 1000)
+    write_results(folder, '2_BBB_2019.json', {'c': box(2.5, 2.5, 4, 4)}, 1000)
+    return str(folder)
+
+
+def build(results, tiles_folder, **kwargs):
+    os.makedirs(tiles_folder, exist_ok=True)
+    return build_tiles(2019, folder=results, tiles_folder=tiles_folder, min_zoom=0, max_zoom=3, n_jobs=1,
+                       verbose=False, **kwargs)
+
+
+def test_incremental_build(tmp_path, results):
+    path = build(results, str(tmp_path / 'tiles'))
+    assert read_tile(path, 0, 0, 0) is not None
+    # c moves to the other side of the world, BBB disappears
+    write_results(results, '2_BBB_2019.json', {'c': box(-120, -30, -119, -29)}, 2000)
+    build(results, str(tmp_path / 'tiles'))
+    assert read_tiles(path) == read_tiles(build(results, str(tmp_path / 'full')))
+
+    os.remove(os.path.join(results, '2_BBB_2019.json'))
+    build(results, str(tmp_path / 'tiles'))
+    assert read_tiles(path) == read_tiles(build(results, str(tmp_path / 'full_removed')))
+    conn = sqlite3.connect(path)
+    assert [t for t, in conn.execute('SELECT file FROM sources')] == ['1_AAA_2019.json']
+    conn.close()
+
+
+def test_interrupted_rebuild(tmp_path, results, monkeypatch):
+    path = build(results, str(tmp_path / 'tiles'))
+    tiles = read_tiles(path)
+
+    def fail(*args):
+        raise RuntimeError('interrupted')
+
+    # New parameters reset the archive only when the new tiles are written
+    monkeypatch.setattr(tile_utils, '_encode_batch', fail)
+    with pytest.raises(RuntimeError):
+        build(results, str(tmp_path / 'tiles'), extent=512)
+    assert read_tiles(path) == tiles
+    conn = sqlite3.connect(path)
+    assert json.loads(conn.execute("SELECT value FROM metadata WHERE name='build_params'").fetchone()[0])['extent'] \
+        == 4096
+    conn.close()
+
+    monkeypatch.undo()
+    build(results, str(tmp_path / 'tiles'), extent=512)
+    assert read_tiles(path) == read_tiles(build(results, str(tmp_path / 'full'), extent=512)) != tiles
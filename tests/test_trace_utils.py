@@ -0,0 +1,65 @@
+import json
+import os
+import time
+
+import pytest
+from joblib import Parallel, delayed
+
+from cities_watch import trace_utils
+from cities_watch.trace_utils import (enable_tracing, get_profile, merge_trace, run_traced, trace_count, trace_span,
+                                      traced, worker_state, write_profile)
+
+
+@pytest.fixture(autouse=True)
+def tracing():
+    enabled = trace_utils.is_tracing()
+    enable_tracing(True)
+    yield
+    enable_tracing(enabled)
+
+
+@traced('work')
+def work(n):
+    trace_count('calls')
+    trace_count('items', n)
+    with trace_span('inner'):
+        time.sleep(.001)
+    return os.getpid()
+
+
+def test_spans_and_counters():
+    for n in [1, 2, 3]:
+        work(n)
+    profile = get_profile()
+    assert profile['counters'] == {'calls': 3, 'items': 6}
+    assert profile['spans']['work']['count'] == 3
+    assert profile['spans']['inner']['max_s'] <= profile['spans']['work']['total_s']
+
+
+def test_disabled():
+    enable_tracing(False)
+    work(1)
+    assert get_profile()['counters'] == {} and get_profile()['spans'] == {}
+    assert write_profile('unused.json') is None
+
+
+@pytest.mark.parametrize('n_jobs', [1, 2])
+def test_worker_counters_are_merged(n_jobs):
+    state = worker_state()
+    outputs = Parallel(n_jobs=n_jobs)(delayed(run_traced)(state, work, n) for n in range(10))
+    pids = [merge_trace(t) for t in outputs]
+    if n_jobs > 1:
+        assert any(t != os.getpid() for t in pids)
+    # Counted once, whether the calls ran in the parent or in workers
+    profile = get_profile()
+    assert profile['counters'] == {'calls': 10, 'items': 45}
+    assert profile['spans']['work']['count'] == 10 and profile['spans']['inner']['count'] == 10
+
+
+def test_write_profile(tmp_path):
+    work(1)
+    file_path = write_profile('run_profile.json', folder=str(tmp_path), verbose=False)
+    with open(file_path, 'r') as f:
+        profile = json.load(f)
+    assert profile['counters'] == {'calls': 1, 'items': 1}
+    assert set(profile) >= {'duration_s', 'spans', 'peak_rss_mb'}
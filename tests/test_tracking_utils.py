@@ -0,0 +1,63 @@
+import json
+
+import pandas as pd
+import pytest
+from shapely.geometry import box, mapping
+
+from cities_watch.tracking_utils import growth_series, overlap_links, track_cities, track_results
+
+SHAPES = {2015: {'a15': box(0, 0, 2, 2), 'b15': box(10, 0, 12, 2), 'c15': box(20, 0, 22, 2),
+                 'e15': box(40, 0, 41, 1)},
+          # b splits in two, d appears
+          2016: {'a16': box(0, 0, 2.1, 2), 'b16_1': box(10, 0, 11.2, 2), 'b16_2': box(11.5, 0, 12, 2),
+                 'c16': box(20, 0, 22, 2), 'd16': box(30, 0, 31, 1)},
+          # c and d merge, e is back after a gap of two years
+          2017: {'a17': box(0, 0, 2.2, 2), 'cd17': box(20, 0, 31, 2), 'e17': box(40, 0, 41, 1)}}
+
+
+def make_shapes():
+    return pd.DataFrame([{'id': k, 'year': year, 'area': g.area, 'geometry': g}
+                         for year, shapes in SHAPES.items() for k, g in shapes.items()])
+
+
+def test_overlap_links():
+    previous = [box(0, 0, 2, 2), box(5, 5, 6, 6)]
+    current = [box(1, 1, 3, 3), box(1.9, 0, 4, 0.1), box(10, 10, 11, 11)]
+    links = overlap_links(previous, current)
+    assert sorted((p, c) for p, c, _ in links) == [(0, 0), (0, 1)]
+    # Overlaps below min_overlap of the smaller shape are ignored
+    assert [(p, c) for p, c, _ in overlap_links(previous, current, min_overlap=.2)] == [(0, 0)]
+    assert overlap_links([], current) == []
+
+
+def test_track_cities():
+    tracks, events = track_cities(make_shapes())
+    city_ids = dict(zip(tracks['id'], tracks['city_id']))
+    assert city_ids['a16'] == city_ids['a17'] == 'a15'
+    # The largest part of a split continues the city, the other one starts a new city
+    assert city_ids['b16_1'] == 'b15' and city_ids['b16_2'] == 'b16_2'
+    # The largest overlap continues through a merge
+    assert city_ids['cd17'] == 'c15'
+    # Not seen for more than max_gap years: a new city
+    assert city_ids['e17'] == 'e17'
+
+    assert events.to_dict('records') == [
+        {'year': 2016, 'event': 'split', 'city_id': 'b16_2', 'other_id': 'b15'},
+        {'year': 2017, 'event': 'merge', 'city_id': 'd16', 'other_id': 'c15'}]
+
+    tracks, _ = track_cities(make_shapes(), max_gap=2)
+    assert dict(zip(tracks['id'], tracks['city_id']))['e17'] == 'e15'
+
+
+def test_track_results(tmp_path):
+    for year, shapes in SHAPES.items():
+        records = [{'id': k, 'area': g.area, 'rank': 1, 'geometry': json.dumps(mapping(g))} for k, g in shapes.items()]
+        with open(tmp_path / f'85_FRA_{year}.json', 'w') as f:
+            json.dump(records, f)
+    tracks, events = track_results(folder=str(tmp_path), n_jobs=1)
+    assert len(tracks) == sum(len(t) for t in SHAPES.values())
+    assert set(events['event']) == {'split', 'merge'} and (events['iso3c'] == 'FRA').all()
+
+    growth = growth_series(tracks)
+    assert growth.loc['a15'].tolist() == pytest.approx([4., 4.2, 4.4])
+    assert growth.loc['b15', 2016] == pytest.approx(2.4) and pd.isnull(growth.loc['b15', 2017])
@@ -0,0 +1,137 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from benchmarks.fake_s3 import FakeS3
+from cities_watch import config, urban_mapper
+from cities_watch.gcloud_utils import list_exported_objects
+from cities_watch.image_utils import get_stack_file_name
+
+
+def make_aoi(split_id):
+    return {'type': 'Feature', 'geometry': None,
+            'properties': {'country_code_gaul': 85, 'iso3c': 'FRA', 'country_name': 'France', 'split_id': split_id}}
+
+
+@pytest.fixture
+def submitted(monkeypatch):
+    # Record the exports instead of building the earth-engine graphs
+    tasks = []
+
+    class Task:
+        def __init__(self, file_name):
+            self.file_name = file_name
+
+        def status(self):
+            return {'state': 'READY', 'file_name': self.file_name}
+
+    def export_shapes_to_bucket(city_vectors, description, file_name, wait_finish=True):
+        tasks.append(file_name)
+        return Task(file_name)
+
+    monkeypatch.setattr(urban_mapper, 'map_urban_areas_multi_year', lambda **kwargs: None)
+    monkeypatch.setattr(urban_mapper, 'export_shapes_to_bucket', export_shapes_to_bucket)
+    monkeypatch.setattr(config, 'UPDATE', False)
+    return tasks
+
+
+def test_get_file_name():
+    assert urban_mapper.get_file_name(make_aoi(3)['properties'], 2015) == \
+        f'{config.FOLDER}/85_FRA/2015/{config.FILENAME}_3'
+    assert urban_mapper.get_file_name(make_aoi(3)['properties'], [2017, 2015, 2016]) == \
+        f'{config.FOLDER}/85_FRA/2015-2016-2017/{config.FILENAME}_3'
+
+
+def test_list_exported_objects():
+    s3 = FakeS3()
+    bucket = s3.Bucket(config.BUCKET_NAME)
+    bucket.put_object(Key='shapes/predicted_shapes_10.geojson', Body='{}')
+    assert list_exported_objects('shapes/predicted_shapes_1', 'geojson', s3=s3) == []
+    bucket.put_object(Key='shapes/predicted_shapes_1.geojson', Body='{}')
+    assert [t.key for t in list_exported_objects('shapes/predicted_shapes_1', 'geojson', s3=s3)] == \
+        ['shapes/predicted_shapes_1.geojson']
+
+
+def test_export_multi_year_skips_exported_splits(submitted):
+    s3 = FakeS3()
+    years = [2015, 2016]
+    # Split 10 is exported, split 1 is not: its prefix matches the export of split 10
+    done = urban_mapper.get_file_name(make_aoi(10)['properties'], years)
+    s3.Bucket(config.BUCKET_NAME).put_object(Key=done + '.geojson', Body='{}')
+
+    output = urban_mapper.export_multi_year([make_aoi(1), make_aoi(10)], years, model=None, s3=s3,
+                                            cache_stacks=False)
+    assert submitted == [urban_mapper.get_file_name(make_aoi(1)['properties'], years)]
+    assert output[0]['years'] == years and output[0]['aoi']['properties']['split_id'] == 1
+
+
+def test_list_exported_tiles():
+    s3 = FakeS3()
+    bucket = s3.Bucket(config.BUCKET_NAME)
+    for key in ['stacks/feature_stack_1-0000000000-0000000000.tif', 'stacks/feature_stack_1-0000000000-0000032768.tif',
+                'stacks/feature_stack_10.tif', 'stacks/feature_stack_1-0000000000.tif']:
+        bucket.put_object(Key=key, Body=b'')
+    assert list_exported_objects('stacks/feature_stack_1', 'tif', s3=s3) == []
+    assert [t.key for t in list_exported_objects('stacks/feature_stack_1', 'tif', s3=s3, tiled=True)] == \
+        ['stacks/feature_stack_1-0000000000-0000000000.tif', 'stacks/feature_stack_1-0000000000-0000032768.tif']
+
+
+@pytest.fixture
+def fake_ee(monkeypatch):
+    # Stack exports and task statuses, without earth-engine
+    exports, states = [], {}
+
+    def export_image_to_bucket(image, description, file_name, region, wait_finish=True):
+        exports.append(file_name)
+        task_id = f'TASK{len(exports)}'
+        states[task_id] = 'READY'
+        return SimpleNamespace(id=task_id, status=lambda: {'id': task_id, 'state': 'READY'})
+
+    def get_task_status(task_ids):
+        return [{'id': t, 'state': states[t]} for t in task_ids if t in states]
+
+    monkeypatch.setattr(urban_mapper, 'ee', SimpleNamespace(Feature=lambda aoi: SimpleNamespace(geometry=lambda: None),
+                                                            data=SimpleNamespace(getTaskStatus=get_task_status)))
+    monkeypatch.setattr(urban_mapper, 'load_feature_stack', lambda **kwargs: None)
+    monkeypatch.setattr(urban_mapper, 'export_image_to_bucket', export_image_to_bucket)
+    return SimpleNamespace(exports=exports, states=states)
+
+
+def test_get_cached_stack(fake_ee):
+    s3 = FakeS3()
+    aoi = make_aoi(1)
+    stack_name = get_stack_file_name(aoi['properties'], 2015)
+
+    # Not exported yet: the export is started once, then known as pending
+    pending = {}
+    assert urban_mapper.get_cached_stack(aoi, 2015, s3=s3, pending=pending)[0] is None
+    _, summary = urban_mapper.get_cached_stack(aoi, 2015, s3=s3, pending=pending)
+    assert summary is None and fake_ee.exports == [stack_name] and pending == {stack_name: 'TASK1'}
+
+    # Exported as a single file, or as tiles
+    s3.Bucket(config.BUCKET_NAME).put_object(Key=f'{stack_name}-0000000000-0000000000.tif', Body=b'')
+    s3.Bucket(config.BUCKET_NAME).put_object(Key=f'{stack_name}-0000032768-0000000000.tif', Body=b'')
+    assert urban_mapper.get_cached_stack(aoi, 2015, s3=s3) == (
+        [f'{stack_name}-0000000000-0000000000', f'{stack_name}-0000032768-0000000000'], None)
+    other_name = get_stack_file_name(make_aoi(2)['properties'], 2015)
+    s3.Bucket(config.BUCKET_NAME).put_object(Key=f'{other_name}.tif', Body=b'')
+    assert urban_mapper.get_cached_stack(make_aoi(2), 2015, s3=s3) == ([other_name], None)
+
+
+def test_pending_stack_exports(tmp_path, fake_ee):
+    s3 = FakeS3()
+    stacks = [get_stack_file_name(make_aoi(k)['properties'], 2015) for k in range(3)]
+    summary = [urban_mapper.get_cached_stack(make_aoi(k), 2015, s3=s3)[1] for k in range(3)]
+    summary.append({'id': 'TASK0', 'state': 'RUNNING', 'aoi': make_aoi(0)})
+    with open(tmp_path / 'run_summary_1.json', 'w') as f:
+        json.dump(summary, f, default=str)
+    # Refreshed statuses: the export of split 0 is done, the export of split 1 failed
+    fake_ee.states.update({'TASK1': 'COMPLETED', 'TASK2': 'FAILED'})
+    pending = urban_mapper.pending_stack_exports(summary_folder=str(tmp_path))
+    assert pending == {stacks[2]: 'TASK3'}
+
+    # The running export is not submitted again, the failed one is
+    urban_mapper.get_cached_stack(make_aoi(2), 2015, s3=s3, pending=pending)
+    urban_mapper.get_cached_stack(make_aoi(1), 2015, s3=s3, pending=pending)
+    assert fake_ee.exports[3:] == [stacks[1]]
@@ -0,0 +1,184 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+
+import pandas as pd
+from shapely.geometry import Point, box, mapping
+
+from benchmarks.fake_s3 import FakeS3
+from cities_watch import config, urban_tagger
+from cities_watch.urban_tagger import (CountryNodes, MemoryBudget, download_cities_shapes, list_cities_files,
+                                       merge_and_tag_stored, run_pipeline, select_year_files)
+
+AOI_PROPS = {'country_code_gaul': 85, 'iso3c': 'FRA'}
+PREFIX = f'{config.FOLDER}/85_FRA/'
+
+
+def make_features(years):
+    return [{'type': 'Feature', 'geometry': mapping(box(k, 0, k + 1, 1)), 'properties': {'city': 1, 'year': year}}
+            for k, year in enumerate(years)]
+
+
+def put_export(s3, folder, split_id, features):
+    key = f'{PREFIX}{folder}/{config.FILENAME}_{split_id}.geojson'
+    s3.Bucket(config.BUCKET_NAME).put_object(Key=key, Body=json.dumps({'type': 'FeatureCollection',
+                                                                       'features': features}))
+
+
+def obj(key, day):
+    return SimpleNamespace(key=PREFIX + key, last_modified=datetime(2020, 1, day))
+
+
+def test_select_year_files():
+    files = [obj('2015/predicted_shapes_0.geojson', 1), obj('2015-2016/predicted_shapes_0.geojson', 2),
+             obj('2015-2016/predicted_shapes_1.geojson', 2), obj('2015-2016-2017/predicted_shapes_0.geojson', 5),
+             obj('2016-2017/predicted_shapes_0.geojson', 3)]
+    # The single-year folder first, not filtered by year
+    selected, filter_year = select_year_files(files, PREFIX, 2015)
+    assert [t.key for t in selected] == [PREFIX + '2015/predicted_shapes_0.geojson'] and not filter_year
+    # Otherwise the files of a single multi-year export: the most recent one
+    selected, filter_year = select_year_files(files, PREFIX, 2016)
+    assert [t.key for t in selected] == [PREFIX + '2015-2016-2017/predicted_shapes_0.geojson'] and filter_year
+    assert select_year_files(files, PREFIX, 2019) == ([], True)
+
+
+def test_select_year_files_same_date():
+    # Exports without dates are told apart by folder name, all the files of the folder are kept
+    files = [SimpleNamespace(key=PREFIX + t) for t in ['2015-2016/predicted_shapes_0.geojson',
+                                                       '2015-2016/predicted_shapes_1.geojson',
+                                                       '2014-2015/predicted_shapes_0.geojson']]
+    selected, _ = select_year_files(files, PREFIX, 2015)
+    assert [t.key for t in selected] == [PREFIX + '2015-2016/predicted_shapes_0.geojson',
+                                         PREFIX + '2015-2016/predicted_shapes_1.geojson']
+
+
+def test_download_cities_shapes():
+    s3 = FakeS3()
+    put_export(s3, '2016', 0, make_features([2016] * 2))
+    put_export(s3, '2017-2018', 0, make_features([2017, 2018, 2018]))
+    put_export(s3, '2017-2018', 1, make_features([2018]))
+    # Other files of the folder are ignored
+    s3.Bucket(config.BUCKET_NAME).put_object(Key=f'{PREFIX}2016/readme.txt', Body='')
+
+    files, filter_year = list_cities_files(AOI_PROPS, 2016, s3=s3)
+    assert len(files) == 1 and not filter_year
+    shapes, n_bytes = download_cities_shapes(AOI_PROPS, 2016, s3=s3)
+    assert len(shapes) == 2 and n_bytes == files[0].size
+
+    # Features of the year only, from all the splits of the multi-year export
+    shapes, _ = download_cities_shapes(AOI_PROPS, 2018, s3=s3)
+    assert len(shapes) == 3 and all(t['properties']['year'] == 2018 for t in shapes)
+    assert download_cities_shapes(AOI_PROPS, 2019, s3=s3) == ([], 0)
+
+
+def write_nodes(folder, aoi_props, n):
+    df = pd.DataFrame({'name': [f'n{i}' for i in range(n)], 'geometry': [Point(i, 0).wkt for i in range(n)]})
+    df.to_csv(os.path.join(folder, f"{aoi_props['country_code_gaul']}_{aoi_props['iso3c']}.csv"))
+
+
+def test_memory_budget():
+    budget = MemoryBudget(10)
+    budget.acquire(4)
+    budget.hold(4)
+    acquired = threading.Event()
+    thread = threading.Thread(target=lambda: (budget.acquire(4), acquired.set()))
+    thread.start()
+    # Held bytes count against the budget: 12 > 10 waits for a release
+    assert not acquired.wait(.1)
+    budget.release(4)
+    assert acquired.wait(1)
+    thread.join()
+    budget.release(4)
+    budget.unhold(4)
+    # An item larger than the budget goes through alone
+    budget.acquire(20)
+    budget.release(20)
+    assert budget.used == budget.held == 0
+
+
+def test_country_nodes(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'OSM_NODES_FOLDER', str(tmp_path))
+    write_nodes(str(tmp_path), AOI_PROPS, 3)
+    budget = MemoryBudget(1e6)
+    loaded = []
+    nodes = CountryNodes([AOI_PROPS], 2, on_load=lambda aoi_meta, df: loaded.append(len(df)), budget=budget,
+                         copies=2)
+    path = nodes.get(AOI_PROPS)
+    assert nodes.get(AOI_PROPS) == path and loaded == [3]
+    # The local copy is held once per worker that may load it, until all the years are released
+    assert budget.held == 2 * os.path.getsize(path)
+    nodes.release(AOI_PROPS)
+    assert budget.held > 0
+    nodes.release(AOI_PROPS)
+    assert budget.used == budget.held == 0
+
+
+def test_merge_and_tag_stored(tmp_path, monkeypatch):
+    write_nodes(str(tmp_path), AOI_PROPS, 3)
+    path = os.path.join(str(tmp_path), '85_FRA.csv')
+    reads = []
+    monkeypatch.setattr(urban_tagger, 'read_nodes', lambda t: reads.append(t) or pd.read_csv(t, index_col=0))
+    monkeypatch.setattr(urban_tagger, 'merge_and_tag', lambda all_shapes, df_nodes, props, **kwargs: list(df_nodes))
+    monkeypatch.setattr(urban_tagger, '_WORKER_NODES', {})
+    # Nodes are read once for all the years of a country, without the index of the local copy
+    for year in [2015, 2016]:
+        assert merge_and_tag_stored([], path, {'year': year}) == ['name', 'geometry']
+    assert reads == [path]
+
+
+def test_run_pipeline(tmp_path, monkeypatch):
+    metas = [dict(AOI_PROPS, country_na_LSIB='France'), {'country_code_gaul': 1, 'iso3c': 'AAA',
+                                                         'country_na_LSIB': 'A'}]
+    monkeypatch.setattr(config, 'OSM_NODES_FOLDER', str(tmp_path))
+    for aoi_meta in metas:
+        write_nodes(str(tmp_path), aoi_meta, 3)
+
+    in_flight, peak, budgets, sunk = [0], [0], [], []
+    lock = threading.Lock()
+
+    class RecordingBudget(MemoryBudget):
+        def __init__(self, limit):
+            super().__init__(limit)
+            budgets.append(self)
+
+    def download(aoi_props, year, s3=None, listing=None):
+        if aoi_props['iso3c'] == 'AAA' and year == 2016:
+            raise IOError('bucket unavailable')
+        with lock:
+            in_flight[0] += 1
+            peak[0] = max(peak[0], in_flight[0])
+        time.sleep(.02)
+        return [year] * 2, 400 * 1024
+
+    def sink(aoi_meta, year, output, client=None, output_mode=None):
+        with lock:
+            in_flight[0] -= 1
+            sunk.append((aoi_meta['iso3c'], year, output))
+        return len(output), []
+
+    monkeypatch.setattr(urban_tagger, 'MemoryBudget', RecordingBudget)
+    monkeypatch.setattr(urban_tagger, 'list_cities_files',
+                        lambda aoi_props, year, s3=None: ([SimpleNamespace(size=400 * 1024)], False))
+    monkeypatch.setattr(urban_tagger, 'download_cities_shapes', download)
+    monkeypatch.setattr(urban_tagger, 'merge_and_tag', lambda all_shapes, df_nodes, props, **kwargs:
+                        [(props['year'], len(df_nodes))] * len(all_shapes))
+    monkeypatch.setattr(urban_tagger, 'sink_output', sink)
+    # Tagged in threads of the test process
+    monkeypatch.setattr(urban_tagger, 'get_reusable_executor', lambda max_workers: ThreadPoolExecutor(max_workers))
+    monkeypatch.setattr(urban_tagger, '_WORKER_NODES', {})
+
+    summaries = run_pipeline(metas, [2015, 2016, 2017], fetch_workers=4, tag_workers=1, sink_workers=2,
+                             queue_size=1, memory_mb=1)
+    # Two items of 400 kB (and the nodes) in a budget of 1 MB
+    assert peak[0] <= 2
+    assert budgets[0].used == budgets[0].held == 0
+    stages = {(t['iso3c'], t['year']): t['stage'] for t in summaries}
+    assert len(stages) == 6 and stages[('AAA', 2016)] == 'fetch'
+    assert [t['error'] for t in summaries if t['stage'] == 'fetch'] == ['bucket unavailable']
+    assert sorted(sunk) == sorted((iso3c, year, [(year, 3)] * 2) for iso3c, year in stages
+                                  if (iso3c, year) != ('AAA', 2016))
+    assert all(t['records'] == 2 for t in summaries if t['stage'] == 'sink')
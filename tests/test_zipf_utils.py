@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from cities_watch.zipf_utils import analyze_results, bootstrap_fits, fit_power_law, fit_rank_size
+
+
+def pareto_sample(alpha, xmin, n, seed=0):
+    # Continuous power law of pdf exponent alpha, by inverse transform sampling
+    u = np.random.default_rng(seed).random(n)
+    return xmin * (1 - u) ** (-1 / (alpha - 1))
+
+
+def test_power_law_mle_known_xmin():
+    fit = fit_power_law(pareto_sample(2.5, 1., 20000), xmin=1.)
+    assert fit['alpha'] == pytest.approx(2.5, abs=0.05)
+    assert fit['zipf'] == pytest.approx(fit['alpha'] - 1)
+    assert fit['n_tail'] == 20000
+
+
+def test_power_law_mle_selects_xmin():
+    # Uniform body below the power-law tail starting at 10
+    rng = np.random.default_rng(1)
+    x = np.concatenate([rng.uniform(1., 10., 5000), pareto_sample(2., 10., 5000, seed=2)])
+    fit = fit_power_law(x, min_tail=50)
+    assert fit['alpha'] == pytest.approx(2., abs=0.1)
+    assert 5. < fit['xmin'] < 20.
+
+
+def test_rank_size_of_exact_zipf():
+    # Areas of an exact Zipf law: rank - 0.5 = c / area
+    df = pd.DataFrame({'area': 1e4 / (np.arange(1, 1001) - .5), 'country_code_gaul': 85, 'iso3c': 'FRA',
+                       'year': 2019})
+    fit = fit_rank_size(df).iloc[0]
+    assert fit['zipf'] == pytest.approx(1.)
+    assert fit['r2'] == pytest.approx(1.)
+    assert fit['n'] == 1000
+
+
+def test_power_law_short_tail():
+    x = pareto_sample(2.5, 1., 100)
+    with pytest.raises(ValueError):
+        fit_power_law(x, xmin=x.max() + 1)
+    with pytest.raises(ValueError):
+        fit_power_law(x, xmin=np.sort(x)[-10], min_tail=50)
+    with pytest.raises(ValueError):
+        fit_power_law([])
+    assert fit_power_law(x, xmin=np.sort(x)[-10], min_tail=10)['n_tail'] == 10
+
+
+def test_bootstrap_fits():
+    x = pareto_sample(2., 1., 2000, seed=3)
+    ols, mle = bootstrap_fits(x, 1., n_boot=50)
+    assert ols.shape == mle.shape == (50,)
+    assert np.percentile(mle, 2.5) < 1. < np.percentile(mle, 97.5)
+
+
+def test_analyze_results():
+    df = pd.concat([pd.DataFrame({'area': pareto_sample(alpha, 1., n, seed=k), 'country_code_gaul': k,
+                                  'iso3c': iso3c, 'year': 2019})
+                    for k, (iso3c, alpha, n) in enumerate([('AAA', 2., 3000), ('BBB', 3., 3000), ('CCC', 2., 20)])])
+    out = analyze_results(df, n_boot=20, n_jobs=1, verbose=False).set_index('iso3c')
+    assert out.loc['AAA', 'zipf_mle'] == pytest.approx(1., abs=.15)
+    assert out.loc['BBB', 'zipf_mle'] == pytest.approx(2., abs=.3)
+    assert out.loc['AAA', 'zipf_mle_low'] < out.loc['AAA', 'zipf_mle'] < out.loc['AAA', 'zipf_mle_high']
+    # Groups smaller than min_tail are only fitted with OLS
+    assert np.isnan(out.loc['CCC', 'zipf_mle']) and np.isfinite(out.loc['CCC', 'zipf_ols'])